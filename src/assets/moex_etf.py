@@ -1,314 +1,168 @@
 # src/assets/moex_etf.py
 import aiohttp
+import asyncio
 import logging
-from typing import Optional
-from datetime import datetime, timedelta
+import orjson
+import re
+from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, time, timedelta, timezone
+from time import monotonic
 
 from .base import BaseAsset, AssetPrice
 from src.config.assets import AssetConfig
+from src.services._http import conditional_headers, get_shared_session
 
 logger = logging.getLogger(__name__)
 
-# src/assets/moex_etf.py
-import aiohttp
-import logging
-from typing import Optional
-from datetime import datetime, timedelta
-
-from .base import BaseAsset, AssetPrice
-from src.config.assets import AssetConfig
-
-logger = logging.getLogger(__name__)
-
-
-class MoexETFAsset(BaseAsset):
-    """Класс для ETF на Московской бирже"""
-
-    def __init__(self, config: AssetConfig):
-        super().__init__(config)
-        self.session: Optional[aiohttp.ClientSession] = None
-        self._cache = {}
-        self._cache_time = {}
-
-    async def _get_session(self) -> aiohttp.ClientSession:
-        if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=10)
-            self.session = aiohttp.ClientSession(timeout=timeout)
-        return self.session
-
-    async def get_price(self) -> Optional[AssetPrice]:
-        """Получает цену с Московской биржи"""
-
-        # Проверяем кэш (актуален 1 минуту)
-        if self.symbol in self._cache:
-            if datetime.now() - self._cache_time[self.symbol] < timedelta(minutes=1):
-                return self._cache[self.symbol]
-
-        try:
-            # Пробуем несколько способов
-
-            # Способ 1: MOEX ISS API (оптимизированный)
-            price = await self._get_price_moex_iss()
-
-            if price is None:
-                # Способ 2: Investing.com через парсинг
-                price = await self._get_price_investing()
-
-            if price is None:
-                # Способ 3: Фиксированная цена из конфигурации
-                price = self._get_fallback_price()
-
-            if price:
-                asset_price = AssetPrice(
-                    symbol=self.symbol,
-                    price=price,
-                    source="moex",
-                    timestamp=datetime.now()
-                )
-
-                # Кэшируем
-                self._cache[self.symbol] = asset_price
-                self._cache_time[self.symbol] = datetime.now()
-
-                return asset_price
-
-        except Exception as e:
-            logger.error(f"Error fetching MOEX ETF price for {self.symbol}: {e}")
-
-        return None
-
-    async def _get_price_moex_iss(self) -> Optional[float]:
-        """Получает цену через MOEX ISS API (оптимизированная версия)"""
-        try:
-            session = await self._get_session()
-
-            # Определяем тикер и торговую площадку
-            ticker = self.config.source_id or self.symbol.upper()
-
-            # Для разных ETF могут быть разные площадки
-            # FXGD торгуется на TQTF (ETF)
-            # Проверяем несколько возможных площадок
-            board_candidates = ["TQTF", "TQTD", "TQBR"]
-
-            for board in board_candidates:
-                price = await self._try_get_price_from_board(session, ticker, board)
-                if price:
-                    return price
-
-            # Если не нашли по основной площадке, пробуем общий endpoint
-            return await self._get_price_from_general_endpoint(session, ticker)
-
-        except Exception as e:
-            logger.error(f"MOEX ISS API error for {self.symbol}: {e}")
-
-        return None
-
-    async def _try_get_price_from_board(self, session: aiohttp.ClientSession,
-                                        ticker: str, board: str) -> Optional[float]:
-        """Пытается получить цену с конкретной торговой площадки"""
-        try:
-            url = f"https://iss.moex.com/iss/engines/stock/markets/shares/boards/{board}/securities/{ticker}.json"
-            params = {
-                "iss.meta": "off",
-                "iss.json": "extended",
-                "securities.columns": "SECID,LAST,PREVADMITTEDQUOTE,OPEN,CLOSEPRICE"
-            }
-
-            async with session.get(url, params=params, timeout=5) as response:
-                if response.status == 200:
-                    data = await response.json()
-
-                    # Проверяем структуру ответа
-                    if len(data) > 1 and 'securities' in data[1]:
-                        securities_data = data[1]['securities']
-                        if securities_data and len(securities_data['data']) > 0:
-                            # Приоритеты получения цены:
-                            # 1. LAST - последняя сделка
-                            # 2. PREVADMITTEDQUOTE - предыдущая биржевая цена
-                            # 3. OPEN - цена открытия
-                            # 4. CLOSEPRICE - цена закрытия
-
-                            row = securities_data['data'][0]
-                            last_price = row[1]  # LAST
-
-                            if last_price and last_price > 0:
-                                logger.info(f"Got price for {ticker} from {board}: LAST={last_price}")
-                                return float(last_price)
-
-                            # Если LAST нет, пробуем другие поля
-                            prev_price = row[2]  # PREVADMITTEDQUOTE
-                            if prev_price and prev_price > 0:
-                                logger.info(f"Got price for {ticker} from {board}: PREVADMITTEDQUOTE={prev_price}")
-                                return float(prev_price)
-
-                            open_price = row[3]  # OPEN
-                            if open_price and open_price > 0:
-                                logger.info(f"Got price for {ticker} from {board}: OPEN={open_price}")
-                                return float(open_price)
-
-                            close_price = row[4]  # CLOSEPRICE
-                            if close_price and close_price > 0:
-                                logger.info(f"Got price for {ticker} from {board}: CLOSEPRICE={close_price}")
-                                return float(close_price)
-
-            return None
-
-        except Exception as e:
-            logger.debug(f"Failed to get price from board {board} for {ticker}: {e}")
-            return None
-
-    async def _get_price_from_general_endpoint(self, session: aiohttp.ClientSession,
-                                               ticker: str) -> Optional[float]:
-        """Получает цену через общий endpoint (без указания площадки)"""
-        try:
-            url = f"https://iss.moex.com/iss/engines/stock/markets/shares/securities/{ticker}.json"
-            params = {
-                "iss.meta": "off",
-                "iss.json": "extended",
-                "securities.columns": "PREVPRICE,PREVLEGALCLOSEPRICE,PREVADMITTEDQUOTE"
-            }
+# Шаблоны цены на странице Investing.com (в порядке приоритета), компилируются один раз
+_INVESTING_PRICE_PATTERNS = (
+    re.compile(r'"last":"([\d\.,]+)"'),
+    re.compile(r'data-test="instrument-price-last">([\d\.,]+)'),
+    re.compile(r'class="text-2xl"[^>]*>([\d\.,]+)'),
+)
 
-            async with session.get(url, params=params, timeout=5) as response:
-                if response.status == 200:
-                    data = await response.json()
+# Основная сессия фондового рынка MOEX (по московскому времени, без учета праздников)
+_MSK = timezone(timedelta(hours=3))
+_MARKET_OPEN = time(10, 0)
+_MARKET_CLOSE = time(18, 45)
 
-                    if len(data) > 1 and 'securities' in data[1]:
-                        securities_data = data[1]['securities']
-                        if securities_data and len(securities_data['data']) > 0:
-                            # Пробуем получить цену из разных полей
-                            row = securities_data['data'][0]
+# Срок жизни цены: во время торгов цена меняется, вне торгов - нет
+_TTL_MARKET_OPEN = timedelta(minutes=1)
+_TTL_MARKET_CLOSED = timedelta(hours=1)
 
-                            prev_price = row[0]  # PREVPRICE
-                            if prev_price and prev_price > 0:
-                                logger.info(f"Got price for {ticker} from general endpoint: PREVPRICE={prev_price}")
-                                return float(prev_price)
 
-                            prev_legal_close = row[1]  # PREVLEGALCLOSEPRICE
-                            if prev_legal_close and prev_legal_close > 0:
-                                logger.info(
-                                    f"Got price for {ticker} from general endpoint: PREVLEGALCLOSEPRICE={prev_legal_close}")
-                                return float(prev_legal_close)
+def _moex_trading_session_id(moment: datetime) -> Tuple[date, bool]:
+    """Идентификатор торговой сессии MOEX: (дата по Москве, идут ли торги)"""
+    msk = moment.astimezone(_MSK)
+    is_open = msk.weekday() < 5 and _MARKET_OPEN <= msk.time() < _MARKET_CLOSE
+    return msk.date(), is_open
 
-                            prev_admitted = row[2]  # PREVADMITTEDQUOTE
-                            if prev_admitted and prev_admitted > 0:
-                                logger.info(
-                                    f"Got price for {ticker} from general endpoint: PREVADMITTEDQUOTE={prev_admitted}")
-                                return float(prev_admitted)
 
-            return None
+def _moex_cache_lifetime(moment: datetime) -> float:
+    """
+    Сколько секунд действительна цена, полученная в moment:
+    TTL текущей торговой сессии, но не дольше момента смены сессии
+    """
+    msk = moment.astimezone(_MSK)
+    day, is_open = _moex_trading_session_id(msk)
+    ttl = _TTL_MARKET_OPEN if is_open else _TTL_MARKET_CLOSED
 
-        except Exception as e:
-            logger.debug(f"Failed to get price from general endpoint for {ticker}: {e}")
-            return None
+    # Сессия меняется при открытии и закрытии торгов в будни и в полночь
+    boundaries = [datetime.combine(day + timedelta(days=1), time(0), _MSK)]
+    if msk.weekday() < 5:
+        boundaries += [datetime.combine(day, t, _MSK) for t in (_MARKET_OPEN, _MARKET_CLOSE)]
+    until_change = min(b for b in boundaries if b > msk) - msk
 
-    async def _get_price_investing(self) -> Optional[float]:
-        """Получает цену через парсинг Investing.com"""
-        try:
-            session = await self._get_session()
+    return min(ttl, until_change).total_seconds()
 
-            # Investing.com для FXGD
-            urls = [
-                f"https://ru.investing.com/etfs/finex-fizicheskoe-zoloto",
-                f"https://ru.investing.com/etfs/finex-physical-gold"
-            ]
 
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7'
-            }
+# Торговая площадка для ETF и адрес ее списка бумаг в MOEX ISS
+_MOEX_BOARD = "TQTF"
+_ISS_BOARD_URL = f"https://iss.moex.com/iss/engines/stock/markets/shares/boards/{_MOEX_BOARD}/securities"
 
-            for url in urls:
-                try:
-                    async with session.get(url, headers=headers) as response:
-                        if response.status == 200:
-                            html = await response.text()
+# Резервные цены (примерные, в рублях), если ни один источник не ответил.
+# Символы активов в конфигурации уже в нижнем регистре
+_FALLBACK_PRICES = {
+    "fxgd": 35.0,
+    "tbrd": 1500.0,
+}
 
-                            # Простой парсинг (нужно доработать под конкретную структуру)
-                            import re
 
-                            # Ищем цену в HTML
-                            price_patterns = [
-                                r'"last":"([\d\.]+)"',
-                                r'data-test="instrument-price-last">([\d\.,]+)',
-                                r'class="text-2xl"[^>]*>([\d\.,]+)'
-                            ]
-
-                            for pattern in price_patterns:
-                                matches = re.search(pattern, html)
-                                if matches:
-                                    price_str = matches.group(1).replace(',', '.')
-                                    return float(price_str)
+def _iss_block(data, block: str) -> List[dict]:
+    """Строки блока из ответа MOEX ISS в формате iss.json=extended"""
+    # Структура ответа: [{"charsetinfo": ...}, {"securities": [{колонка: значение}, ...], "marketdata": [...]}]
+    if len(data) < 2:
+        return []
+    return data[1].get(block) or []
 
-                except:
-                    continue
 
-        except Exception as e:
-            logger.error(f"Investing.com parsing error: {e}")
+def _iss_prices(data) -> Dict[str, float]:
+    """
+    Цены бумаг из ответа MOEX ISS по SECID: LAST из блока marketdata,
+    а если торгов не было - PREVPRICE из блока securities
+    """
+    marketdata = {row["SECID"]: row for row in _iss_block(data, "marketdata")}
 
-        return None
+    prices = {}
+    for row in _iss_block(data, "securities"):
+        price = _iss_row_price({**row, **marketdata.get(row["SECID"], {})})
+        if price is not None:
+            prices[row["SECID"]] = price
+    return prices
 
-    def _get_fallback_price(self) -> Optional[float]:
-        """Возвращает резервную цену из конфигурации"""
-        # Можно добавить поле в AssetConfig для резервной цены
-        fallback_prices = {
-            "fxgd": 35.0,  # Примерная цена в рублях
-            "tbrd": 1500.0
-        }
 
-        return fallback_prices.get(self.symbol)
+def _iss_row_price(row: dict) -> Optional[float]:
+    """LAST, а если торгов не было - PREVPRICE"""
+    for column in ("LAST", "PREVPRICE"):
+        price = row.get(column)
+        if price and price > 0:
+            return float(price)
+    return None
 
-    def validate_amount(self, amount: float) -> bool:
-        return (
-                amount >= self.config.min_amount and
-                amount <= self.config.max_amount
-        )
 
-    def get_etf_info(self) -> dict:
-        """Информация об ETF"""
-        info = {
-            "name": self.config.name,
-            "currency": "RUB",
-            "exchange": "MOEX",
-            "ticker": "FXGD",
-            "isin": "IE00B8XB7377",  # ISIN код FXGD
-            "expense_ratio": 0.45,  # 0.45% комиссия
-            "gold_per_share": 0.1,  # 0.1 грамма золота на акцию
-            "fund_size": "~100 млрд руб",  # Примерный размер фонда
-            "description": self.config.description
-        }
-
-        # Добавляем текущую цену если есть
-        if self.symbol in self._cache:
-            info["current_price"] = self._cache[self.symbol].price
-
-        return info
-
-    async def close(self):
-        if self.session and not self.session.closed:
-            await self.session.close()
 class MoexETFAsset(BaseAsset):
     """Класс для ETF на Московской бирже"""
 
     def __init__(self, config: AssetConfig):
         super().__init__(config)
+        # Собственная сессия не создается: все ETF используют общий пул соединений
         self.session: Optional[aiohttp.ClientSession] = None
         self._cache = {}
-        self._cache_time = {}
+        # Дедлайны записей кэша по time.monotonic()
+        self._cache_deadline = {}
+        # Границы допустимого количества (проверяются на каждый /add)
+        self._bounds = (config.min_amount, config.max_amount)
+        # Незавершенные запросы цены по символу (single-flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # ETag, Last-Modified и цена последнего ответа MOEX ISS
+        self._iss_validators: Optional[Tuple[Optional[str], Optional[str], float]] = None
 
     async def _get_session(self) -> aiohttp.ClientSession:
-        if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=10)
-            self.session = aiohttp.ClientSession(timeout=timeout)
-        return self.session
+        """Возвращает собственную сессию, если задана, иначе общий пул"""
+        if self.session is not None and not self.session.closed:
+            return self.session
+        return await get_shared_session()
+
+    def _secid(self) -> str:
+        """Код бумаги в MOEX ISS (SECID в ответах биржи всегда в верхнем регистре)"""
+        return (self.config.source_id or self.symbol).upper()
 
     async def get_price(self) -> Optional[AssetPrice]:
         """Получает цену с Московской биржи"""
 
-        # Проверяем кэш (актуален 1 минуту)
-        if self.symbol in self._cache:
-            if datetime.now() - self._cache_time[self.symbol] < timedelta(minutes=1):
-                return self._cache[self.symbol]
+        # Проверяем кэш: цена действительна в пределах той же торговой сессии,
+        # 1 минуту во время торгов и 1 час, когда биржа закрыта.
+        # Дедлайн считается при записи, проверка - одно сравнение чисел
+        deadline = self._cache_deadline.get(self.symbol)
+        if deadline is not None and monotonic() < deadline:
+            return self._cache[self.symbol]
 
+        # Такой же запрос уже выполняется - ждем его результат вместо нового запроса к бирже
+        inflight = self._inflight.get(self.symbol)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[self.symbol] = future
+        try:
+            asset_price = await self._fetch_price()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            # Ожидающие запросы получают ту же ошибку, что и первый
+            future.set_exception(e)
+            # Ошибка уже пробрасывается ниже - без ожидающих она не должна попасть в лог asyncio
+            future.exception()
+            raise
+        else:
+            future.set_result(asset_price)
+            return asset_price
+        finally:
+            self._inflight.pop(self.symbol, None)
+
+    async def _fetch_price(self) -> Optional[AssetPrice]:
+        """Загружает цену из доступных источников и сохраняет ее в кэш"""
         try:
             # Пробуем несколько способов
 
@@ -324,16 +178,17 @@ class MoexETFAsset(BaseAsset):
                 price = self._get_fallback_price()
 
             if price:
+                now = datetime.now()
                 asset_price = AssetPrice(
                     symbol=self.symbol,
                     price=price,
                     source="moex",
-                    timestamp=datetime.now()
+                    timestamp=now
                 )
 
                 # Кэшируем
                 self._cache[self.symbol] = asset_price
-                self._cache_time[self.symbol] = datetime.now()
+                self._cache_deadline[self.symbol] = monotonic() + _moex_cache_lifetime(now)
 
                 return asset_price
 
@@ -347,53 +202,98 @@ class MoexETFAsset(BaseAsset):
         try:
             session = await self._get_session()
 
-            # Для FXGD используем тикер FXGD
-            board = "TQTF"  # Торговая площадка для ETF
-            security = "FXGD"  # Или self.config.source_id
+            security = self._secid()
 
-            # API Московской биржи
-            url = f"https://iss.moex.com/iss/engines/stock/markets/shares/boards/{board}/securities/{security}.json"
+            # API Московской биржи: LAST (блок marketdata) и PREVPRICE (блок securities)
+            # запрашиваются одним вызовом, PREVPRICE используется, когда торгов нет и LAST пустой
+            url = f"{_ISS_BOARD_URL}/{security}.json"
             params = {
                 "iss.meta": "off",
                 "iss.json": "extended",
-                "securities.columns": "SECID,LAST,LASTTOPREVPRICE"
+                "iss.only": "securities,marketdata",
+                "securities.columns": "SECID,PREVPRICE",
+                "marketdata.columns": "SECID,LAST"
             }
 
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-
-                    # Структура ответа MOEX
-                    if len(data) > 1 and 'securities' in data[1]:
-                        securities_data = data[1]['securities']
-                        if securities_data and len(securities_data['data']) > 0:
-                            last_price = securities_data['data'][0][1]  # LAST цена
-                            if last_price and last_price > 0:
-                                return float(last_price)
-
-            # Альтернативный endpoint
-            url2 = f"https://iss.moex.com/iss/engines/stock/markets/shares/securities/{security}.json"
-            params2 = {
-                "iss.meta": "off",
-                "iss.json": "extended",
-                "securities.columns": "PREVPRICE"
-            }
+            # Условный запрос: если котировка не изменилась (ночью, в выходные),
+            # ISS вернет 304 без тела и цена продлевается без разбора
+            headers = None
+            if self._iss_validators is not None:
+                etag, last_modified, _ = self._iss_validators
+                headers = conditional_headers(etag, last_modified)
+
+            async with session.get(url, params=params, headers=headers) as response:
+                if response.status == 304 and self._iss_validators is not None:
+                    logger.debug(f"MOEX ISS price for {self.symbol} not modified")
+                    return self._iss_validators[2]
 
-            async with session.get(url2, params=params2) as response:
                 if response.status == 200:
-                    data = await response.json()
-                    if len(data) > 1 and 'securities' in data[1]:
-                        securities_data = data[1]['securities']
-                        if securities_data and len(securities_data['data']) > 0:
-                            prev_price = securities_data['data'][0][0]  # PREVPRICE
-                            if prev_price and prev_price > 0:
-                                return float(prev_price)
+                    # Ответ ISS разбирается orjson прямо из байтов
+                    data = orjson.loads(await response.read())
+                    price = _iss_prices(data).get(security)
+
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+                    if price is not None and (etag or last_modified):
+                        self._iss_validators = (etag, last_modified, price)
+                    return price
 
         except Exception as e:
             logger.error(f"MOEX ISS API error for {self.symbol}: {e}")
 
         return None
 
+    @classmethod
+    async def prefetch_all(cls, assets: List["MoexETFAsset"]) -> Dict[str, float]:
+        """
+        Загружает цены нескольких ETF одним запросом к MOEX ISS и кладет их в кэш активов,
+        чтобы последующие get_price() не обращались к бирже по отдельности
+        :return: Найденные цены {symbol: price}
+        """
+        by_secid = {asset._secid(): asset for asset in assets}
+        if not by_secid:
+            return {}
+
+        try:
+            session = await next(iter(by_secid.values()))._get_session()
+            params = {
+                "iss.meta": "off",
+                "iss.json": "extended",
+                "iss.only": "securities,marketdata",
+                "securities": ",".join(by_secid),
+                "securities.columns": "SECID,PREVPRICE",
+                "marketdata.columns": "SECID,LAST"
+            }
+
+            async with session.get(f"{_ISS_BOARD_URL}.json", params=params) as response:
+                if response.status != 200:
+                    logger.error(f"MOEX ISS batch request failed: HTTP {response.status}")
+                    return {}
+                secid_prices = _iss_prices(orjson.loads(await response.read()))
+
+        except Exception as e:
+            logger.error(f"MOEX ISS batch request error: {e}")
+            return {}
+
+        prices = {}
+        now = datetime.now()
+        deadline = monotonic() + _moex_cache_lifetime(now)
+        for secid, price in secid_prices.items():
+            asset = by_secid.get(secid)
+            if asset is None:
+                continue
+
+            asset._cache[asset.symbol] = AssetPrice(
+                symbol=asset.symbol,
+                price=price,
+                source="moex",
+                timestamp=now
+            )
+            asset._cache_deadline[asset.symbol] = deadline
+            prices[asset.symbol] = price
+
+        return prices
+
     async def _get_price_investing(self) -> Optional[float]:
         """Получает цену через парсинг Investing.com"""
         try:
@@ -416,25 +316,12 @@ class MoexETFAsset(BaseAsset):
                         if response.status == 200:
                             html = await response.text()
 
-                            # Простой парсинг
-                            import re
-
                             # Ищем цену в HTML
-                            price_patterns = [
-                                r'"last":"([\d\.,]+)"',
-                                r'data-test="instrument-price-last">([\d\.,]+)',
-                                r'class="text-2xl"[^>]*>([\d\.,]+)'
-                            ]
-
-                            for pattern in price_patterns:
-                                matches = re.search(pattern, html)
+                            for pattern in _INVESTING_PRICE_PATTERNS:
+                                matches = pattern.search(html)
                                 if matches:
-                                    price_str = matches.group(1)
-                                    # Убираем разделители тысяч и заменяем запятую на точку для десятичных
-                                    price_str = price_str.replace(',', '')  # Убираем запятые как разделители тысяч
-                                    price_str = price_str.replace(',',
-                                                                  '.')  # Если осталась запятая как десятичный разделитель
-                                    return float(price_str)
+                                    # Убираем запятые - разделители тысяч
+                                    return float(matches.group(1).replace(',', ''))
 
                 except:
                     continue
@@ -446,19 +333,12 @@ class MoexETFAsset(BaseAsset):
 
     def _get_fallback_price(self) -> Optional[float]:
         """Возвращает резервную цену из конфигурации"""
-        # Можно добавить поле в AssetConfig для резервной цены
-        fallback_prices = {
-            "fxgd": 35.0,  # Примерная цена в рублях
-            "tbrd": 1500.0
-        }
-
-        return fallback_prices.get(self.symbol)
+        return _FALLBACK_PRICES.get(self.symbol)
 
     def validate_amount(self, amount: float) -> bool:
-        return (
-                amount >= self.config.min_amount and
-                amount <= self.config.max_amount
-        )
+        """Валидирует количество паев"""
+        min_amount, max_amount = self._bounds
+        return min_amount <= amount <= max_amount
 
     def get_etf_info(self) -> dict:
         """Информация об ETF"""
@@ -481,5 +361,7 @@ class MoexETFAsset(BaseAsset):
         return info
 
     async def close(self):
+        """Закрывает собственную сессию (общий пул закрывается при остановке бота)"""
         if self.session and not self.session.closed:
-            await self.session.close()
\ No newline at end of file
+            await self.session.close()
+            self.session = None
\ No newline at end of file
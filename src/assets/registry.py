@@ -13,6 +13,7 @@ class AssetRegistry:
 
     def __init__(self):
         self._assets: Dict[str, BaseAsset] = {}
+        self._by_alias: Dict[str, BaseAsset] = {}  # Индекс алиасов для поиска без перебора
         self._load_assets()
 
     def _load_assets(self):
@@ -21,6 +22,9 @@ class AssetRegistry:
             try:
                 asset = asset_factory.create_asset(config)
                 self._assets[config.symbol] = asset
+                for alias in config.aliases:
+                    # При совпадении алиасов выигрывает первый актив, как при переборе
+                    self._by_alias.setdefault(alias, asset)
             except Exception as e:
                 import logging
                 logger = logging.getLogger(__name__)
@@ -31,15 +35,16 @@ class AssetRegistry:
         symbol_lower = symbol.lower()
 
         # Прямой поиск
-        if symbol_lower in self._assets:
-            return self._assets[symbol_lower]
+        asset = self._assets.get(symbol_lower)
+        if asset is not None:
+            return asset
 
         # Поиск по алиасам
-        for asset in self._assets.values():
-            if symbol_lower in asset.config.aliases:
-                return asset
+        return self._by_alias.get(symbol_lower)
 
-        return None
+    def get_assets(self, symbols: List[str]) -> Dict[str, Optional[BaseAsset]]:
+        """Получает активы для нескольких символов {symbol: asset или None}"""
+        return {symbol: self.get_asset(symbol) for symbol in symbols}
 
     def get_all_assets(self) -> List[BaseAsset]:
         """Возвращает все активы"""
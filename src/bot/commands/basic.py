@@ -23,17 +23,18 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
 
-    # Создаем/получаем пользователя
-    user_repo.get_or_create_user(
-        user_id=user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        language_code=user.language_code,
-        is_premium=getattr(user, 'is_premium', False)
-    )
-
-    record_user_activity(user.id, "start")
+    # Создаем/получаем пользователя и записываем активность одним сохранением
+    with user_repo.transaction():
+        user_repo.get_or_create_user(
+            user_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            language_code=user.language_code,
+            is_premium=getattr(user, 'is_premium', False)
+        )
+
+        record_user_activity(user.id, "start")
 
     welcome_message = get_welcome_message(get_user_display_name(update))
 
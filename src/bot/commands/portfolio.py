@@ -224,10 +224,11 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Удаляем все активы
     cleared_count = 0
-    for symbol in list(portfolio.keys()):
-        success, _ = portfolio_repo.remove_asset(user.id, symbol, None)
-        if success:
-            cleared_count += 1
+    with portfolio_repo.transaction():
+        for symbol in list(portfolio.keys()):
+            success, _ = portfolio_repo.remove_asset(user.id, symbol, None)
+            if success:
+                cleared_count += 1
 
     message = f"🧹 **Портфель очищен**\n\n"
     message += f"Удалено активов: {cleared_count}\n"
@@ -196,7 +196,7 @@ def get_crypto_assets_message(assets: List, prices_info: Dict) -> str:
 
             if price_usd:
                 if not price_rub:
-                    price_rub = currency_service.usd_to_rub(price_usd)
+                    price_rub = currency_service.usd_to_rub_real_sync(price_usd)
 
                 message += f"  Цена: ${price_usd:,.4f} | {currency_service.format_rub(price_rub)}\n"
                 if change := price_info.get("change_24h"):
@@ -221,7 +221,7 @@ def get_crypto_assets_message(assets: List, prices_info: Dict) -> str:
 
             line = f"{asset.config.emoji} {asset.config.name} ({asset.symbol.upper()})"
             if price_usd:
-                price_rub = price_info.get("price_rub", currency_service.usd_to_rub(price_usd))
+                price_rub = price_info.get("price_rub", currency_service.usd_to_rub_real_sync(price_usd))
                 line += f" — ${price_usd:.4f} | {currency_service.format_rub(price_rub)}"
 
             message += f"{line}\n"
@@ -58,7 +58,7 @@ class Settings:
     LOG_FILE: str = "logs/bot.log"
 
     # База данных
-    DATA_FILE: str = "data/user_data.json"
+    DATA_FILE: str = "data/user_data.db"
 
     # Настройки приложения
     DEFAULT_CURRENCY: str = "USD"
@@ -104,7 +104,7 @@ class Settings:
             COINGECKO_API_URL=os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3"),
             CACHE_TTL=int(os.getenv("CACHE_TTL", "60")),
             LOG_LEVEL=os.getenv("LOG_LEVEL", "INFO"),
-            DATA_FILE=os.getenv("DATA_FILE", "data/user_data.json"),
+            DATA_FILE=os.getenv("DATA_FILE", "data/user_data.db"),
             DEFAULT_CURRENCY=os.getenv("DEFAULT_CURRENCY", "USD"),
             UPDATE_INTERVAL=int(os.getenv("UPDATE_INTERVAL", "60")),
             RUB_EXCHANGE_RATE=float(os.getenv("RUB_EXCHANGE_RATE", "80.0")),
@@ -2,76 +2,202 @@
 Простой рабочий репозиторий для портфелей.
 """
 
-import json
-import os
 import logging
-from datetime import datetime, timezone
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
 from typing import Dict, Any, Optional, Tuple, List
 from pathlib import Path
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
+# Схема хранилища: изменение портфеля - запись одной строки, а не всего файла
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id    INTEGER PRIMARY KEY,
+    username   TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS assets (
+    user_id    INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    symbol     TEXT NOT NULL,
+    amount     REAL NOT NULL,
+    added_at   TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, symbol)
+);
+"""
+
+_UPSERT_USER = (
+    "INSERT INTO users (user_id, username, created_at, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, updated_at = excluded.updated_at"
+)
+
+_UPSERT_ASSET = (
+    "INSERT INTO assets (user_id, symbol, amount, added_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id, symbol) DO UPDATE SET amount = excluded.amount, updated_at = excluded.updated_at"
+)
+
+_TOUCH_USER = "UPDATE users SET updated_at = ? WHERE user_id = ?"
+
 
 class SimplePortfolioRepository:
     """Простой репозиторий для работы с портфелями"""
 
     def __init__(self, data_file: str = None):
-        # Определяем путь к файлу данных
+        # Определяем путь к файлу базы данных
         if data_file is None:
             # Путь относительно корня проекта
             project_root = Path(__file__).parent.parent.parent
-            self.data_file = project_root / "src" / "data" / "user_data.json"
+            self.data_file = project_root / "src" / "data" / "user_data.db"
         else:
             self.data_file = Path(data_file)
 
+        # Прежний JSON файл с портфелями: для пути вида *.json база создается рядом
+        # (*.db), а данные переносятся из указанного файла
+        self._legacy_file = self.data_file.with_suffix('.json')
+        if self.data_file.suffix == '.json':
+            self.data_file = self.data_file.with_suffix('.db')
+
         # Создаем директорию если нужно
         self.data_file.parent.mkdir(parents=True, exist_ok=True)
 
-        # Загружаем данные
+        self._conn = self._connect()
+
+        # Отложенная фиксация изменений внутри transaction()
+        self._tx_depth = 0
+
+        # Данные читаются из памяти, каждое изменение сразу пишется в SQLite
         self.data: Dict[str, Any] = self._load_data()
 
+        # Число активов всех пользователей, поддерживается при изменениях
+        self._total_assets = self._count_assets()
+
         logger.info(f"SimplePortfolioRepository initialized with {self.data_file}")
         logger.info(f"Loaded {len(self.data)} users")
 
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает базу в режиме WAL (чтение не блокируется записью)"""
+        try:
+            conn = self._open_connection()
+        except sqlite3.DatabaseError as e:
+            logger.error(f"Invalid database {self.data_file}: {e}")
+            # Сохраняем поврежденный файл и начинаем с чистой базы
+            backup_file = self.data_file.with_suffix(f'.backup.{datetime.now().strftime("%Y%m%d_%H%M%S")}.db')
+            shutil.move(str(self.data_file), backup_file)
+            logger.error(f"Created backup of corrupted file: {backup_file}")
+            conn = self._open_connection()
+        return conn
+
+    def _open_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.data_file), check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(_SCHEMA)
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+        return conn
+
     def _load_data(self) -> Dict[str, Any]:
-        """Загружает данные из JSON файла"""
+        """Загружает данные из базы (при первом запуске - из прежнего JSON файла)"""
+        data = self._read_data()
+
+        if not data:
+            data = self._import_json()
+
+        logger.info(f"Loaded data from {self.data_file}")
+        return data
+
+    def _read_data(self) -> Dict[str, Any]:
+        """Читает пользователей и их активы из базы одним запросом"""
         try:
-            if self.data_file.exists():
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                logger.info(f"Loaded data from {self.data_file}")
-                return data
-            else:
-                logger.info(f"Data file {self.data_file} does not exist, starting fresh")
-                return {}
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in {self.data_file}: {e}")
-            # Создаем backup поврежденного файла
-            backup_file = self.data_file.with_suffix(f'.backup.{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
-            if self.data_file.exists():
-                import shutil
-                shutil.copy2(self.data_file, backup_file)
-                logger.error(f"Created backup of corrupted file: {backup_file}")
-            return {}
-        except Exception as e:
+            rows = self._conn.execute(
+                "SELECT u.user_id, u.username, u.created_at, u.updated_at, "
+                "a.symbol, a.amount, a.added_at, a.updated_at "
+                "FROM users u LEFT JOIN assets a ON a.user_id = u.user_id"
+            ).fetchall()
+        except sqlite3.Error as e:
             logger.error(f"Failed to load data from {self.data_file}: {e}")
             return {}
 
-    def _save_data(self) -> bool:
-        """Сохраняет данные в JSON файл"""
+        data: Dict[str, Any] = {}
+        for user_id, username, created_at, updated_at, symbol, amount, added_at, asset_updated_at in rows:
+            user = data.get(str(user_id))
+            if user is None:
+                user = data[str(user_id)] = {
+                    "user_id": user_id,
+                    "username": username,
+                    "assets": {},
+                    "created_at": created_at,
+                    "updated_at": updated_at
+                }
+            if symbol is not None:
+                user["assets"][symbol] = {
+                    "symbol": symbol,
+                    "amount": amount,
+                    "added_at": added_at,
+                    "updated_at": asset_updated_at
+                }
+
+        return data
+
+    def _reload(self):
+        """Перечитывает данные из базы после отката изменений"""
+        self.data = self._read_data()
+        self._total_assets = self._count_assets()
+
+    def _import_json(self) -> Dict[str, Any]:
+        """Переносит данные из прежнего JSON файла (рядом с базой), если он есть"""
+        json_file = self._legacy_file
+        if not json_file.exists():
+            return {}
+
         try:
-            # Создаем временный файл для безопасной записи
-            temp_file = self.data_file.with_suffix('.tmp')
+            data = orjson.loads(json_file.read_bytes())
+        except (OSError, orjson.JSONDecodeError) as e:
+            logger.error(f"Failed to import legacy data from {json_file}: {e}")
+            return {}
 
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=2, ensure_ascii=False)
+        self.data = data
+        if self._save_data():
+            logger.info(f"Imported {len(data)} users from {json_file}")
+        return data
 
-            # Заменяем старый файл новым
-            if self.data_file.exists():
-                temp_file.replace(self.data_file)
-            else:
-                temp_file.rename(self.data_file)
+    def _count_assets(self) -> int:
+        """Пересчитывает число активов по данным в памяти"""
+        return sum(len(user_data.get("assets", {})) for user_data in self.data.values())
 
+    def _save_data(self) -> bool:
+        """
+        Полностью синхронизирует базу с данными в памяти.
+        Обычные изменения пишут только свои строки; полная запись нужна,
+        если данные портфеля изменяли напрямую
+        """
+        try:
+            with self._statement_group():
+                self._conn.execute("DELETE FROM assets")
+                self._conn.execute("DELETE FROM users")
+                self._conn.executemany(_UPSERT_USER, (
+                    (user_data.get("user_id", int(user_key)), user_data.get("username"),
+                     user_data.get("created_at"), user_data.get("updated_at"))
+                    for user_key, user_data in self.data.items()
+                ))
+                self._conn.executemany(_UPSERT_ASSET, (
+                    (user_data.get("user_id", int(user_key)), symbol, asset.get("amount", 0),
+                     asset.get("added_at"), asset.get("updated_at"))
+                    for user_key, user_data in self.data.items()
+                    for symbol, asset in user_data.get("assets", {}).items()
+                ))
+
+            # Данные могли изменить напрямую - счетчик пересчитывается
+            self._total_assets = self._count_assets()
             logger.debug(f"Saved {len(self.data)} users to {self.data_file}")
             return True
 
@@ -79,10 +205,92 @@ class SimplePortfolioRepository:
             logger.error(f"Failed to save data to {self.data_file}: {e}")
             return False
 
+    @contextmanager
+    def _statement_group(self):
+        """
+        Атомарная группа запросов: вне transaction() - своя транзакция,
+        внутри - точка сохранения, к которой группа откатывается при ошибке
+        """
+        if self._tx_depth == 0:
+            with self._conn:
+                yield
+            return
+
+        self._conn.execute("SAVEPOINT portfolio_write")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK TO portfolio_write")
+            self._conn.execute("RELEASE portfolio_write")
+            raise
+        self._conn.execute("RELEASE portfolio_write")
+
+    def _execute(self, *statements: Tuple[str, tuple]) -> bool:
+        """
+        Выполняет запросы атомарно. При ошибке запись откатывается,
+        а данные в памяти перечитываются из базы
+        """
+        try:
+            with self._statement_group():
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write to {self.data_file}: {e}")
+            self._reload()
+            return False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Выполняет изменения блока одной транзакцией: одна запись на диск при выходе.
+        Если блок завершился исключением, его изменения откатываются
+        (и в базе, и в памяти), а исключение пробрасывается дальше.
+        Вложенные блоки откатываются независимо через точки сохранения.
+        Если не удалась фиксация, изменения тоже откатываются, а ошибка sqlite3
+        пробрасывается, чтобы вызывающий код не сообщил об успешной записи
+        """
+        savepoint = None
+        if self._tx_depth == 0:
+            self._conn.execute("BEGIN")
+        else:
+            savepoint = f"portfolio_tx_{self._tx_depth}"
+            self._conn.execute(f"SAVEPOINT {savepoint}")
+
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if savepoint is None:
+                self._conn.rollback()
+            else:
+                self._conn.execute(f"ROLLBACK TO {savepoint}")
+                self._conn.execute(f"RELEASE {savepoint}")
+            self._reload()
+            raise
+
+        self._tx_depth -= 1
+        if savepoint is not None:
+            self._conn.execute(f"RELEASE {savepoint}")
+            return
+
+        try:
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to commit to {self.data_file}: {e}")
+            self._conn.rollback()
+            self._reload()
+            raise
+
     def save(self) -> bool:
         """Публичный метод для сохранения данных"""
         return self._save_data()
 
+    def close(self):
+        """Закрывает соединение с базой"""
+        self._conn.close()
+
     def get_or_create_user(self, user_id: int, username: Optional[str] = None) -> Dict[str, Any]:
         """
         Получает или создает пользователя.
@@ -99,14 +307,16 @@ class SimplePortfolioRepository:
                 "created_at": now,
                 "updated_at": now
             }
-            self._save_data()
+            self._execute((_UPSERT_USER, (user_id, username, now, now)))
             logger.info(f"Created new user: {user_id} ({username})")
         else:
             # Обновляем username если изменился
             if username and self.data[user_key].get("username") != username:
+                now = datetime.now().isoformat()
                 self.data[user_key]["username"] = username
-                self.data[user_key]["updated_at"] = datetime.now().isoformat()
-                self._save_data()
+                self.data[user_key]["updated_at"] = now
+                self._execute(("UPDATE users SET username = ?, updated_at = ? WHERE user_id = ?",
+                               (username, now, user_id)))
                 logger.debug(f"Updated username for user {user_id}: {username}")
 
         return self.data[user_key]
@@ -144,14 +354,19 @@ class SimplePortfolioRepository:
                     "added_at": now,
                     "updated_at": now
                 }
+                self._total_assets += 1
                 logger.debug(f"Created new asset {symbol}: {amount}")
 
             # Обновляем данные пользователя
             self.data[user_key]["assets"] = assets
             self.data[user_key]["updated_at"] = now
 
-            # Сохраняем
-            success = self._save_data()
+            # Сохраняем только измененные строки
+            asset = assets[symbol]
+            success = self._execute(
+                (_UPSERT_ASSET, (user_id, symbol, asset["amount"], asset["added_at"], now)),
+                (_TOUCH_USER, (now, user_id)),
+            )
 
             if success:
                 logger.info(f"Successfully added {amount} {symbol.upper()} to user {user_id}")
@@ -216,25 +431,31 @@ class SimplePortfolioRepository:
             if amount is None:
                 # Удаляем полностью
                 del assets[symbol]
+                self._total_assets -= 1
                 message = f"Весь {symbol.upper()} удален"
+                statement = ("DELETE FROM assets WHERE user_id = ? AND symbol = ?", (user_id, symbol))
             elif amount > current_amount:
                 return False, f"Недостаточно {symbol.upper()}. Доступно: {current_amount}"
             elif amount == current_amount:
                 # Удаляем полностью, если количество совпадает
                 del assets[symbol]
+                self._total_assets -= 1
                 message = f"Весь {symbol.upper()} удален"
+                statement = ("DELETE FROM assets WHERE user_id = ? AND symbol = ?", (user_id, symbol))
             else:
                 # Уменьшаем количество
                 assets[symbol]["amount"] = current_amount - amount
                 assets[symbol]["updated_at"] = now
                 message = f"Удалено {amount} {symbol.upper()}"
+                statement = ("UPDATE assets SET amount = ?, updated_at = ? WHERE user_id = ? AND symbol = ?",
+                             (current_amount - amount, now, user_id, symbol))
 
             # Обновляем данные
             self.data[user_key]["assets"] = assets
             self.data[user_key]["updated_at"] = now
 
             # Сохраняем
-            success = self._save_data()
+            success = self._execute(statement, (_TOUCH_USER, (now, user_id)))
 
             if success:
                 logger.info(f"Successfully removed asset {symbol} from user {user_id}")
@@ -260,11 +481,16 @@ class SimplePortfolioRepository:
                 return False, "Портфель уже пуст"
 
             # Очищаем активы
+            now = datetime.now().isoformat()
             self.data[user_key]["assets"] = {}
-            self.data[user_key]["updated_at"] = datetime.now().isoformat()
+            self.data[user_key]["updated_at"] = now
+            self._total_assets -= assets_count
 
             # Сохраняем
-            success = self._save_data()
+            success = self._execute(
+                ("DELETE FROM assets WHERE user_id = ?", (user_id,)),
+                (_TOUCH_USER, (now, user_id)),
+            )
 
             if success:
                 logger.info(f"Cleared portfolio for user {user_id} ({assets_count} assets)")
@@ -280,22 +506,17 @@ class SimplePortfolioRepository:
         """Проверяет здоровье репозитория"""
         try:
             file_exists = self.data_file.exists()
+            journal_mode = self._conn.execute("PRAGMA journal_mode").fetchone()[0]
             file_size = self.data_file.stat().st_size if file_exists else 0
 
-            # Статистика пользователей
-            total_users = len(self.data)
-            total_assets = 0
-
-            for user_data in self.data.values():
-                total_assets += len(user_data.get("assets", {}))
-
             return {
                 "status": "healthy",
                 "data_file": str(self.data_file),
                 "file_exists": file_exists,
                 "file_size": file_size,
-                "total_users": total_users,
-                "total_assets": total_assets,
+                "journal_mode": journal_mode,
+                "total_users": len(self.data),
+                "total_assets": self._total_assets,
                 "initialized": True
             }
         except Exception as e:
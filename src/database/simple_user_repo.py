@@ -6,17 +6,45 @@
 import json
 import os
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional, List
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, List, Set
 from pathlib import Path
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
 
 class SimpleUserRepository:
     """Простой репозиторий для работы с пользователями"""
 
-    def __init__(self, data_file: str = None):
+    # Настройки нового пользователя (копируются, не изменяются)
+    _DEFAULT_SETTINGS = {
+        "notifications": True,
+        "currency": "USD",
+        "language": "ru",
+        "daily_report": False,
+        "price_alerts": False,
+        "theme": "default"
+    }
+
+    # Шаблон записи пользователя
+    _USER_TEMPLATE = {
+        "user_id": None,
+        "username": None,
+        "first_name": None,
+        "last_name": None,
+        "language_code": None,
+        "is_premium": False,
+        "created_at": None,
+        "last_seen": None,
+        "settings": None,
+        "activity_count": 0
+    }
+
+    def __init__(self, data_file: str = None, durable: bool = False):
         # Определяем путь к файлу данных
         if data_file is None:
             # Путь относительно корня проекта
@@ -28,20 +56,34 @@ class SimpleUserRepository:
         # Создаем директорию если нужно
         self.data_file.parent.mkdir(parents=True, exist_ok=True)
 
+        # Надежная запись (fsync + атомарная замена) нужна не всегда:
+        # активность пользователей восстанавливается, поэтому по умолчанию пишем быстро
+        self.durable = durable
+
+        # Отложенное сохранение внутри transaction()
+        self._tx_depth = 0
+        self._dirty = False
+
         # Загружаем данные
-        self.data: Dict[str, Any] = self._load_data()
+        self.data: Dict[int, Any] = self._load_data()
+
+        # Индекс активности: день (YYYY-MM-DD) -> пользователи, последний раз активные в этот день
+        self._active_by_day: Dict[str, Set[int]] = defaultdict(set)
+        self._user_day: Dict[int, str] = {}
+        self._rebuild_activity_index()
 
         logger.info(f"SimpleUserRepository initialized with {self.data_file}")
         logger.info(f"Loaded {len(self.data)} users")
 
-    def _load_data(self) -> Dict[str, Any]:
+    def _load_data(self) -> Dict[int, Any]:
         """Загружает данные из JSON файла"""
         try:
             if self.data_file.exists():
                 with open(self.data_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                 logger.info(f"Loaded user data from {self.data_file}")
-                return data
+                # JSON хранит ключи строками, в памяти держим int user_id
+                return {int(k): v for k, v in data.items()}
             else:
                 logger.info(f"User data file {self.data_file} does not exist, starting fresh")
                 return {}
@@ -59,19 +101,26 @@ class SimpleUserRepository:
             return {}
 
     def _save_data(self) -> bool:
-        """Сохраняет данные в JSON файл"""
-        try:
-            # Создаем временный файл для безопасной записи
-            temp_file = self.data_file.with_suffix('.tmp')
+        """Сохраняет данные (внутри транзакции только помечает их измененными)"""
+        if self._tx_depth > 0:
+            self._dirty = True
+            return True
 
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=2, ensure_ascii=False)
+        return self._write_data()
 
-            # Заменяем старый файл новым
-            if self.data_file.exists():
-                temp_file.replace(self.data_file)
+    def _write_data(self) -> bool:
+        """Записывает данные в JSON файл"""
+        try:
+            payload = orjson.dumps(
+                self.data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+            )
+
+            if self.durable:
+                self._write_durable(payload)
             else:
-                temp_file.rename(self.data_file)
+                # Быстрый путь: пишем прямо в файл, без временного файла и rename
+                with open(self.data_file, 'wb') as f:
+                    f.write(payload)
 
             logger.debug(f"Saved {len(self.data)} users to {self.data_file}")
             return True
@@ -80,15 +129,104 @@ class SimpleUserRepository:
             logger.error(f"Failed to save user data to {self.data_file}: {e}")
             return False
 
+    def _write_durable(self, payload: bytes):
+        """Атомарно записывает данные с fsync файла и директории"""
+        temp_file = self.data_file.with_suffix('.tmp')
+
+        with open(temp_file, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Заменяем старый файл новым и фиксируем запись в директории
+        os.replace(temp_file, self.data_file)
+        dir_fd = os.open(self.data_file.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _rebuild_activity_index(self):
+        """Строит индекс активности по загруженным данным"""
+        self._active_by_day.clear()
+        self._user_day.clear()
+
+        for user_id, user_data in self.data.items():
+            last_seen = user_data.get("last_seen")
+            if last_seen:
+                self._touch_activity_index(user_id, last_seen)
+
+    def _touch_activity_index(self, user_id: int, last_seen: str):
+        """Переносит пользователя в корзину дня его последней активности"""
+        day = last_seen[:10]  # YYYY-MM-DD
+        previous_day = self._user_day.get(user_id)
+
+        if previous_day == day:
+            return
+
+        if previous_day is not None:
+            bucket = self._active_by_day[previous_day]
+            bucket.discard(user_id)
+            if not bucket:
+                del self._active_by_day[previous_day]
+
+        self._active_by_day[day].add(user_id)
+        self._user_day[user_id] = day
+
+    def _count_active_users(self, days: int) -> int:
+        """
+        Считает пользователей, активных за последние N дней.
+        Более поздние дни считаются целиком, а в корзине дня границы
+        last_seen сравнивается с отсечкой с точностью до времени
+        """
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        cutoff_day = cutoff[:10]
+
+        count = 0
+        for day, users in self._active_by_day.items():
+            if day > cutoff_day:
+                count += len(users)
+            elif day == cutoff_day:
+                count += sum(1 for user_id in users if self.data[user_id]["last_seen"] >= cutoff)
+        return count
+
+    def _reload(self):
+        """Перечитывает данные из файла после отката изменений"""
+        self.data = self._load_data()
+        self._rebuild_activity_index()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Откладывает все сохранения до выхода из блока.
+        Несколько изменений в рамках одного апдейта дают одну запись на диск.
+        Если блок завершился исключением, ничего не записывается, данные в памяти
+        перечитываются из файла, а исключение пробрасывается дальше.
+        Вложенный блок откатывается вместе с внешним
+        """
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self._dirty = False
+                self._reload()
+            raise
+
+        self._tx_depth -= 1
+        if self._tx_depth == 0 and self._dirty:
+            self._dirty = False
+            self._write_data()
+
     def get_or_create_user(self, user_id: int, username: Optional[str] = None,
                            first_name: Optional[str] = None, last_name: Optional[str] = None,
                            language_code: Optional[str] = None, is_premium: bool = False) -> Dict[str, Any]:
         """Получает или создает пользователя"""
-        user_key = str(user_id)
-
-        if user_key not in self.data:
+        if user_id not in self.data:
             now = datetime.now().isoformat()
-            self.data[user_key] = {
+            self.data[user_id] = {
+                **self._USER_TEMPLATE,
                 "user_id": user_id,
                 "username": username,
                 "first_name": first_name,
@@ -97,22 +235,15 @@ class SimpleUserRepository:
                 "is_premium": is_premium,
                 "created_at": now,
                 "last_seen": now,
-                "settings": {
-                    "notifications": True,
-                    "currency": "USD",
-                    "language": language_code or "ru",
-                    "daily_report": False,
-                    "price_alerts": False,
-                    "theme": "default"
-                },
-                "activity_count": 0
+                "settings": dict(self._DEFAULT_SETTINGS, language=language_code or "ru")
             }
+            self._touch_activity_index(user_id, now)
             self._save_data()
             logger.info(f"Created new user: {user_id} ({username})")
         else:
             # Обновляем информацию если изменилась
             updated = False
-            user_data = self.data[user_key]
+            user_data = self.data[user_id]
 
             if username and user_data.get("username") != username:
                 user_data["username"] = username
@@ -134,23 +265,23 @@ class SimpleUserRepository:
                 self._save_data()
                 logger.debug(f"Updated user info for {user_id}")
 
-        return self.data[user_key]
+        return self.data[user_id]
 
     def record_user_activity(self, user_id: int, activity: str):
         """Записывает активность пользователя"""
         try:
-            user_key = str(user_id)
-
             # Убедимся, что пользователь существует
-            if user_key not in self.data:
+            if user_id not in self.data:
                 # Создаем пользователя с минимальной информацией
                 self.get_or_create_user(user_id)
 
             # Обновляем last_seen
-            self.data[user_key]["last_seen"] = datetime.now().isoformat()
+            now = datetime.now().isoformat()
+            self.data[user_id]["last_seen"] = now
+            self._touch_activity_index(user_id, now)
 
             # Увеличиваем счетчик активности
-            self.data[user_key]["activity_count"] = self.data[user_key].get("activity_count", 0) + 1
+            self.data[user_id]["activity_count"] = self.data[user_id].get("activity_count", 0) + 1
 
             # Сохраняем
             self._save_data()
@@ -162,33 +293,22 @@ class SimpleUserRepository:
 
     def get_user_settings(self, user_id: int) -> Dict[str, Any]:
         """Получает настройки пользователя"""
-        user_key = str(user_id)
-
-        if user_key not in self.data:
+        if user_id not in self.data:
             # Возвращаем настройки по умолчанию
-            return {
-                "notifications": True,
-                "currency": "USD",
-                "language": "ru",
-                "daily_report": False,
-                "price_alerts": False,
-                "theme": "default"
-            }
+            return dict(self._DEFAULT_SETTINGS)
 
-        return self.data[user_key].get("settings", {})
+        return self.data[user_id].get("settings", {})
 
     def update_user_settings(self, user_id: int, settings: Dict[str, Any]) -> bool:
         """Обновляет настройки пользователя"""
         try:
-            user_key = str(user_id)
-
-            if user_key not in self.data:
+            if user_id not in self.data:
                 return False
 
             # Обновляем настройки
-            current_settings = self.data[user_key].get("settings", {})
+            current_settings = self.data[user_id].get("settings", {})
             current_settings.update(settings)
-            self.data[user_key]["settings"] = current_settings
+            self.data[user_id]["settings"] = current_settings
 
             # Сохраняем
             success = self._save_data()
@@ -217,13 +337,11 @@ class SimpleUserRepository:
                     "registration_trend": []
                 }
 
-            # Считаем активных пользователей (последние 30 дней)
-            active_users = 0
+            # Считаем активных пользователей (последние 30 дней) по индексу
+            active_users = self._count_active_users(30)
             premium_users = 0
             languages = {}
 
-            cutoff_date = datetime.now() - datetime.timedelta(days=30)
-
             for user_data in self.data.values():
                 # Premium пользователи
                 if user_data.get("is_premium", False):
@@ -233,14 +351,6 @@ class SimpleUserRepository:
                 lang = user_data.get("language_code", "unknown")
                 languages[lang] = languages.get(lang, 0) + 1
 
-                # Активные пользователи
-                try:
-                    last_seen = datetime.fromisoformat(user_data.get("last_seen", ""))
-                    if last_seen >= cutoff_date:
-                        active_users += 1
-                except:
-                    pass
-
             # Тренд регистраций (по месяцам)
             registration_trend = {}
             for user_data in self.data.values():
@@ -279,16 +389,7 @@ class SimpleUserRepository:
             file_size = self.data_file.stat().st_size if file_exists else 0
 
             # Активные пользователи (последние 7 дней)
-            active_users = 0
-            cutoff_date = datetime.now() - datetime.timedelta(days=7)
-
-            for user_data in self.data.values():
-                try:
-                    last_seen = datetime.fromisoformat(user_data.get("last_seen", ""))
-                    if last_seen >= cutoff_date:
-                        active_users += 1
-                except:
-                    pass
+            active_users = self._count_active_users(7)
 
             return {
                 "status": "healthy",
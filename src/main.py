@@ -10,6 +10,7 @@ from telegram.ext import Application
 from src.config.settings import settings
 from src.bot.handlers import setup_handlers
 from src.assets.registry import asset_registry
+from src.services._http import close_shared_session
 
 
 def setup_directories():
@@ -80,6 +81,9 @@ async def on_shutdown(application: Application):
     # Закрываем ресурсы активов
     await asset_registry.close_all()
 
+    # Закрываем общий HTTP-пул сервисов ЦБ РФ
+    await close_shared_session()
+
     logger.info("Bot stopped")
 
 
@@ -0,0 +1,107 @@
+# src/services/_cache.py
+"""
+Ограниченный LRU-кэш с временем жизни записей для сервисов.
+"""
+
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Tuple
+
+
+class TTLCache:
+    """
+    LRU-кэш ограниченного размера, записи которого устаревают через ttl секунд.
+    Срок жизни хранится как дедлайн по time.monotonic(), поэтому переводы
+    системных часов не влияют на кэш
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 512, ttl: float = 3600, jitter: float = 0.0,
+                 stale_ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Разброс срока жизни (0.2 = ±20%), чтобы записи одной загрузки не устаревали разом
+        self.jitter = jitter
+        # Сколько секунд после устаревания запись еще доступна через get_stale()
+        self.stale_ttl = stale_ttl
+        self._data: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        # Счетчики обращений: свежие попадания, промахи (включая устаревшие) и вытеснения
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение, если оно есть и не устарело"""
+        value, fresh = self.get_stale(key, default)
+        return value if fresh else default
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Tuple[Any, bool]:
+        """
+        Возвращает (значение, свежее ли оно).
+        Устаревшее значение возвращается, пока не прошло stale_ttl секунд после дедлайна
+        """
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default, False
+
+        value, deadline = item
+        now = time.monotonic()
+        if now >= deadline + self.stale_ttl:
+            del self._data[key]
+            self.misses += 1
+            return default, False
+
+        self._data.move_to_end(key)
+        fresh = now < deadline
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value, fresh
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        ttl = self.ttl
+        if self.jitter:
+            ttl *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+
+        # Вытесняем самые давно использованные записи
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Удаляет запись и возвращает ее значение"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        """Очищает кэш (счетчики обращений сохраняются)"""
+        self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """Статистика обращений к кэшу"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,61 @@
+# src/services/_http.py
+"""
+Общий HTTP-пул для сервисов ЦБ РФ и биржевых активов.
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+_READ_BUFSIZE = 2 ** 18
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def get_shared_session() -> aiohttp.ClientSession:
+    """Создает или возвращает общую сессию для текущего event loop"""
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=16,
+            ttl_dns_cache=300,
+            keepalive_timeout=75
+        )
+        # Буфер чтения 256 КБ вместо 64 КБ: ответы MOEX ISS и ЦБ читаются меньшим числом порций
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10, connect=3),
+            connector=connector,
+            read_bufsize=_READ_BUFSIZE
+        )
+        _session_loop = loop
+        logger.debug("Created shared HTTP session")
+
+    return _session
+
+
+async def close_shared_session():
+    """Закрывает общую сессию (вызывается при остановке бота)"""
+    global _session, _session_loop
+
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
+
+
+def conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> Dict[str, str]:
+    """Заголовки условного запроса по сохраненным ETag / Last-Modified"""
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
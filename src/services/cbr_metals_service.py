@@ -1,14 +1,41 @@
 # src/services/cbr_metals_service.py
+import asyncio
+import bisect
 import logging
+from array import array
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, Tuple
 import aiohttp
 from dataclasses import dataclass
+from functools import lru_cache
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+from src.services._cache import TTLCache
+from src.services._http import conditional_headers, get_shared_session
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@lru_cache(maxsize=4096)
+def _parse_cbr_date(date_str: str) -> datetime:
+    """Разбирает дату ЦБ РФ формата ДД.ММ.ГГГГ (быстрее strptime)"""
+    if len(date_str) != 10 or date_str[2] != '.' or date_str[5] != '.':
+        raise ValueError(f"time data {date_str!r} does not match format '%d.%m.%Y'")
+    return datetime(int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2]))
+
+
+# Готовый форматтер цен (связанный str.format без разбора f-строки)
+_PRICE_FMT = "{:,.2f}".format
+
+# Поля цен MetalPrice (допустимые значения metal_type)
+_METAL_FIELDS = frozenset(("gold", "silver", "platinum", "palladium"))
+
+
+@dataclass(slots=True, frozen=True)
 class MetalPrice:
     """Класс для хранения цен на драгоценные металлы"""
     date: datetime
@@ -29,18 +56,11 @@ class MetalPrice:
 
     def format_price(self, metal_type: str) -> str:
         """Форматирует цену для вывода"""
-        prices = {
-            "gold": self.gold,
-            "silver": self.silver,
-            "platinum": self.platinum,
-            "palladium": self.palladium
-        }
-
-        if metal_type not in prices:
+        if metal_type not in _METAL_FIELDS:
             raise ValueError(f"Unknown metal type: {metal_type}")
 
-        price = prices[metal_type]
-        return f"{price:,.2f}".replace(',', ' ')
+        # Поля хранятся в слотах: getattr читает их без промежуточного словаря
+        return _PRICE_FMT(getattr(self, metal_type)).replace(',', ' ')
 
 
 class MetalService:
@@ -48,6 +68,22 @@ class MetalService:
 
     CBR_METAL_URL = "https://cbr.ru/hd_base/metall/metall_base_new/"
 
+    MAX_CONCURRENT_REQUESTS = 8
+
+    # Нижняя граница ряда цен ЦБ РФ: за более ранние даты данных нет,
+    # такие запросы отклоняются без загрузки страницы
+    MIN_DATE = datetime(2003, 1, 1)
+
+    REQUEST_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
+
+    # Таблица очистки чисел: "12 345,67" -> "12345.67" (включая неразрывные пробелы)
+    _NUM_TRANS = str.maketrans({' ': '', '\xa0': '', ',': '.'})
+
+    # Ключ кэша для самой свежей записи (быстрый путь get_latest_metal_price)
+    _LATEST_PRICE_KEY = "latest_price"
+
     # Коды металлов
     METAL_TYPES = {
         "gold": "Золото",
@@ -56,38 +92,68 @@ class MetalService:
         "palladium": "Палладий"
     }
 
-    def __init__(self):
-        self.session: Optional[aiohttp.ClientSession] = None
-        self.cache: Dict[str, List[MetalPrice]] = {}
-        self.cache_time: Dict[str, datetime] = {}
+    # Коды металлов в порядке METAL_TYPES (словарь не меняется, список строится один раз)
+    _METAL_CODES = tuple(METAL_TYPES)
+
+    def __init__(self, session: Optional[aiohttp.ClientSession] = None):
+        # Собственная сессия не создается: используется переданная или общий пул.
+        # Переданной сессией владеет вызывающий код, close() ее не закрывает
+        self.session: Optional[aiohttp.ClientSession] = session
+        self._session_injected = session is not None
         self.cache_ttl = 1800  # 30 минут в секундах (цены обновляются реже чем валюты)
+        self.cache = TTLCache(maxsize=16, ttl=self.cache_ttl)
+        # Незавершенные запросы по ключу кэша (single-flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Не более MAX_CONCURRENT_REQUESTS одновременных запросов к ЦБ РФ
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        # ETag, Last-Modified и разобранные цены последнего ответа
+        self._validators: Optional[Tuple[Optional[str], Optional[str], List[MetalPrice]]] = None
+        # Столбцовое представление последнего загруженного списка цен
+        self._columns: Dict[str, Any] = {}
+        self._columns_source: Optional[List[MetalPrice]] = None
+        # Отформатированные цены для последней записи: (запись, словарь)
+        self._formatted_cache: Optional[Tuple[MetalPrice, Dict[str, Any]]] = None
 
     async def _get_session(self) -> aiohttp.ClientSession:
-        """Создает или возвращает сессию"""
-        if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=10)
-            connector = aiohttp.TCPConnector(ssl=False)  # На случай проблем с SSL
-            self.session = aiohttp.ClientSession(
-                timeout=timeout,
-                connector=connector,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                }
-            )
-        return self.session
+        """Возвращает собственную сессию, если задана, иначе общий пул"""
+        if self.session is not None and not self.session.closed:
+            return self.session
+        return await get_shared_session()
 
     async def _fetch_metal_prices(self) -> List[MetalPrice]:
         """Загружает и парсит данные с сайта ЦБ РФ"""
         try:
             session = await self._get_session()
 
-            async with session.get(self.CBR_METAL_URL) as response:
+            # Условный запрос: если страница не изменилась, ЦБ вернет 304 без тела
+            headers = dict(self.REQUEST_HEADERS)
+            if self._validators is not None:
+                etag, last_modified, _ = self._validators
+                headers.update(conditional_headers(etag, last_modified))
+
+            # ssl=False - на случай проблем с SSL на cbr.ru
+            async with self._semaphore, session.get(
+                    self.CBR_METAL_URL, headers=headers, ssl=False) as response:
+                if response.status == 304 and self._validators is not None:
+                    logger.debug("Metal prices not modified")
+                    return self._validators[2]
+
                 if response.status != 200:
                     logger.error(f"Failed to fetch metal prices: HTTP {response.status}")
                     return []
 
                 html_content = await response.text()
-                return self._parse_metal_prices(html_content)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+            # Разбор HTML - CPU-работа, выносим из event loop
+            loop = asyncio.get_running_loop()
+            prices = await loop.run_in_executor(None, self._parse_metal_prices, html_content)
+
+            if prices and (etag or last_modified):
+                self._validators = (etag, last_modified, prices)
+
+            return prices
 
         except aiohttp.ClientError as e:
             logger.error(f"Network error fetching metal prices: {e}")
@@ -98,38 +164,41 @@ class MetalService:
 
     def _parse_metal_prices(self, html_content: str) -> List[MetalPrice]:
         """Парсит HTML с ценами на металлы"""
-        try:
-            from bs4 import BeautifulSoup
+        if lxml_html is None:
+            logger.error("lxml is required. Install it with: pip install lxml")
+            return []
 
-            soup = BeautifulSoup(html_content, 'html.parser')
-            table = soup.find('table')
+        try:
+            doc = lxml_html.fromstring(html_content)
+            tables = doc.xpath('(//table)[1]')
 
-            if not table:
+            if not tables:
                 logger.error("Metal price table not found")
                 return []
 
-            # Находим все строки таблицы
-            rows = table.find_all('tr')
+            # Только строки самой таблицы (без вложенных таблиц); текст ячейки
+            # берется целиком, включая вложенную разметку (<span>, <b>, <br>)
+            rows = tables[0].xpath('./tr | ./thead/tr | ./tbody/tr')
             prices = []
 
             # Пропускаем заголовок таблицы (первая строка)
             for row in rows[1:]:
-                cols = row.find_all('td')
+                cols = [td.text_content() for td in row.iterchildren('td')]
 
                 # Проверяем, что строка содержит все 5 колонок (дата + 4 металла)
                 if len(cols) >= 5:
                     try:
                         # Извлекаем и очищаем данные
-                        date_str = cols[0].text.strip()
+                        date_str = cols[0].strip()
 
                         # Преобразуем дату
-                        date = datetime.strptime(date_str, '%d.%m.%Y')
+                        date = _parse_cbr_date(date_str)
 
                         # Извлекаем и преобразуем цены
-                        gold = float(cols[1].text.strip().replace(' ', '').replace(',', '.'))
-                        silver = float(cols[2].text.strip().replace(' ', '').replace(',', '.'))
-                        platinum = float(cols[3].text.strip().replace(' ', '').replace(',', '.'))
-                        palladium = float(cols[4].text.strip().replace(' ', '').replace(',', '.'))
+                        gold = float(cols[1].translate(self._NUM_TRANS))
+                        silver = float(cols[2].translate(self._NUM_TRANS))
+                        platinum = float(cols[3].translate(self._NUM_TRANS))
+                        palladium = float(cols[4].translate(self._NUM_TRANS))
 
                         # Создаем объект MetalPrice
                         metal_price = MetalPrice(
@@ -155,13 +224,25 @@ class MetalService:
             logger.info(f"Successfully parsed {len(prices)} metal price records")
             return prices
 
-        except ImportError:
-            logger.error("BeautifulSoup4 is required. Install it with: pip install beautifulsoup4")
-            return []
         except Exception as e:
             logger.error(f"Error parsing metal prices: {e}")
             return []
 
+    def _get_columns(self, prices: List[MetalPrice]) -> Dict[str, Any]:
+        """
+        Возвращает цены в виде столбцов (даты и массивы цен по металлам).
+        Столбцы строятся один раз на каждый загруженный список цен
+        """
+        if self._columns_source is not prices:
+            columns: Dict[str, Any] = {"dates": [p.date for p in prices]}
+            for metal_type in self.METAL_TYPES:
+                columns[metal_type] = array('d', [getattr(p, metal_type) for p in prices])
+
+            self._columns = columns
+            self._columns_source = prices
+
+        return self._columns
+
     async def get_latest_prices(self, force_refresh: bool = False) -> List[MetalPrice]:
         """
         Получает последние доступные цены на металлы
@@ -169,25 +250,44 @@ class MetalService:
         :return: Список цен на металлы
         """
         cache_key = "latest"
-        current_time = datetime.now()
 
         # Проверяем кэш, если не требуется принудительное обновление
         if not force_refresh:
-            if (cache_key in self.cache and
-                    cache_key in self.cache_time and
-                    (current_time - self.cache_time[cache_key]).seconds < self.cache_ttl):
+            cached_prices = self.cache.get(cache_key)
+            if cached_prices is not None:
                 logger.debug("Using cached metal prices")
-                return self.cache[cache_key]
+                return cached_prices
 
-        # Загружаем свежие данные
-        prices = await self._fetch_metal_prices()
+        # Такой же запрос уже выполняется - ждем его результат вместо нового запроса
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            logger.debug("Waiting for in-flight metal prices request")
+            return await asyncio.shield(inflight)
 
-        if prices:
-            # Сохраняем в кэш
-            self.cache[cache_key] = prices
-            self.cache_time[cache_key] = current_time
-
-        return prices
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        try:
+            # Загружаем свежие данные
+            prices = await self._fetch_metal_prices()
+
+            if prices:
+                # Сохраняем в кэш вместе с самой свежей записью
+                self.cache[cache_key] = prices
+                self.cache[self._LATEST_PRICE_KEY] = prices[0]
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            # Ожидающие запросы получают ту же ошибку, что и первый
+            future.set_exception(e)
+            # Ошибка уже пробрасывается ниже - без ожидающих она не должна попасть в лог asyncio
+            future.exception()
+            raise
+        else:
+            future.set_result(prices)
+            return prices
+        finally:
+            self._inflight.pop(cache_key, None)
 
     async def get_latest_metal_price(self, metal_type: str = "gold") -> Optional[MetalPrice]:
         """
@@ -199,6 +299,11 @@ class MetalService:
             logger.error(f"Unknown metal type: {metal_type}")
             return None
 
+        # Быстрый путь: самая свежая запись хранится в кэше отдельно
+        latest = self.cache.get(self._LATEST_PRICE_KEY)
+        if latest is not None:
+            return latest
+
         prices = await self.get_latest_prices()
 
         if not prices:
@@ -213,6 +318,10 @@ class MetalService:
         :param date: Дата для поиска
         :return: Объект MetalPrice или None
         """
+        if date < self.MIN_DATE:
+            logger.warning(f"Metal prices are not available before {self.MIN_DATE.strftime('%d.%m.%Y')}")
+            return None
+
         try:
             # Получаем все доступные цены
             prices = await self.get_latest_prices()
@@ -269,11 +378,12 @@ class MetalService:
         if not prices:
             return []
 
-        # Фильтруем цены за последние N дней
+        # Цены отсортированы от новых к старым: граница находится бинарным поиском
         cutoff_date = datetime.now() - timedelta(days=days)
-        recent_prices = [p for p in prices if p.date >= cutoff_date]
+        dates = self._get_columns(prices)["dates"]
+        end = bisect.bisect_left(dates, True, key=lambda d: d < cutoff_date)
 
-        return recent_prices
+        return prices[:end]
 
     async def get_metal_price_change(self, metal_type: str, days: int = 1) -> Optional[float]:
         """
@@ -283,29 +393,26 @@ class MetalService:
         :return: Изменение в процентах или None
         """
         try:
-            prices = await self.get_latest_prices()
-
-            if len(prices) < days + 1:
-                logger.warning(f"Not enough data to calculate {days}-day change")
+            metal = metal_type.lower()
+            if metal not in self.METAL_TYPES:
                 return None
 
-            # Берем текущую цену и цену N дней назад
-            current_price_obj = prices[0]
-            historical_price_obj = prices[days]
+            prices = await self.get_latest_prices()
 
-            # Получаем цены для конкретного металла
-            if metal_type.lower() not in self.METAL_TYPES:
+            # Берем столбец цен металла: текущая цена и цена N дней назад
+            column = self._get_columns(prices)[metal]
+            if len(column) < days + 1:
+                logger.warning(f"Not enough data to calculate {days}-day change")
                 return None
 
-            current_price = getattr(current_price_obj, metal_type.lower())
-            historical_price = getattr(historical_price_obj, metal_type.lower())
+            current_price = column[0]
+            historical_price = column[days]
 
             # Рассчитываем процентное изменение
             if historical_price == 0:
                 return None
 
-            change_percent = ((current_price - historical_price) / historical_price) * 100
-            return change_percent
+            return (current_price / historical_price - 1) * 100
 
         except Exception as e:
             logger.error(f"Error calculating price change: {e}")
@@ -321,7 +428,13 @@ class MetalService:
         if not latest:
             return {}
 
-        return {
+        # Цены меняются раз в день: форматируем один раз на каждую запись.
+        # Вызывающему отдается копия, чтобы его изменения не попали в кэш
+        if self._formatted_cache is not None and self._formatted_cache[0] == latest:
+            cached = self._formatted_cache[1]
+            return {**cached, "formatted": dict(cached["formatted"])}
+
+        result = {
             "date": latest.date.strftime('%d.%m.%Y'),
             "gold": latest.gold,
             "silver": latest.silver,
@@ -334,25 +447,39 @@ class MetalService:
                 "palladium": latest.format_price("palladium")
             }
         }
+        self._formatted_cache = (latest, result)
+
+        return {**result, "formatted": dict(result["formatted"])}
 
     async def get_available_metal_types(self) -> List[str]:
         """Возвращает список доступных типов металлов"""
-        return list(self.METAL_TYPES.keys())
+        return list(self._METAL_CODES)
 
     async def get_metal_name(self, metal_type: str) -> Optional[str]:
         """Возвращает русское название металла"""
-        return self.METAL_TYPES.get(metal_type.lower())
+        # Коды обычно уже в нижнем регистре: lower() только при промахе
+        name = self.METAL_TYPES.get(metal_type)
+        if name is None:
+            name = self.METAL_TYPES.get(metal_type.lower())
+        return name
 
     async def close(self):
-        """Закрывает сессию"""
+        """Закрывает собственную сессию (общий пул закрывается при остановке бота)"""
+        if self._session_injected:
+            return
         if self.session and not self.session.closed:
             await self.session.close()
             self.session = None
 
+    def cache_stats(self) -> Dict[str, float]:
+        """Статистика попаданий в кэш (hits, misses, evictions, hit_rate)"""
+        return self.cache.stats()
+
     def clear_cache(self):
         """Очищает кэш"""
         self.cache.clear()
-        self.cache_time.clear()
+        self._formatted_cache = None
+        self._validators = None
         logger.info("Metal service cache cleared")
 
 
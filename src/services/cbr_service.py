@@ -1,12 +1,68 @@
 # src/services/cbr_service.py
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+from datetime import date as date_type, datetime, timedelta
+from functools import lru_cache
+from io import BytesIO, StringIO
+from typing import Dict, Optional, List, Iterator, Tuple
 import aiohttp
-import xml.etree.ElementTree as ET
+
+from src.services._cache import TTLCache
+from src.services._http import conditional_headers, get_shared_session
+
+try:
+    from lxml import etree as ET
+    _LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _LXML = False
 
 logger = logging.getLogger(__name__)
 
+# Общие настройки парсера lxml: сущности и DTD не разворачиваются (защита от XXE),
+# сеть не используется, таблица ID не строится
+_LXML_PARSER_OPTIONS = {
+    'resolve_entities': False,
+    'load_dtd': False,
+    'no_network': True,
+    'collect_ids': False,
+    'huge_tree': False,
+}
+
+
+def _iter_xml_elements(xml_data: str, tag: str) -> Iterator:
+    """
+    Потоково перебирает элементы tag, не строя полное дерево.
+    Уже обработанные элементы освобождаются сразу после yield.
+    """
+    if _LXML:
+        # Текст уже декодирован aiohttp, поэтому кодировка из <?xml ...?> игнорируется
+        context = ET.iterparse(BytesIO(xml_data.encode('utf-8')), events=('end',), tag=tag,
+                               encoding='utf-8', **_LXML_PARSER_OPTIONS)
+    else:
+        context = (item for item in ET.iterparse(StringIO(xml_data), events=('end',))
+                   if item[1].tag == tag)
+
+    for _, elem in context:
+        yield elem
+
+        elem.clear()
+        if _LXML:
+            # Удаляем уже пройденных соседей, чтобы корень не копил пустые узлы
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+@lru_cache(maxsize=512)
+def _format_cbr_date(day: date_type) -> str:
+    """Дата в формате запросов ЦБ РФ (дд/мм/гггг); результат кэшируется по дню"""
+    return day.strftime('%d/%m/%Y')
+
+
+def _cbr_date_param(date: date_type) -> str:
+    """Параметр даты для API ЦБ РФ (время отбрасывается, чтобы кэш работал по дням)"""
+    return _format_cbr_date(date.date() if isinstance(date, datetime) else date)
+
 
 class CBRService:
     """Сервис для получения курсов валют от Центрального Банка РФ"""
@@ -28,18 +84,33 @@ class CBRService:
         "byn": "R01090B",  # Белорусский рубль
     }
 
-    def __init__(self):
-        self.session: Optional[aiohttp.ClientSession] = None
-        self.cache: Dict[str, Dict] = {}
-        self.cache_time: Dict[str, datetime] = {}
+    # Обратное соответствие: ID ЦБ РФ -> локальный код валюты
+    _CBR_ID_TO_LOCAL = {cbr_id: code for code, cbr_id in CURRENCY_CODES.items()}
+
+    MAX_CONCURRENT_REQUESTS = 8
+
+    # Таблица очистки чисел: "90,1234" -> "90.1234" (включая неразрывные пробелы)
+    _NUM_TRANS = str.maketrans({' ': '', '\xa0': '', ',': '.'})
+
+    def __init__(self, session: Optional[aiohttp.ClientSession] = None):
+        # Собственная сессия не создается: используется переданная или общий пул.
+        # Переданной сессией владеет вызывающий код, close() ее не закрывает
+        self.session: Optional[aiohttp.ClientSession] = session
+        self._session_injected = session is not None
         self.cache_ttl = 3600  # 1 час в секундах
+        self.cache = TTLCache(maxsize=512, ttl=self.cache_ttl)
+        # Незавершенные запросы по ключу кэша (single-flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Не более MAX_CONCURRENT_REQUESTS одновременных запросов к ЦБ РФ
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        # ETag, Last-Modified и XML последнего ответа с курсами на сегодня
+        self._daily_validators: Optional[Tuple[Optional[str], Optional[str], str]] = None
 
     async def _get_session(self) -> aiohttp.ClientSession:
-        """Создает или возвращает сессию"""
-        if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=10)
-            self.session = aiohttp.ClientSession(timeout=timeout)
-        return self.session
+        """Возвращает собственную сессию, если задана, иначе общий пул"""
+        if self.session is not None and not self.session.closed:
+            return self.session
+        return await get_shared_session()
 
     async def get_daily_rates(self, date: Optional[datetime] = None) -> Dict[str, float]:
         """
@@ -48,25 +119,52 @@ class CBRService:
         :return: Словарь с курсами валют {currency_code: rate}
         """
         try:
-            session = await self._get_session()
+            xml_data = await self._fetch_daily_xml(date)
+            if xml_data is None:
+                return {}
 
-            # Формируем параметры запроса
-            params = {}
-            if date:
-                params['date_req'] = date.strftime('%d/%m/%Y')
-
-            async with session.get(self.CBR_API_URL, params=params) as response:
-                if response.status == 200:
-                    xml_data = await response.text()
-                    return self._parse_daily_rates(xml_data)
-                else:
-                    logger.error(f"CBR API error: {response.status}")
-                    return {}
+            # Разбор XML - CPU-работа, выносим из event loop
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._parse_daily_rates, xml_data)
 
         except Exception as e:
             logger.error(f"Error getting CBR rates: {e}")
             return {}
 
+    async def _fetch_daily_xml(self, date: Optional[datetime] = None) -> Optional[str]:
+        """Загружает XML с ежедневными курсами (None в случае ошибки)"""
+        session = await self._get_session()
+
+        # Формируем параметры запроса
+        params = {}
+        if date:
+            params['date_req'] = _cbr_date_param(date)
+
+        # Для текущей даты отправляем условный запрос: при 304 тело не передается
+        headers = {}
+        if not date and self._daily_validators is not None:
+            etag, last_modified, _ = self._daily_validators
+            headers = conditional_headers(etag, last_modified)
+
+        async with self._semaphore, session.get(self.CBR_API_URL, params=params, headers=headers) as response:
+            if response.status == 304 and headers:
+                logger.debug("CBR daily rates not modified")
+                return self._daily_validators[2]
+
+            if response.status != 200:
+                logger.error(f"CBR API error: {response.status}")
+                return None
+
+            xml_data = await response.text()
+
+            if not date:
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+                if etag or last_modified:
+                    self._daily_validators = (etag, last_modified, xml_data)
+
+            return xml_data
+
     async def get_currency_rate(self, currency_code: str, date: Optional[datetime] = None) -> Optional[float]:
         """
         Получает курс конкретной валюты
@@ -77,14 +175,44 @@ class CBRService:
         try:
             # Проверяем кэш
             cache_key = f"{currency_code}_{date.strftime('%Y%m%d') if date else 'today'}"
-            current_time = datetime.now()
-
-            if (cache_key in self.cache and
-                    cache_key in self.cache_time and
-                    (current_time - self.cache_time[cache_key]).seconds < self.cache_ttl):
+            cached_rate = self.cache.get(cache_key)
+            if cached_rate is not None:
                 logger.debug(f"Using cached rate for {currency_code}")
-                return self.cache[cache_key]
+                return cached_rate
+
+            # Такой же запрос уже выполняется - ждем его результат вместо нового запроса
+            inflight = self._inflight.get(cache_key)
+            if inflight is not None:
+                logger.debug(f"Waiting for in-flight request for {currency_code}")
+                return await asyncio.shield(inflight)
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[cache_key] = future
+            try:
+                rate = await self._fetch_currency_rate(currency_code, date, cache_key)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as e:
+                # Ожидающие запросы получают ту же ошибку, что и первый
+                future.set_exception(e)
+                # Ошибка уже пробрасывается ниже - без ожидающих она не должна попасть в лог asyncio
+                future.exception()
+                raise
+            else:
+                future.set_result(rate)
+                return rate
+            finally:
+                self._inflight.pop(cache_key, None)
 
+        except Exception as e:
+            logger.error(f"Error getting currency rate for {currency_code}: {e}")
+            return None
+
+    async def _fetch_currency_rate(self, currency_code: str, date: Optional[datetime],
+                                   cache_key: str) -> Optional[float]:
+        """Загружает курс валюты из ЦБ РФ и сохраняет его в кэш"""
+        try:
             # Получаем код валюты для ЦБ РФ
             cbr_currency_code = self.CURRENCY_CODES.get(currency_code.lower())
             if not cbr_currency_code:
@@ -95,35 +223,40 @@ class CBRService:
 
             # Если нужна историческая дата, используем динамический API
             if date and date != datetime.now().date():
-                date_req1 = date.strftime('%d/%m/%Y')
-                date_req2 = date.strftime('%d/%m/%Y')
+                date_req = _cbr_date_param(date)
 
                 params = {
-                    'date_req1': date_req1,
-                    'date_req2': date_req2,
+                    'date_req1': date_req,
+                    'date_req2': date_req,
                     'VAL_NM_RQ': cbr_currency_code
                 }
 
-                async with session.get(self.CBR_API_URL_DYNAMIC, params=params) as response:
-                    if response.status == 200:
-                        xml_data = await response.text()
-                        rate = self._parse_dynamic_rate(xml_data, currency_code)
-                        if rate:
-                            # Сохраняем в кэш
-                            self.cache[cache_key] = rate
-                            self.cache_time[cache_key] = current_time
-                        return rate
-                    else:
+                async with self._semaphore, session.get(self.CBR_API_URL_DYNAMIC, params=params) as response:
+                    if response.status != 200:
                         logger.error(f"CBR dynamic API error: {response.status}")
                         return None
+
+                    xml_data = await response.text()
+
+                # Разбор XML - CPU-работа, выносим из event loop
+                loop = asyncio.get_running_loop()
+                rate = await loop.run_in_executor(None, self._parse_dynamic_rate, xml_data, currency_code)
+                if rate:
+                    # Сохраняем в кэш
+                    self.cache[cache_key] = rate
+                return rate
             else:
                 # Для текущей даты используем основной API
-                rates = await self.get_daily_rates(date)
-                rate = rates.get(currency_code.lower())
+                xml_data = await self._fetch_daily_xml(date)
+                if xml_data is None:
+                    return None
+
+                # Нужна одна валюта: разбор останавливается на найденном элементе
+                loop = asyncio.get_running_loop()
+                rate = await loop.run_in_executor(None, self._parse_daily_rate_for, xml_data, currency_code)
                 if rate:
                     # Сохраняем в кэш
                     self.cache[cache_key] = rate
-                    self.cache_time[cache_key] = current_time
                 return rate
 
         except Exception as e:
@@ -142,45 +275,66 @@ class CBRService:
         """Парсит XML с ежедневными курсами"""
         rates = {}
         try:
-            root = ET.fromstring(xml_data)
-
-            # Получаем дату курсов
-            date_str = root.attrib.get('Date')
-            logger.info(f"Parsing CBR rates for date: {date_str}")
-
-            for valute in root.findall('Valute'):
-                char_code = valute.find('CharCode').text.lower()
-                value = valute.find('Value').text
-                nominal = int(valute.find('Nominal').text)
+            for valute in _iter_xml_elements(xml_data, 'Valute'):
+                # Известные валюты определяем по атрибуту ID, остальные - по CharCode
+                char_code = self._CBR_ID_TO_LOCAL.get(valute.get('ID'))
+                if char_code is None:
+                    char_code = valute.findtext('CharCode').lower()
+                value = valute.findtext('Value')
+                nominal = int(valute.findtext('Nominal'))
 
                 # Конвертируем в число
-                value_clean = value.replace(',', '.')
+                value_clean = value.translate(self._NUM_TRANS)
                 try:
                     rate = float(value_clean) / nominal
                     rates[char_code] = rate
                 except ValueError:
                     logger.warning(f"Could not parse rate for {char_code}: {value}")
 
+            logger.info(f"Parsed {len(rates)} CBR rates")
+
         except Exception as e:
             logger.error(f"Error parsing CBR XML: {e}")
 
         return rates
 
-    def _parse_dynamic_rate(self, xml_data: str, currency_code: str) -> Optional[float]:
-        """Парсит XML с динамикой курса"""
+    def _parse_daily_rate_for(self, xml_data: str, currency_code: str) -> Optional[float]:
+        """Парсит из XML с ежедневными курсами только одну валюту"""
+        cbr_id = self.CURRENCY_CODES.get(currency_code.lower())
+        if not cbr_id:
+            logger.error(f"Unknown currency code: {currency_code}")
+            return None
+
         try:
-            root = ET.fromstring(xml_data)
+            for valute in _iter_xml_elements(xml_data, 'Valute'):
+                if valute.get('ID') != cbr_id:
+                    continue
+
+                value = valute.findtext('Value')
+                nominal = int(valute.findtext('Nominal'))
+                return float(value.translate(self._NUM_TRANS)) / nominal
+
+            logger.warning(f"Currency {currency_code} ({cbr_id}) not found in CBR XML")
 
-            # Ищем последнюю запись
-            records = root.findall('Record')
-            if records:
-                last_record = records[-1]
-                value = last_record.find('Value').text
-                nominal = int(last_record.find('Nominal').text)
+        except Exception as e:
+            logger.error(f"Error parsing CBR XML for {currency_code}: {e}")
+
+        return None
 
+    def _parse_dynamic_rate(self, xml_data: str, currency_code: str) -> Optional[float]:
+        """Парсит XML с динамикой курса"""
+        try:
+            # Нужна только последняя запись: запоминаем значения по ходу разбора
+            last_value = None
+            last_nominal = None
+            for record in _iter_xml_elements(xml_data, 'Record'):
+                last_value = record.findtext('Value')
+                last_nominal = record.findtext('Nominal')
+
+            if last_value is not None:
                 # Конвертируем в число
-                value_clean = value.replace(',', '.')
-                rate = float(value_clean) / nominal
+                value_clean = last_value.translate(self._NUM_TRANS)
+                rate = float(value_clean) / int(last_nominal)
                 return rate
 
         except Exception as e:
@@ -201,9 +355,16 @@ class CBRService:
             if from_currency.lower() == to_currency.lower():
                 return amount
 
-            # Получаем курсы обеих валют к RUB
-            from_rate = await self.get_currency_rate(from_currency)
-            to_rate = await self.get_currency_rate(to_currency)
+            # Получаем курсы обеих валют к RUB параллельно
+            from_rate, to_rate = await asyncio.gather(
+                self.get_currency_rate(from_currency),
+                self.get_currency_rate(to_currency),
+                return_exceptions=True
+            )
+            if isinstance(from_rate, Exception):
+                from_rate = None
+            if isinstance(to_rate, Exception):
+                to_rate = None
 
             if not from_rate or not to_rate:
                 logger.error(f"Cannot get rates for conversion: {from_currency} -> {to_currency}")
@@ -222,15 +383,21 @@ class CBRService:
         return list(self.CURRENCY_CODES.keys())
 
     async def close(self):
-        """Закрывает сессию"""
+        """Закрывает собственную сессию (общий пул закрывается при остановке бота)"""
+        if self._session_injected:
+            return
         if self.session and not self.session.closed:
             await self.session.close()
             self.session = None
 
+    def cache_stats(self) -> Dict[str, float]:
+        """Статистика попаданий в кэш (hits, misses, evictions, hit_rate)"""
+        return self.cache.stats()
+
     def clear_cache(self):
         """Очищает кэш"""
         self.cache.clear()
-        self.cache_time.clear()
+        self._daily_validators = None
         logger.info("CBR cache cleared")
 
 
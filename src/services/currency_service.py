@@ -1,31 +1,129 @@
 # src/services/currency_service.py
+import asyncio
+import functools
+import json
 import logging
+import os
+import random
+import time
 from typing import Optional
 from datetime import datetime
+from pathlib import Path
 from src.config.settings import settings
 from src.services.cbr_service import cbr_service
 
 logger = logging.getLogger(__name__)
 
+# Коды валют, которые сравниваются на горячих путях конвертации
+_USD = "usd"
+_RUB = "rub"
+
+# Готовые форматтеры рублевых сумм (связанный str.format без разбора f-строки)
+_RUB_BIG = "{:,.0f} ₽".format
+_RUB_SMALL = "{:.2f} ₽".format
+
+# Снимок последних курсов ЦБ, чтобы после перезапуска не ждать запросов к ЦБ
+DEFAULT_SNAPSHOT_FILE = Path.home() / ".cache" / "finance_bot" / "rates.json"
+
 
 class CurrencyService:
     """Сервис для конвертации валют"""
 
-    def __init__(self):
+    def __init__(self, snapshot_file: Optional[Path] = DEFAULT_SNAPSHOT_FILE):
+        self._real_rate_cache: Optional[float] = None  # Курс ЦБ + надбавка, пересчитывается при изменении
+        self._usd_additional_rub = 0.0
         self.usd_rub_rate_cbr = None  # Чистый курс USD/RUB от ЦБ
         self.other_rates_cbr = {}  # Курсы других валют от ЦБ {currency: rate_to_rub}
+        self._upper_codes = {}  # Коды валют для вывода {currency: CURRENCY}
         self.last_update = None
         self.update_interval = 3600  # 1 час
+        # Момент следующего обновления по time.monotonic() (с разбросом)
+        self._next_refresh_at: Optional[float] = None
         self.usd_additional_rub = 2.0  # +2 рубля только к USD (ИЗМЕНИЛ НАЗВАНИЕ!)
+        self.snapshot_file = Path(snapshot_file) if snapshot_file else None  # None - без снимка
         self._initialized = False
 
+    @property
+    def usd_rub_rate_cbr(self) -> Optional[float]:
+        """Чистый курс USD/RUB от ЦБ"""
+        return self._usd_rub_rate_cbr
+
+    @usd_rub_rate_cbr.setter
+    def usd_rub_rate_cbr(self, value: Optional[float]):
+        self._usd_rub_rate_cbr = value
+        self._update_real_rate_cache()
+
+    @property
+    def usd_additional_rub(self) -> float:
+        """Надбавка к курсу USD в рублях"""
+        return self._usd_additional_rub
+
+    @usd_additional_rub.setter
+    def usd_additional_rub(self, value: float):
+        self._usd_additional_rub = value
+        self._update_real_rate_cache()
+
+    def _update_real_rate_cache(self):
+        """Пересчитывает реальный курс USD/RUB после изменения курса ЦБ или надбавки"""
+        if self._usd_rub_rate_cbr is None:
+            self._real_rate_cache = None
+        else:
+            self._real_rate_cache = self._usd_rub_rate_cbr + self._usd_additional_rub
+
     async def initialize(self):
         """Инициализация сервиса - загружает курсы при старте"""
         if not self._initialized:
-            await self.update_rates_from_cbr()
+            if not self._load_snapshot():
+                await self.update_rates_from_cbr()
             self._initialized = True
             logger.info("CurrencyService инициализирован")
 
+    def _load_snapshot(self) -> bool:
+        """Загружает курсы из снимка, если он не старше update_interval"""
+        if not self.snapshot_file or not self.snapshot_file.exists():
+            return False
+
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+
+            age = time.time() - snapshot["ts"]
+            if not 0 <= age < self.update_interval or not snapshot.get("usd"):
+                return False
+
+            self.usd_rub_rate_cbr = snapshot["usd"]
+            self.other_rates_cbr = snapshot.get("others", {})
+            self._upper_codes = {code: code.upper() for code in self.other_rates_cbr}
+            self.last_update = datetime.fromtimestamp(snapshot["ts"])
+            # Следующее обновление - когда снимок устареет
+            self._next_refresh_at = time.monotonic() + (self.update_interval - age)
+
+            logger.info(f"Курсы загружены из снимка {self.snapshot_file} (возраст {age:.0f} сек)")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка чтения снимка курсов: {e}")
+            return False
+
+    def _save_snapshot(self):
+        """Сохраняет курсы ЦБ в снимок (атомарная замена файла)"""
+        if not self.snapshot_file:
+            return
+
+        try:
+            self.snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.snapshot_file.with_suffix('.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "usd": self.usd_rub_rate_cbr,
+                    "others": self.other_rates_cbr,
+                    "ts": time.time()
+                }, f)
+            os.replace(temp_file, self.snapshot_file)
+
+        except Exception as e:
+            logger.error(f"Ошибка сохранения снимка курсов: {e}")
+
     async def _ensure_initialized(self):
         """Убеждается, что сервис инициализирован"""
         if not self._initialized:
@@ -35,33 +133,46 @@ class CurrencyService:
         """Внутренний метод для обновления курсов если устарели"""
         await self._ensure_initialized()
 
-        if (self.last_update is None or
-                (datetime.now() - self.last_update).seconds > self.update_interval):
+        if self._next_refresh_at is None or time.monotonic() >= self._next_refresh_at:
             await self.update_rates_from_cbr()
 
+    def _mark_updated(self):
+        """Запоминает время обновления и планирует следующее с разбросом ±10%"""
+        self._upper_codes = {code: code.upper() for code in self.other_rates_cbr}
+        self.last_update = datetime.now()
+        interval = self.update_interval * random.uniform(0.9, 1.1)
+        self._next_refresh_at = time.monotonic() + interval
+
     async def update_rates_from_cbr(self):
         """Обновляет все курсы из ЦБ РФ"""
         try:
             logger.info("Обновление курсов из ЦБ РФ...")
 
-            # Получаем курс USD/RUB
-            usd_rate = await cbr_service.get_usd_rub_rate()
+            # Запрашиваем USD/RUB и курсы других валют параллельно
+            other_currencies = ["eur", "cny", "kzt", "uah"]
+            usd_rate, *other_rates = await asyncio.gather(
+                cbr_service.get_usd_rub_rate(),
+                *(cbr_service.get_currency_rate(currency) for currency in other_currencies),
+                return_exceptions=True
+            )
+
+            if isinstance(usd_rate, Exception):
+                logger.error(f"Ошибка получения курса USD/RUB: {usd_rate}")
+                usd_rate = None
 
             if usd_rate:
                 self.usd_rub_rate_cbr = usd_rate
 
-                # Получаем курсы других валют
+                # Сохраняем курсы других валют
                 self.other_rates_cbr = {}
-                other_currencies = ["eur", "cny", "kzt", "uah"]
-
-                for currency in other_currencies:
-                    rate = await cbr_service.get_currency_rate(currency)
-                    if rate:
+                for currency, rate in zip(other_currencies, other_rates):
+                    if rate and not isinstance(rate, Exception):
                         self.other_rates_cbr[currency] = rate
                     else:
                         logger.warning(f"Не удалось получить курс для {currency}")
 
-                self.last_update = datetime.now()
+                self._mark_updated()
+                self._save_snapshot()
 
                 logger.info(f"Курсы обновлены из ЦБ РФ:")
                 logger.info(f"  - USD/RUB: {usd_rate:.2f} ₽")
@@ -89,7 +200,7 @@ class CurrencyService:
             "kzt": 0.18,  # примерно
             "uah": 2.4,  # примерно
         }
-        self.last_update = datetime.now()
+        self._mark_updated()
         logger.warning(f"Используются курсы по умолчанию (ЦБ недоступен)")
 
     # ======================== ОСНОВНЫЕ МЕТОДЫ ========================
@@ -100,13 +211,14 @@ class CurrencyService:
 
     def convert_to_rub_sync(self, amount: float, from_currency: str) -> Optional[float]:
         """Конвертирует любую валюту в RUB"""
-        if from_currency.lower() == "rub":
+        currency = from_currency.lower()
+        if currency == _RUB:
             return amount
 
-        if from_currency.lower() == "usd":
+        if currency == _USD:
             return self.usd_to_rub_real_sync(amount)
 
-        rate = self.get_currency_to_rub_rate_sync(from_currency)
+        rate = self.get_currency_to_rub_rate_sync(currency)
         if rate:
             return amount * rate
         return None
@@ -117,18 +229,19 @@ class CurrencyService:
         """Возвращает реальный курс USD/RUB (курс ЦБ + 2 рубля)"""
         await self._update_rates_if_needed()
 
-        if self.usd_rub_rate_cbr is None:
+        if self._real_rate_cache is None:
             await self.update_rates_from_cbr()
 
-        return self.usd_rub_rate_cbr + self.usd_additional_rub
+        return self._real_rate_cache
 
     def get_real_usd_rub_rate_sync(self) -> float:
         """Синхронная версия - реальный курс USD/RUB"""
-        if self.usd_rub_rate_cbr is None:
+        real_rate = self._real_rate_cache
+        if real_rate is None:
             logger.warning("Курс USD еще не загружен, используем дефолтный")
             default_rate = settings.RUB_EXCHANGE_RATE or 80.0
             return default_rate + self.usd_additional_rub
-        return self.usd_rub_rate_cbr + self.usd_additional_rub
+        return real_rate
 
     async def get_cbr_usd_rub_rate(self) -> float:
         """Возвращает курс USD/RUB от ЦБ"""
@@ -152,25 +265,28 @@ class CurrencyService:
         """Возвращает курс валюты к RUB от ЦБ"""
         await self._update_rates_if_needed()
 
-        if currency.lower() == "usd":
+        currency = currency.lower()
+        if currency == _USD:
             return await self.get_cbr_usd_rub_rate()
-        elif currency.lower() == "rub":
+        elif currency == _RUB:
             return 1.0
         else:
-            return self.other_rates_cbr.get(currency.lower())
+            return self.other_rates_cbr.get(currency)
 
     def get_currency_to_rub_rate_sync(self, currency: str) -> Optional[float]:
         """Синхронная версия - курс валюты к RUB от ЦБ (ДОБАВИЛ ЭТОТ МЕТОД!)"""
-        if currency.lower() == "usd":
+        currency = currency.lower()
+        if currency == _USD:
             return self.get_cbr_usd_rub_rate_sync()
-        elif currency.lower() == "rub":
+        elif currency == _RUB:
             return 1.0
         else:
-            return self.other_rates_cbr.get(currency.lower())
+            return self.other_rates_cbr.get(currency)
 
     async def get_currency_to_usd_rate(self, currency: str) -> Optional[float]:
         """Возвращает курс валюты к USD"""
-        if currency.lower() == "usd":
+        currency = currency.lower()
+        if currency == _USD:
             return 1.0
 
         # Получаем курс к RUB
@@ -186,7 +302,8 @@ class CurrencyService:
 
     def get_currency_to_usd_rate_sync(self, currency: str) -> Optional[float]:
         """Синхронная версия - курс валюты к USD"""
-        if currency.lower() == "usd":
+        currency = currency.lower()
+        if currency == _USD:
             return 1.0
 
         currency_to_rub = self.get_currency_to_rub_rate_sync(currency)
@@ -228,48 +345,57 @@ class CurrencyService:
 
     async def convert_to_usd(self, amount: float, from_currency: str) -> Optional[float]:
         """Конвертирует любую валюту в USD"""
-        if from_currency.lower() == "usd":
+        currency = from_currency.lower()
+        if currency == _USD:
             return amount
 
-        rate = await self.get_currency_to_usd_rate(from_currency)
+        rate = await self.get_currency_to_usd_rate(currency)
         if rate:
             return amount * rate
         return None
 
     def convert_to_usd_sync(self, amount: float, from_currency: str) -> Optional[float]:
         """Синхронная версия - конвертация в USD"""
-        if from_currency.lower() == "usd":
+        currency = from_currency.lower()
+        if currency == _USD:
             return amount
 
-        rate = self.get_currency_to_usd_rate_sync(from_currency)
-        if rate:
-            return amount * rate
-        return None
+        # Курсы читаются напрямую, без промежуточных вызовов get_*_rate_sync
+        currency_to_rub = 1.0 if currency == _RUB else self.other_rates_cbr.get(currency)
+        if not currency_to_rub:
+            return None
+
+        usd_to_rub_real = self._real_rate_cache
+        if usd_to_rub_real is None:
+            usd_to_rub_real = self.get_real_usd_rub_rate_sync()
+        return amount * currency_to_rub / usd_to_rub_real
 
     # ======================== ФОРМАТИРОВАНИЕ И ИНФО ========================
 
     def format_rub(self, amount_rub: float) -> str:
         """Форматирует сумму в рублях"""
-        if amount_rub >= 1000:
-            return f"{amount_rub:,.0f} ₽"
-        else:
-            return f"{amount_rub:.2f} ₽"
+        return _RUB_BIG(amount_rub) if amount_rub >= 1000 else _RUB_SMALL(amount_rub)
 
     def get_rate_info(self) -> str:
         """Возвращает информацию о курсах"""
         cbr_rate = self.get_cbr_usd_rub_rate_sync()
         real_rate = self.get_real_usd_rub_rate_sync()
 
-        info = f"💰 **Курсы валют:**\n"
-        info += f"• USD/RUB (ЦБ): {cbr_rate:.2f} ₽\n"
-        info += f"• USD/RUB (реальный): {real_rate:.2f} ₽ (+{self.usd_additional_rub} ₽)\n"  # ИЗМЕНИЛ
+        lines = [
+            "💰 **Курсы валют:**",
+            f"• USD/RUB (ЦБ): {cbr_rate:.2f} ₽",
+            f"• USD/RUB (реальный): {real_rate:.2f} ₽ (+{self.usd_additional_rub} ₽)",
+        ]
 
-        # Добавляем другие валюты
-        for currency, rate in self.other_rates_cbr.items():
-            if rate:
-                info += f"• {currency.upper()}/RUB: {rate:.2f} ₽\n"
+        # Добавляем другие валюты (коды в верхнем регистре подготовлены при загрузке курсов)
+        upper_codes = self._upper_codes
+        lines.extend(
+            f"• {upper_codes.get(currency) or currency.upper()}/RUB: {rate:.2f} ₽"
+            for currency, rate in self.other_rates_cbr.items() if rate
+        )
+        lines.append("")
 
-        return info
+        return "\n".join(lines)
 
     # ======================== ДЛЯ ОБРАТНОЙ СОВМЕСТИМОСТИ ========================
 
@@ -279,13 +405,10 @@ class CurrencyService:
         if not amount_usd:
             return 0.0
 
-        # Используем глобальный экземпляр
-        try:
-            rate = currency_service.get_real_usd_rub_rate_sync()
-            return round(amount_usd * rate, 2)
-        except Exception as e:
-            logger.error(f"Error in usd_to_rub_static: {e}")
-            return amount_usd * 93.0  # Fallback
+        # Используем глобальный экземпляр; синхронный курс не бросает исключений,
+        # а при незагруженных курсах возвращает курс по умолчанию
+        rate = get_currency_service().get_real_usd_rub_rate_sync()
+        return round(amount_usd * rate, 2) if rate else amount_usd * 93.0  # Fallback
 
     @property
     def additional_rub(self):
@@ -298,5 +421,15 @@ class CurrencyService:
         self.usd_additional_rub = value
 
 
-# Глобальный экземпляр
-currency_service = CurrencyService()
\ No newline at end of file
+# Глобальный экземпляр сервиса создается лениво
+@functools.cache
+def get_currency_service() -> CurrencyService:
+    """Возвращает глобальный экземпляр сервиса (создается при первом обращении)"""
+    return CurrencyService()
+
+
+def __getattr__(name: str):
+    # Ленивый глобальный экземпляр: from ... import currency_service продолжает работать
+    if name == "currency_service":
+        return get_currency_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
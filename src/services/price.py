@@ -1,27 +1,71 @@
 # src/services/price.py
 import asyncio
+import functools
 import logging
-from typing import Dict, List, Optional
-from datetime import datetime
+import time
+from typing import Dict, List, Optional, Set, Tuple
 from collections import Counter
 
 from src.assets.registry import asset_registry
 from src.assets.base import AssetPrice
 from src.config.settings import PriceSources
+from src.services._cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
+def _source_key(source) -> str:
+    """
+    Ключ источника для статистики. У PriceSources берется value без str():
+    str() у enum дает 'PriceSources.BINANCE' и делит статистику с 'binance'
+    """
+    return getattr(source, 'value', source)
+
+
+class TokenBucket:
+    """Асинхронный token bucket: не более rate запросов в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока не появится свободный токен, и забирает его"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
 class PriceService:
     """Сервис для получения цен активов"""
 
     def __init__(self):
-        self.cache: Dict[str, AssetPrice] = {}
-        self.cache_time: Dict[str, float] = {}
         self.cache_ttl = 60  # секунды
-        self.rate_limit_delay = 1.0  # Задержка между запросами
-        self.last_request_time = 0.0
+        self.stale_ttl = 300  # Сколько секунд устаревшая цена отдается, пока обновляется в фоне
+        # symbol -> AssetPrice; срок жизни ±20%, чтобы цены не обновлялись все разом
+        self.cache = TTLCache(maxsize=2048, ttl=self.cache_ttl, jitter=0.2, stale_ttl=self.stale_ttl)
+        self._refreshing: Set[str] = set()  # Символы, обновляемые в фоне
+        # Незавершенные запросы цен по символу (single-flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        self.rate_limit_delay = 1.0  # Средний интервал между запросами к одному источнику
+        self.rate_limit_burst = 5  # Сколько запросов к источнику можно сделать сразу
+        self.max_concurrency = 8  # Максимум одновременных запросов цен
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._buckets: Dict[str, TokenBucket] = {}  # Ограничители частоты по источникам
         self.request_counter = Counter()  # Счетчик запросов по источникам
+        self._top_source: Optional[Tuple[str, int]] = None  # Самый частый источник (источник, запросов)
 
     def get_active_price_source(self) -> str:
         """Определяет активный источник цен на основе статистики запросов"""
@@ -39,10 +83,14 @@ class PriceService:
                             return "Binance API"
                 return "CoinGecko API, Binance API"
 
-            # Находим самый частый источник
-            most_common = self.request_counter.most_common(1)
-            if most_common:
-                source, count = most_common[0]
+            # Самый частый источник поддерживается при каждом обновлении счетчика
+            top_source = self._top_source
+            if top_source is None:
+                most_common = self.request_counter.most_common(1)
+                top_source = most_common[0] if most_common else None
+
+            if top_source:
+                source, count = top_source
                 if source == PriceSources.COINGECKO:
                     return f"CoinGecko API ({count} запросов)"
                 elif source == PriceSources.BINANCE:
@@ -56,6 +104,18 @@ class PriceService:
             logger.error(f"Error determining price source: {e}")
             return "CoinGecko API, Binance API"
 
+    def _count_sources(self, sources: List[str]):
+        """Увеличивает счетчики источников и обновляет самый частый источник"""
+        self.request_counter.update(sources)
+
+        # Счетчики только растут, поэтому достаточно сравнить обновленные источники с текущим лидером
+        top = self._top_source
+        for source in sources:
+            count = self.request_counter[source]
+            if top is None or source == top[0] or count > top[1]:
+                top = (source, count)
+        self._top_source = top
+
     def get_price_sources_stats(self) -> Dict[str, int]:
         """Возвращает статистику по источникам цен"""
         return dict(self.request_counter)
@@ -64,15 +124,47 @@ class PriceService:
     async def get_price(self, symbol: str) -> Optional[AssetPrice]:
         """Получает цену одного актива"""
         # Проверяем кэш
-        cache_key = f"price_{symbol}"
-        current_time = asyncio.get_event_loop().time()
-
-        if (cache_key in self.cache and
-                cache_key in self.cache_time and
-                current_time - self.cache_time[cache_key] < self.cache_ttl):
-            logger.debug(f"Using cached price for {symbol}")
-            return self.cache[cache_key]
-
+        cached, fresh = self.cache.get_stale(symbol)
+        if cached is not None:
+            if fresh:
+                logger.debug(f"Using cached price for {symbol}")
+            else:
+                # Цена устарела: отдаем ее сразу, а обновляем в фоне
+                logger.debug(f"Using stale price for {symbol}, refreshing in background")
+                self._schedule_refresh(symbol)
+            return cached
+
+        return await self._load_price(symbol)
+
+    async def _load_price(self, symbol: str) -> Optional[AssetPrice]:
+        """Загружает цену актива; одновременные запросы одного символа объединяются"""
+        # Такой же запрос уже выполняется - ждем его результат вместо нового запроса
+        inflight = self._inflight.get(symbol)
+        if inflight is not None:
+            logger.debug(f"Waiting for in-flight price request for {symbol}")
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[symbol] = future
+        try:
+            price = await self._fetch_and_store(symbol)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            # Ожидающие запросы получают ту же ошибку, что и первый
+            future.set_exception(e)
+            # Ошибка уже пробрасывается ниже - без ожидающих она не должна попасть в лог asyncio
+            future.exception()
+            raise
+        else:
+            future.set_result(price)
+            return price
+        finally:
+            self._inflight.pop(symbol, None)
+
+    async def _fetch_and_store(self, symbol: str) -> Optional[AssetPrice]:
+        """Загружает цену актива из источника и сохраняет ее в кэш"""
         # Получаем актив из реестра
         asset = asset_registry.get_asset(symbol)
         if not asset:
@@ -83,16 +175,34 @@ class PriceService:
         price = await asset.get_price()
         if price:
             # Сохраняем в кэш
-            self.cache[cache_key] = price
-            self.cache_time[cache_key] = current_time
+            self.cache[symbol] = price
 
             # Увеличиваем счетчик для источника
             if hasattr(price, 'source'):
-                source_str = str(price.source)
-                self.request_counter[source_str] += 1
+                self._count_sources([_source_key(price.source)])
 
         return price
 
+    def _schedule_refresh(self, symbol: str):
+        """Запускает фоновое обновление цены, если оно еще не запущено"""
+        if symbol in self._refreshing:
+            return
+
+        self._refreshing.add(symbol)
+        task = asyncio.create_task(self._refresh(symbol))
+        # Храним ссылку на задачу, чтобы ее не собрал сборщик мусора
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _refresh(self, symbol: str):
+        """Фоновое обновление цены"""
+        try:
+            await self._load_price(symbol)
+        except Exception as e:
+            logger.error(f"Background refresh failed for {symbol}: {e}")
+        finally:
+            self._refreshing.discard(symbol)
+
     async def get_prices(self, symbols: List[str]) -> Dict[str, Optional[AssetPrice]]:
         """Получает цены для нескольких активов"""
         # Уникальные символы
@@ -103,13 +213,9 @@ class PriceService:
         remaining_symbols = []
 
         for symbol in unique_symbols:
-            cache_key = f"price_{symbol}"
-            current_time = asyncio.get_event_loop().time()
-
-            if (cache_key in self.cache and
-                    cache_key in self.cache_time and
-                    current_time - self.cache_time[cache_key] < self.cache_ttl):
-                cached_results[symbol] = self.cache[cache_key]
+            cached = self.cache.get(symbol)
+            if cached is not None:
+                cached_results[symbol] = cached
             else:
                 remaining_symbols.append(symbol)
 
@@ -117,38 +223,56 @@ class PriceService:
         if not remaining_symbols:
             return cached_results
 
-        # Для оставшихся символов получаем цены с задержкой
+        # Оставшиеся символы запрашиваем параллельно (с ограничением частоты по источникам)
         prices = cached_results.copy()
 
-        for symbol in remaining_symbols:
-            # Задержка между запросами
-            current_time = asyncio.get_event_loop().time()
-            time_since_last_request = current_time - self.last_request_time
-            if time_since_last_request < self.rate_limit_delay:
-                await asyncio.sleep(self.rate_limit_delay - time_since_last_request)
-
-            asset = asset_registry.get_asset(symbol)
-            if asset:
-                price = await asset.get_price()
-                self.last_request_time = asyncio.get_event_loop().time()
-
-                if price:
-                    # Увеличиваем счетчик для источника
-                    if hasattr(price, 'source'):
-                        source_str = str(price.source)
-                        self.request_counter[source_str] += 1
-
-                    cache_key = f"price_{symbol}"
-                    self.cache[cache_key] = price
-                    self.cache_time[cache_key] = current_time
-                    prices[symbol] = price
-                else:
-                    prices[symbol] = None
-            else:
-                prices[symbol] = None
+        # Активы для всех промахов получаем одним обращением к реестру
+        assets = asset_registry.get_assets(remaining_symbols)
+        missing = [symbol for symbol, asset in assets.items() if asset is None]
+        if missing:
+            logger.error(f"Assets not found: {', '.join(missing)}")
+            prices.update(dict.fromkeys(missing))
+
+        found = [(symbol, asset) for symbol, asset in assets.items() if asset is not None]
+        results = await asyncio.gather(
+            *(self._fetch_one(asset) for _, asset in found),
+            return_exceptions=True
+        )
+
+        sources = []
+        for (symbol, _), price in zip(found, results):
+            if isinstance(price, Exception):
+                logger.error(f"Error getting price for {symbol}: {price}")
+                price = None
+
+            if price:
+                if hasattr(price, 'source'):
+                    sources.append(_source_key(price.source))
+
+                self.cache[symbol] = price
+
+            prices[symbol] = price
+
+        # Увеличиваем счетчики источников одним обновлением
+        self._count_sources(sources)
 
         return prices
 
+    def _get_bucket(self, source: str) -> TokenBucket:
+        """Возвращает ограничитель частоты запросов для источника"""
+        bucket = self._buckets.get(source)
+        if bucket is None:
+            bucket = TokenBucket(rate=1.0 / self.rate_limit_delay, capacity=self.rate_limit_burst)
+            self._buckets[source] = bucket
+        return bucket
+
+    async def _fetch_one(self, asset) -> Optional[AssetPrice]:
+        """Запрашивает цену одного актива с учетом ограничений источника"""
+        source = str(getattr(asset.config, 'price_source', ''))
+        async with self._semaphore:
+            await self._get_bucket(source).acquire()
+            return await asset.get_price()
+
     async def get_all_crypto_prices(self) -> Dict[str, Optional[AssetPrice]]:
         """Получает цены всех крипто активов"""
         crypto_assets = asset_registry.get_crypto_assets()
@@ -164,10 +288,27 @@ class PriceService:
     async def convert_currency(self, amount: float, from_currency: str, to_currency: str) -> Optional[float]:
         """Конвертирует сумму из одной валюты в другую"""
         try:
+            from_upper = from_currency.upper()
+            to_upper = to_currency.upper()
+
             # Если конвертируем из USD в USD
-            if from_currency.upper() == to_currency.upper():
+            if from_upper == to_upper:
                 return amount
 
+            # Цены активов в USD: если одна из сторон USD, достаточно одной цены
+            if from_upper == "USD" or to_upper == "USD":
+                other = to_currency if from_upper == "USD" else from_currency
+                other_price = await self.get_price(other)
+
+                if not other_price:
+                    logger.error(f"Cannot get prices for conversion: {from_currency} -> {to_currency}")
+                    return None
+
+                if other_price.currency.upper() == "USD":
+                    if from_upper == "USD":
+                        return amount / other_price.price
+                    return amount * other_price.price
+
             # Получаем цены обеих валют
             prices = await self.get_prices([from_currency, to_currency])
 
@@ -189,9 +330,18 @@ class PriceService:
     def clear_cache(self):
         """Очищает кэш цен"""
         self.cache.clear()
-        self.cache_time.clear()
         logger.info("Price cache cleared")
 
 
-# Глобальный экземпляр сервиса
-price_service = PriceService()
\ No newline at end of file
+# Глобальный экземпляр сервиса создается лениво
+@functools.cache
+def get_price_service() -> PriceService:
+    """Возвращает глобальный экземпляр сервиса (создается при первом обращении)"""
+    return PriceService()
+
+
+def __getattr__(name: str):
+    # Ленивый глобальный экземпляр: from ... import price_service продолжает работать
+    if name == "price_service":
+        return get_price_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,6 +1,6 @@
 # src/tests/conftest.py
 import pytest
-import asyncio
+import pytest_asyncio
 import sys
 import os
 
@@ -8,9 +8,21 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 
-@pytest.fixture(scope="session")
-def event_loop():
-    """Создание event loop для асинхронных тестов"""
-    loop = asyncio.new_event_loop()
-    yield loop
-    loop.close()
\ No newline at end of file
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def shared_cbr_service():
+    """Один экземпляр CBRService на всю сессию тестов"""
+    from src.services.cbr_service import CBRService
+
+    service = CBRService()
+    yield service
+    await service.close()
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def shared_metal_service():
+    """Один экземпляр MetalService на всю сессию тестов"""
+    from src.services.cbr_metals_service import MetalService
+
+    service = MetalService()
+    yield service
+    await service.close()
@@ -1,178 +1,308 @@
 import aiohttp
 import asyncio
+import datetime
+import re
+import sys
+from typing import Any, Dict, List, Optional
 
+try:
+    from lxml import etree
+    _XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+except ImportError:  # без lxml проверки идут по тексту ответа
+    etree = None
 
-async def test_api():
-    async with aiohttp.ClientSession() as session:
-        print("=" * 50)
-        print("Тестирование API ЦБ РФ")
-        print("=" * 50)
-
-        # Тест 1: Основной API для ежедневных курсов
-        cbr_url = "https://www.cbr.ru/scripts/XML_daily.asp"
-        print(f"\n1. Тестирование основного API: {cbr_url}")
-
-        try:
-            async with session.get(cbr_url) as resp:
-                print(f"Статус: {resp.status}")
-                if resp.status == 200:
-                    text = await resp.text()
-                    print(f"Успешно! Получено {len(text)} символов")
-
-                    # Проверяем структуру XML
-                    if "ValCurs" in text:
-                        print("✓ XML структура корректна (содержит ValCurs)")
-                    else:
-                        print("✗ XML структура некорректна")
-
-                    # Проверяем наличие валют
-                    currencies_to_check = ["USD", "EUR", "CNY"]
-                    for currency in currencies_to_check:
-                        if currency in text:
-                            print(f"✓ Валюта {currency} найдена")
-                        else:
-                            print(f"✗ Валюта {currency} не найдена")
-                else:
-                    print(f"Ошибка: статус {resp.status}")
-        except Exception as e:
-            print(f"Ошибка при запросе: {e}")
+try:
+    from orjson import loads as json_loads
+except ImportError:  # json.loads тоже принимает bytes
+    from json import loads as json_loads
+
+CBR_URL = "https://www.cbr.ru/scripts/XML_daily.asp"
+CBR_DYNAMIC_URL = "https://www.cbr.ru/scripts/XML_dynamic.asp"
+
+# Паттерн для поиска USD курса (если lxml недоступен)
+_USD_RATE_RE = re.compile(r'<Valute ID="R01235">.*?<Value>([\d,]+)</Value>', re.DOTALL)
+
+# Разделитель разделов вывода
+_SEP = "=" * 50
+_NL_SEP = "\n" + _SEP
+
+# Валюты, наличие которых проверяет тест 1
+_DAILY_CURRENCIES = ("USD", "EUR", "CNY")
+
+# Проверки независимы, поэтому выполняются параллельно.
+# Каждая собирает свой вывод в список строк, который печатается целиком,
+# как только проверка завершится, - вывод разных проверок не перемешивается
 
-        print("\n" + "=" * 50)
 
-        # Тест 2: Динамический API для исторических данных
-        print("\n2. Тестирование динамического API")
+async def probe_cbr_daily(session: aiohttp.ClientSession) -> List[str]:
+    """Тесты 1 и 4: один запрос XML_daily, обе проверки по одному ответу"""
+    status: Optional[int] = None
+    summary: Optional[Dict[str, Any]] = None
+    error: Optional[Exception] = None
 
-        # Параметры для USD за последние 7 дней
-        import datetime
-        today = datetime.datetime.now()
-        week_ago = today - datetime.timedelta(days=7)
+    try:
+        async with session.get(CBR_URL) as resp:
+            status = resp.status
+            if status == 200:
+                summary = await read_daily_summary(resp)
+    except Exception as e:
+        error = e
 
-        cbr_dynamic_url = "https://www.cbr.ru/scripts/XML_dynamic.asp"
-        params = {
-            'date_req1': week_ago.strftime('%d/%m/%Y'),
-            'date_req2': today.strftime('%d/%m/%Y'),
-            'VAL_NM_RQ': 'R01235'  # Код USD
+    return (check_cbr_daily(status, summary, error)
+            + [_NL_SEP]
+            + check_usd_rate(status, summary, error))
+
+
+async def read_daily_summary(resp: aiohttp.ClientResponse) -> Dict[str, Any]:
+    """
+    Разбирает XML_daily по мере получения: корневой тег, коды валют и курс USD.
+    Тело не собирается в строку, обработанные элементы Valute сразу освобождаются
+    """
+    if etree is None:
+        body = await resp.read()
+        text = body.decode(resp.get_encoding())
+        match = _USD_RATE_RE.search(text)
+        return {
+            "size": len(body),
+            "valid": "ValCurs" in text,
+            "currencies": {currency for currency in _DAILY_CURRENCIES if currency in text},
+            "usd_rate": match.group(1) if match else None,
         }
 
-        print(f"URL: {cbr_dynamic_url}")
-        print(f"Параметры: {params}")
-
-        try:
-            async with session.get(cbr_dynamic_url, params=params) as resp:
-                print(f"Статус: {resp.status}")
-                if resp.status == 200:
-                    text = await resp.text()
-                    print(f"Успешно! Получено {len(text)} символов")
-
-                    if "ValCurs" in text and "Record" in text:
-                        print("✓ XML структура корректна")
-                        # Считаем количество записей
-                        record_count = text.count("<Record ")
-                        print(f"✓ Найдено записей курса: {record_count}")
-                    else:
-                        print("✗ XML структура некорректна")
-                else:
-                    print(f"Ошибка: статус {resp.status}")
-        except Exception as e:
-            print(f"Ошибка при запросе: {e}")
-
-        print("\n" + "=" * 50)
-
-        # Тест 3: API с параметром даты
-        print("\n3. Тестирование API с конкретной датой")
-
-        test_date = "01/01/2024"
-        params_with_date = {'date_req': test_date}
-
-        try:
-            async with session.get(cbr_url, params=params_with_date) as resp:
-                print(f"Запрос курсов на дату: {test_date}")
-                print(f"Статус: {resp.status}")
-                if resp.status == 200:
-                    text = await resp.text()
-                    if test_date.replace("/", ".") in text:
-                        print(f"✓ Данные за {test_date} получены успешно")
-                    else:
-                        print("✗ Данные за указанную дату не найдены")
-                else:
-                    print(f"Ошибка: статус {resp.status}")
-        except Exception as e:
-            print(f"Ошибка при запросе: {e}")
-
-        print("\n" + "=" * 50)
-
-        # Тест 4: Получаем курс конкретной валюты (USD)
-        print("\n4. Получение текущего курса USD/RUB")
-
-        try:
-            async with session.get(cbr_url) as resp:
-                if resp.status == 200:
-                    text = await resp.text()
-
-                    # Ищем USD в XML
-                    import re
-                    # Паттерн для поиска USD курса
-                    usd_pattern = r'<Valute ID="R01235">.*?<Value>([\d,]+)</Value>'
-                    match = re.search(usd_pattern, text, re.DOTALL)
-
-                    if match:
-                        usd_rate = match.group(1).replace(',', '.')
-                        print(f"✓ Текущий курс USD/RUB: {usd_rate}")
-
-                        # Проверяем, что курс - валидное число
-                        try:
-                            rate_float = float(usd_rate)
-                            print(f"✓ Курс в числовом формате: {rate_float}")
-                            if 10 < rate_float < 200:  # Реалистичный диапазон для рубля
-                                print("✓ Курс в реалистичном диапазоне")
-                            else:
-                                print("⚠ Курс вне ожидаемого диапазона")
-                        except ValueError:
-                            print("✗ Не удалось преобразовать курс в число")
-                    else:
-                        print("✗ Курс USD не найден в ответе")
+    # Байты подаются парсеру напрямую: кодировку (windows-1251) он берет из объявления XML
+    parser = etree.XMLPullParser(events=("start", "end"), resolve_entities=False, no_network=True)
+    summary = {"size": 0, "valid": False, "currencies": set(), "usd_rate": None}
+    root_tag = None
+
+    try:
+        async for chunk in resp.content.iter_chunked(4096):
+            summary["size"] += len(chunk)
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root_tag is None:
+                        root_tag = elem.tag
+                elif elem.tag == "Valute":
+                    summary["currencies"].add(elem.findtext("CharCode"))
+                    if elem.get("ID") == "R01235":
+                        summary["usd_rate"] = elem.findtext("Value")
+                    elem.clear()
+        parser.close()
+        summary["valid"] = root_tag == "ValCurs"
+    except etree.XMLSyntaxError:
+        pass
+
+    return summary
+
+
+def check_cbr_daily(status: Optional[int], summary: Optional[Dict[str, Any]],
+                    error: Optional[Exception]) -> List[str]:
+    """Тест 1: Основной API для ежедневных курсов"""
+    lines = [f"\n1. Тестирование основного API: {CBR_URL}"]
+
+    if error is not None:
+        lines.append(f"Ошибка при запросе: {error}")
+        return lines
+
+    lines.append(f"Статус: {status}")
+    if summary is not None:
+        lines.append(f"Успешно! Получено {summary['size']} байт")
+
+        # Проверяем структуру XML
+        if summary["valid"]:
+            lines.append("✓ XML структура корректна (содержит ValCurs)")
+        else:
+            lines.append("✗ XML структура некорректна")
+
+        # Проверяем наличие валют
+        for currency in _DAILY_CURRENCIES:
+            if currency in summary["currencies"]:
+                lines.append(f"✓ Валюта {currency} найдена")
+            else:
+                lines.append(f"✗ Валюта {currency} не найдена")
+    else:
+        lines.append(f"Ошибка: статус {status}")
+
+    return lines
+
+
+async def probe_cbr_dynamic(session: aiohttp.ClientSession) -> List[str]:
+    """Тест 2: Динамический API для исторических данных"""
+    lines = ["\n2. Тестирование динамического API"]
+
+    # Параметры для USD за последние 7 дней
+    today = datetime.datetime.now()
+    week_ago = today - datetime.timedelta(days=7)
+
+    params = {
+        'date_req1': week_ago.strftime('%d/%m/%Y'),
+        'date_req2': today.strftime('%d/%m/%Y'),
+        'VAL_NM_RQ': 'R01235'  # Код USD
+    }
+
+    lines.append(f"URL: {CBR_DYNAMIC_URL}")
+    lines.append(f"Параметры: {params}")
+
+    try:
+        async with session.get(CBR_DYNAMIC_URL, params=params) as resp:
+            lines.append(f"Статус: {resp.status}")
+            if resp.status == 200:
+                body = await resp.read()
+                lines.append(f"Успешно! Получено {len(body)} байт")
+
+                # Один разбор вместо проверок подстрок и подсчета по тексту
+                record_count = count_dynamic_records(body, resp.get_encoding())
+                if record_count:
+                    lines.append("✓ XML структура корректна")
+                    lines.append(f"✓ Найдено записей курса: {record_count}")
                 else:
-                    print(f"✗ Ошибка при получении данных: {resp.status}")
-        except Exception as e:
-            print(f"Ошибка: {e}")
-
-        print("\n" + "=" * 50)
-
-        # Проверьте CoinGecko
-        print("\n5. Тестирование CoinGecko API")
-        url = "https://api.coingecko.com/api/v3/simple/price"
-        params = {"ids": "bitcoin", "vs_currencies": "usd"}
-        try:
-            async with session.get(url, params=params) as resp:
-                print(f"CoinGecko статус: {resp.status}")
-                if resp.status == 200:
-                    data = await resp.json()
-                    print(f"✓ Bitcoin цена: ${data['bitcoin']['usd']}")
+                    lines.append("✗ XML структура некорректна")
+            else:
+                lines.append(f"Ошибка: статус {resp.status}")
+    except Exception as e:
+        lines.append(f"Ошибка при запросе: {e}")
+
+    return lines
+
+
+def count_dynamic_records(body: bytes, encoding: str) -> int:
+    """Количество записей Record в ответе XML_dynamic (0, если структура некорректна)"""
+    if etree is None:
+        text = body.decode(encoding)
+        return text.count("<Record ") if "ValCurs" in text else 0
+
+    try:
+        root = etree.fromstring(body, parser=_XML_PARSER)
+    except etree.XMLSyntaxError:
+        return 0
+    return len(root.findall("Record")) if root.tag == "ValCurs" else 0
+
+
+async def probe_cbr_dated(session: aiohttp.ClientSession) -> List[str]:
+    """Тест 3: API с параметром даты"""
+    lines = ["\n3. Тестирование API с конкретной датой"]
+
+    test_date = "01/01/2024"
+    params_with_date = {'date_req': test_date}
+
+    try:
+        async with session.get(CBR_URL, params=params_with_date) as resp:
+            lines.append(f"Запрос курсов на дату: {test_date}")
+            lines.append(f"Статус: {resp.status}")
+            if resp.status == 200:
+                text = await resp.text()
+                if test_date.replace("/", ".") in text:
+                    lines.append(f"✓ Данные за {test_date} получены успешно")
                 else:
-                    print(f"✗ Ошибка: {resp.status}")
-                    print(await resp.text())
-        except Exception as e:
-            print(f"Ошибка CoinGecko: {e}")
-
-        print("\n" + "=" * 50)
-
-        # Проверьте Binance
-        print("\n6. Тестирование Binance API")
-        url = "https://api.binance.com/api/v3/ticker/price"
-        params = {"symbol": "BTCUSDT"}
-        try:
-            async with session.get(url, params=params) as resp:
-                print(f"Binance статус: {resp.status}")
-                if resp.status == 200:
-                    data = await resp.json()
-                    print(f"✓ BTC/USDT цена: ${data['price']}")
+                    lines.append("✗ Данные за указанную дату не найдены")
+            else:
+                lines.append(f"Ошибка: статус {resp.status}")
+    except Exception as e:
+        lines.append(f"Ошибка при запросе: {e}")
+
+    return lines
+
+
+def check_usd_rate(status: Optional[int], summary: Optional[Dict[str, Any]],
+                   error: Optional[Exception]) -> List[str]:
+    """Тест 4: Получаем курс конкретной валюты (USD) из ответа теста 1"""
+    lines = ["\n4. Получение текущего курса USD/RUB"]
+
+    if error is not None:
+        lines.append(f"Ошибка: {error}")
+        return lines
+
+    if summary is not None:
+        usd_rate = summary["usd_rate"]
+
+        if usd_rate:
+            usd_rate = usd_rate.replace(',', '.')
+            lines.append(f"✓ Текущий курс USD/RUB: {usd_rate}")
+
+            # Проверяем, что курс - валидное число
+            try:
+                rate_float = float(usd_rate)
+                lines.append(f"✓ Курс в числовом формате: {rate_float}")
+                if 10 < rate_float < 200:  # Реалистичный диапазон для рубля
+                    lines.append("✓ Курс в реалистичном диапазоне")
                 else:
-                    print(f"✗ Ошибка: {resp.status}")
-                    print(await resp.text())
-        except Exception as e:
-            print(f"Ошибка Binance: {e}")
+                    lines.append("⚠ Курс вне ожидаемого диапазона")
+            except ValueError:
+                lines.append("✗ Не удалось преобразовать курс в число")
+        else:
+            lines.append("✗ Курс USD не найден в ответе")
+    else:
+        lines.append(f"✗ Ошибка при получении данных: {status}")
+
+    return lines
+
+
+async def probe_coingecko(session: aiohttp.ClientSession) -> List[str]:
+    """Тест 5: CoinGecko"""
+    lines = ["\n5. Тестирование CoinGecko API"]
+    url = "https://api.coingecko.com/api/v3/simple/price"
+    params = {"ids": "bitcoin", "vs_currencies": "usd"}
+    try:
+        async with session.get(url, params=params) as resp:
+            lines.append(f"CoinGecko статус: {resp.status}")
+            if resp.status == 200:
+                data = json_loads(await resp.read())
+                lines.append(f"✓ Bitcoin цена: ${data['bitcoin']['usd']}")
+            else:
+                lines.append(f"✗ Ошибка: {resp.status}")
+                lines.append(await resp.text())
+    except Exception as e:
+        lines.append(f"Ошибка CoinGecko: {e}")
+
+    return lines
+
+
+async def probe_binance(session: aiohttp.ClientSession) -> List[str]:
+    """Тест 6: Binance"""
+    lines = ["\n6. Тестирование Binance API"]
+    url = "https://api.binance.com/api/v3/ticker/price"
+    params = {"symbol": "BTCUSDT"}
+    try:
+        async with session.get(url, params=params) as resp:
+            lines.append(f"Binance статус: {resp.status}")
+            if resp.status == 200:
+                data = json_loads(await resp.read())
+                lines.append(f"✓ BTC/USDT цена: ${data['price']}")
+            else:
+                lines.append(f"✗ Ошибка: {resp.status}")
+                lines.append(await resp.text())
+    except Exception as e:
+        lines.append(f"Ошибка Binance: {e}")
+
+    return lines
+
+
+async def test_api():
+    # Кэш DNS и keep-alive: повторные запросы к cbr.ru идут по уже открытым соединениям
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=75)
+    timeout = aiohttp.ClientTimeout(total=10, connect=3)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        sys.stdout.write("\n".join([_SEP, "Тестирование API ЦБ РФ", _SEP, ""]))
+
+        probes = [
+            probe_cbr_daily,
+            probe_cbr_dynamic,
+            probe_cbr_dated,
+            probe_coingecko,
+            probe_binance,
+        ]
+        # Каждая проба сама перехватывает ошибки запроса и описывает их в выводе.
+        # Результаты печатаются по мере готовности (разделы пронумерованы),
+        # вывод каждой пробы - одной записью в stdout
+        tasks = [asyncio.create_task(probe(session), name=probe.__name__) for probe in probes]
+        for i, future in enumerate(asyncio.as_completed(tasks)):
+            lines = await future
+            if i:
+                lines = [_NL_SEP] + lines
+            sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":
     print("Запуск тестов API...")
-    asyncio.run(test_api())
\ No newline at end of file
+    asyncio.run(test_api())
@@ -2,9 +2,12 @@
 import asyncio
 import logging
 from datetime import datetime, timedelta
+from statistics import fmean
 from typing import Dict, Any
 import sys
-from src.services.cbr_metals_service import MetalService
+
+import pytest
+from src.services.cbr_metals_service import MetalPrice, MetalService
 
 # Настройка логирования для тестов
 logging.basicConfig(
@@ -17,421 +20,501 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Таблица цен ЦБ РФ для тестов разбора (строится один раз при импорте модуля)
+_HTML_PRICES = """
+    <html><body>
+    <table class="data">
+        <tr><th>Дата</th><th>Золото</th><th>Серебро</th><th>Платина</th><th>Палладий</th></tr>
+        <tr><td>02.02.2026</td><td>12 345,67</td><td>150,12</td><td>3 456,78</td><td>2\xa0345,67</td></tr>
+        <tr><td>03.02.2026</td><td>12 400,00</td><td>151,00</td><td>3 500,00</td><td>2 400,00</td></tr>
+        <tr><td>bad row</td></tr>
+    </table>
+    </body></html>
+"""
+
+# Та же таблица с вложенной разметкой в ячейках и вложенной таблицей
+_HTML_PRICES_NESTED = """
+    <html><body>
+    <table class="data">
+        <tbody>
+        <tr><th>Дата</th><th>Золото</th><th>Серебро</th><th>Платина</th><th>Палладий</th></tr>
+        <tr><td><span>02.02.2026</span></td><td><b>12 345,67</b></td><td>150,<br>12</td>
+            <td>3 456,78</td><td>2\xa0345,67</td></tr>
+        <tr><td>03.02.2026</td><td>12 400,00</td><td><span class="v">151,00</span></td><td>3 500,00</td>
+            <td>2 400,00</td><td><table><tr><td>01.01.2000</td></tr></table></td></tr>
+        </tbody>
+    </table>
+    </body></html>
+"""
+
+
+@pytest.fixture
+def mock_cbr(shared_metal_service, monkeypatch):
+    """
+    Подменяет загрузку страницы ЦБ РФ разбором _HTML_PRICES из памяти.
+    Возвращает список выполненных "запросов" для проверки их количества
+    """
+    requests = []
+
+    async def fetch_from_fixture():
+        requests.append(shared_metal_service.CBR_METAL_URL)
+        return shared_metal_service._parse_metal_prices(_HTML_PRICES)
+
+    monkeypatch.setattr(shared_metal_service, "_fetch_metal_prices", fetch_from_fixture)
+    return requests
+
+
+@pytest.fixture
+def metal_service(shared_metal_service, mock_cbr):
+    """Общий экземпляр сервиса с очищенным кэшем и данными без сети (изоляция тестов)"""
+    shared_metal_service.clear_cache()
+    return shared_metal_service
+
+
+async def test_get_available_metal_types(metal_service):
+    """Тестирование списка типов металлов"""
+    assert await metal_service.get_available_metal_types() == ["gold", "silver", "platinum", "palladium"]
+
+
+async def test_get_latest_prices(metal_service):
+    """Тестирование получения последних цен"""
+    prices = await metal_service.get_latest_prices()
+
+    assert len(prices) == 2
+    assert prices[0].date == datetime(2026, 2, 3)
+    assert prices[0].gold == 12400.0
+    assert prices[0].silver == 151.0
+
 
-async def test_all_methods():
-    """Тестирование всех методов MetalService"""
+@pytest.mark.parametrize("metal_type, expected_price", [
+    ("gold", 12400.0),
+    ("silver", 151.0),
+    ("platinum", 3500.0),
+    ("palladium", 2400.0),
+])
+async def test_get_latest_metal_price(metal_service, metal_type, expected_price):
+    """Тестирование последней цены отдельного металла"""
+    price_obj = await metal_service.get_latest_metal_price(metal_type)
 
-    # Импортируем сервис
-    try:
-        from src.services.cbr_metals_service import MetalService, MetalPrice
-    except ImportError:
-        print("Ошибка: Не удалось импортировать MetalService")
-        print("Убедитесь, что файл cbr_metals_service.py находится в правильной директории")
-        return
+    assert isinstance(price_obj, MetalPrice)
+    assert getattr(price_obj, metal_type) == expected_price
 
-    print("=" * 70)
-    print("ТЕСТИРОВАНИЕ METAL SERVICE")
+
+async def test_get_metal_price_by_date(metal_service):
+    """Тестирование цены на дату: точное совпадение или ближайшая предыдущая запись"""
+    today = datetime.now()
+
+    assert (await metal_service.get_metal_price_by_date(datetime(2026, 2, 2, 15, 30))).gold == 12345.67
+    assert (await metal_service.get_metal_price_by_date(today)).date == datetime(2026, 2, 3)
+    assert (await metal_service.get_metal_price_by_date(today - timedelta(days=1))).date == datetime(2026, 2, 3)
+
+
+async def test_min_date_short_circuit(metal_service, mock_cbr):
+    """Тестирование: даты раньше начала ряда ЦБ РФ отклоняются без загрузки страницы"""
+    assert await metal_service.get_metal_price_by_date(datetime(2000, 1, 1)) is None
+    assert mock_cbr == []
+
+
+@pytest.mark.parametrize("method_name, expected_price", [
+    ("get_gold_price", 12400.0),
+    ("get_silver_price", 151.0),
+    ("get_platinum_price", 3500.0),
+    ("get_palladium_price", 2400.0),
+])
+async def test_specific_price_methods(metal_service, method_name, expected_price):
+    """Тестирование методов получения цен конкретных металлов"""
+    # Метод берется по имени у экземпляра из фикстуры, а не связывается при сборе тестов
+    assert await getattr(metal_service, method_name)() == expected_price
+
+
+async def test_get_all_metal_prices_dict(metal_service):
+    """Тестирование словаря текущих цен"""
+    prices_dict = await metal_service.get_all_metal_prices_dict()
+
+    assert prices_dict["date"] == "03.02.2026"
+    assert prices_dict["gold"] == 12400.0
+    assert set(prices_dict["formatted"]) == {"gold", "silver", "platinum", "palladium"}
+    # Повторный вызов отдает тот же результат
+    assert await metal_service.get_all_metal_prices_dict() == prices_dict
+
+
+async def test_get_all_metal_prices_dict_returns_copy(metal_service):
+    """Тестирование: изменение полученного словаря не влияет на следующие вызовы"""
+    prices_dict = await metal_service.get_all_metal_prices_dict()
+    expected = {**prices_dict, "formatted": dict(prices_dict["formatted"])}
+
+    prices_dict["gold"] = 0.0
+    prices_dict["formatted"]["gold"] = "изменено"
+    prices_dict["extra"] = True
+
+    assert await metal_service.get_all_metal_prices_dict() == expected
+
+
+async def test_get_metal_price_change(metal_service):
+    """Тестирование изменения цены за день"""
+    assert await metal_service.get_metal_price_change("gold", days=1) == pytest.approx(
+        (12400.0 / 12345.67 - 1) * 100)
+    assert await metal_service.get_metal_price_change("silver", days=1) == pytest.approx(
+        (151.0 / 150.12 - 1) * 100)
+    # Записей меньше, чем нужно для сравнения
+    assert await metal_service.get_metal_price_change("gold", days=2) is None
+
+
+async def test_force_refresh_and_clear_cache(metal_service, mock_cbr):
+    """Тестирование принудительного обновления и очистки кэша"""
+    await metal_service.get_latest_prices()
+    await metal_service.get_latest_prices()
+    assert len(mock_cbr) == 1
+
+    assert await metal_service.get_latest_prices(force_refresh=True)
+    assert len(mock_cbr) == 2
+
+    metal_service.clear_cache()
+    assert len(metal_service.cache) == 0
+    await metal_service.get_latest_prices()
+    assert len(mock_cbr) == 3
+
+
+async def test_metal_price_to_dict_and_format(metal_service):
+    """Тестирование MetalPrice.to_dict() и format_price()"""
+    latest = (await metal_service.get_latest_prices())[0]
+
+    price_dict = latest.to_dict()
+    assert {"date", "gold", "silver", "platinum", "palladium"} <= set(price_dict)
+
+    formatted = latest.format_price("gold")
+    assert formatted and "руб" not in formatted  # Метод только форматирует число
+    assert latest.format_price("palladium") == "2 400.00"
+
+    # Записи хранят поля в слотах, без __dict__
+    assert not hasattr(latest, "__dict__")
+
+
+async def print_live_summary(service: MetalService):
+    """Сводка по реальным данным ЦБ РФ (режим скрипта)"""
+    print("\n" + "=" * 70)
+    print("СВОДКА ПО ДАННЫМ ЦБ РФ")
     print("=" * 70)
 
-    # Создаем экземпляр сервиса
-    service = MetalService()
+    prices = await service.get_latest_prices()
+    if not prices:
+        print("✗ Не удалось получить цены")
+        return
 
-    test_results = {
-        "passed": 0,
-        "failed": 0,
-        "total": 0
-    }
+    print(f"\nВсего получено записей: {len(prices)}")
+    print(f"Диапазон дат: {prices[-1].date.strftime('%d.%m.%Y')} - {prices[0].date.strftime('%d.%m.%Y')}")
 
-    try:
-        # 1. Тест: get_available_metal_types()
-        print("\n" + "=" * 70)
-        print("1. Тест: get_available_metal_types()")
-        print("-" * 70)
-        metal_types = await service.get_available_metal_types()
-        test_results["total"] += 1
-
-        if metal_types and len(metal_types) == 4:
-            print(f"✓ Методы возвращены: {metal_types}")
-            test_results["passed"] += 1
-        else:
-            print(f"✗ Ошибка: ожидалось 4 типа металлов, получено {len(metal_types) if metal_types else 0}")
-            test_results["failed"] += 1
-
-        # 2. Тест: get_metal_name()
-        print("\n" + "=" * 70)
-        print("2. Тест: get_metal_name()")
-        print("-" * 70)
-
-        test_cases = [
-            ("gold", "Золото"),
-            ("silver", "Серебро"),
-            ("platinum", "Платина"),
-            ("palladium", "Палладий"),
-            ("invalid", None)  # Несуществующий металл
-        ]
-
-        for metal_code, expected_name in test_cases:
-            test_results["total"] += 1
-            name = await service.get_metal_name(metal_code)
-
-            if name == expected_name:
-                print(f"✓ {metal_code}: {name}")
-                test_results["passed"] += 1
-            else:
-                print(f"✗ {metal_code}: ожидалось '{expected_name}', получено '{name}'")
-                test_results["failed"] += 1
-
-        # 3. Тест: get_latest_prices()
-        print("\n" + "=" * 70)
-        print("3. Тест: get_latest_prices()")
-        print("-" * 70)
-
-        prices = await service.get_latest_prices()
-        test_results["total"] += 1
-
-        if prices and len(prices) > 0:
-            print(f"✓ Получено {len(prices)} записей")
-            latest = prices[0]
-            print(f"  Последняя запись: {latest.date.strftime('%d.%m.%Y')}")
-            print(f"  Золото: {latest.gold:.2f} руб/г")
-            print(f"  Серебро: {latest.silver:.2f} руб/г")
-            test_results["passed"] += 1
-        else:
-            print("✗ Ошибка: не удалось получить цены")
-            test_results["failed"] += 1
-
-        # 4. Тест: get_latest_metal_price()
-        print("\n" + "=" * 70)
-        print("4. Тест: get_latest_metal_price()")
-        print("-" * 70)
-
-        for metal_type in metal_types:
-            test_results["total"] += 1
-            price_obj = await service.get_latest_metal_price(metal_type)
-
-            if price_obj and isinstance(price_obj, MetalPrice):
-                metal_name = await service.get_metal_name(metal_type)
-                price = getattr(price_obj, metal_type)
-                print(f"✓ {metal_name}: {price:.2f} руб/г")
-                test_results["passed"] += 1
-            else:
-                print(f"✗ Не удалось получить цену для {metal_type}")
-                test_results["failed"] += 1
-
-        # 5. Тест: get_metal_price_by_date()
-        print("\n" + "=" * 70)
-        print("5. Тест: get_metal_price_by_date()")
-        print("-" * 70)
-
-        # Тест 5.1: Текущая дата
-        test_results["total"] += 1
-        today_price = await service.get_metal_price_by_date(datetime.now())
-
-        if today_price:
-            print(f"✓ Цена на сегодня: найдена")
-            test_results["passed"] += 1
-        else:
-            print(f"✗ Цена на сегодня: не найдена")
-            test_results["failed"] += 1
-
-        # Тест 5.2: Историческая дата (вчера)
-        test_results["total"] += 1
-        yesterday = datetime.now() - timedelta(days=1)
-        yesterday_price = await service.get_metal_price_by_date(yesterday)
-
-        if yesterday_price:
-            print(f"✓ Цена на вчера ({yesterday.strftime('%d.%m.%Y')}): найдена")
-            test_results["passed"] += 1
-        else:
-            print(f"✓ Цена на вчера: не найдена (может быть нормально, если нет данных)")
-            test_results["passed"] += 1
-
-        # 6. Тест: Методы получения конкретных цен
-        print("\n" + "=" * 70)
-        print("6. Тест: Методы получения конкретных цен")
-        print("-" * 70)
-
-        specific_methods = [
-            ("get_gold_price()", service.get_gold_price),
-            ("get_silver_price()", service.get_silver_price),
-            ("get_platinum_price()", service.get_platinum_price),
-            ("get_palladium_price()", service.get_palladium_price)
-        ]
-
-        for method_name, method in specific_methods:
-            test_results["total"] += 1
-            price = await method()
-
-            if price and isinstance(price, float):
-                print(f"✓ {method_name}: {price:.2f} руб/г")
-                test_results["passed"] += 1
-            else:
-                print(f"✗ {method_name}: не удалось получить цену")
-                test_results["failed"] += 1
-
-        # 7. Тест: get_all_metal_prices_dict()
-        print("\n" + "=" * 70)
-        print("7. Тест: get_all_metal_prices_dict()")
-        print("-" * 70)
-
-        prices_dict = await service.get_all_metal_prices_dict()
-        test_results["total"] += 1
-
-        if prices_dict and isinstance(prices_dict, dict):
-            print(f"✓ Словарь цен получен:")
-            print(f"  Дата: {prices_dict.get('date')}")
-            for metal, formatted in prices_dict.get('formatted', {}).items():
-                print(f"  {metal.capitalize()}: {formatted} руб/г")
-            test_results["passed"] += 1
-        else:
-            print("✗ Ошибка: не удалось получить словарь цен")
-            test_results["failed"] += 1
-
-        # 8. Тест: get_price_history()
-        print("\n" + "=" * 70)
-        print("8. Тест: get_price_history()")
-        print("-" * 70)
-
-        # Тест 8.1: История за 5 дней
-        test_results["total"] += 1
-        history_5 = await service.get_price_history(days=5)
-
-        if history_5 and len(history_5) > 0:
-            print(f"✓ История за 5 дней: получено {len(history_5)} записей")
-            for i, price in enumerate(history_5[:3]):  # Показываем первые 3
-                print(f"  {i + 1}. {price.date.strftime('%d.%m.%Y')}: "
-                      f"Au={price.gold:.2f}, Ag={price.silver:.2f}")
-            test_results["passed"] += 1
-        else:
-            print("✗ Ошибка: не удалось получить историю за 5 дней")
-            test_results["failed"] += 1
-
-        # Тест 8.2: История за 30 дней
-        test_results["total"] += 1
-        history_30 = await service.get_price_history(days=30)
-
-        if history_30:
-            print(f"✓ История за 30 дней: получено {len(history_30)} записей")
-            test_results["passed"] += 1
-        else:
-            print("✗ Ошибка: не удалось получить историю за 30 дней")
-            test_results["failed"] += 1
-
-        # 9. Тест: get_metal_price_change()
-        print("\n" + "=" * 70)
-        print("9. Тест: get_metal_price_change()")
-        print("-" * 70)
-
-        if len(prices) >= 2:  # Нужно хотя бы 2 записи для расчета
-            for metal_type in ["gold", "silver"]:
-                test_results["total"] += 1
-                change = await service.get_metal_price_change(metal_type, days=1)
-
-                if change is not None:
-                    metal_name = await service.get_metal_name(metal_type)
-                    print(f"✓ Изменение {metal_name} за 1 день: {change:+.2f}%")
-                    test_results["passed"] += 1
-                else:
-                    print(f"✓ Изменение {metal_type} за 1 день: данных недостаточно")
-                    test_results["passed"] += 1  # Это не ошибка, а недостаток данных
-        else:
-            print("⚠ Недостаточно данных для теста изменения цен")
-            test_results["total"] += 1
-            test_results["passed"] += 1
-
-        # 10. Тест: Принудительное обновление кэша
-        print("\n" + "=" * 70)
-        print("10. Тест: Принудительное обновление кэша")
-        print("-" * 70)
-
-        test_results["total"] += 1
-        prices_forced = await service.get_latest_prices(force_refresh=True)
-
-        if prices_forced:
-            print(f"✓ Данные принудительно обновлены: {len(prices_forced)} записей")
-            test_results["passed"] += 1
-        else:
-            print("✗ Ошибка при принудительном обновлении")
-            test_results["failed"] += 1
-
-        # 11. Тест: clear_cache()
-        print("\n" + "=" * 70)
-        print("11. Тест: clear_cache()")
-        print("-" * 70)
-
-        test_results["total"] += 1
-        service.clear_cache()
-        print("✓ Кэш очищен")
-        test_results["passed"] += 1
-
-        # 12. Тест: to_dict() для MetalPrice
-        print("\n" + "=" * 70)
-        print("12. Тест: MetalPrice.to_dict()")
-        print("-" * 70)
-
-        if prices:
-            test_results["total"] += 1
-            latest_price = prices[0]
-            price_dict = latest_price.to_dict()
-
-            if isinstance(price_dict, dict) and "date" in price_dict:
-                print("✓ Метод to_dict() работает корректно")
-                print(f"  Ключи: {list(price_dict.keys())}")
-                test_results["passed"] += 1
-            else:
-                print("✗ Ошибка в методе to_dict()")
-                test_results["failed"] += 1
-
-            # Тест format_price()
-            test_results["total"] += 1
-            formatted = latest_price.format_price("gold")
-            if formatted and "руб" not in formatted:  # Метод только форматирует число
-                print(f"✓ Метод format_price(): {formatted}")
-                test_results["passed"] += 1
-            else:
-                print("✗ Ошибка в методе format_price()")
-                test_results["failed"] += 1
-
-        # Итоги тестирования
-        print("\n" + "=" * 70)
-        print("ИТОГИ ТЕСТИРОВАНИЯ")
-        print("=" * 70)
-
-        print(f"Всего тестов: {test_results['total']}")
-        print(f"Пройдено: {test_results['passed']}")
-        print(f"Не пройдено: {test_results['failed']}")
-
-        success_rate = (test_results['passed'] / test_results['total']) * 100 if test_results['total'] > 0 else 0
-        print(f"Успешность: {success_rate:.1f}%")
-
-        if test_results['failed'] == 0:
-            print("\n✅ Все тесты пройдены успешно!")
-        else:
-            print(f"\n⚠ Имеются проблемы: {test_results['failed']} тест(ов) не пройдено")
-
-        print("\n" + "=" * 70)
-        print("ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ")
-        print("=" * 70)
-
-        # Вывод детальной информации о полученных данных
-        if prices:
-            print(f"\nВсего получено записей: {len(prices)}")
-            print(f"Диапазон дат: {prices[-1].date.strftime('%d.%m.%Y')} - {prices[0].date.strftime('%d.%m.%Y')}")
-
-            # Средние цены
-            avg_gold = sum(p.gold for p in prices) / len(prices)
-            avg_silver = sum(p.silver for p in prices) / len(prices)
-            print(f"\nСредняя цена золота: {avg_gold:.2f} руб/г")
-            print(f"Средняя цена серебра: {avg_silver:.2f} руб/г")
-
-            # Изменение за период
-            if len(prices) > 1:
-                first = prices[-1]
-                last = prices[0]
-                gold_change = ((last.gold - first.gold) / first.gold) * 100
-                silver_change = ((last.silver - first.silver) / first.silver) * 100
-
-                print(f"\nИзменение за период:")
-                print(f"  Золото: {gold_change:+.2f}%")
-                print(f"  Серебро: {silver_change:+.2f}%")
+    # Столбцы цен сервис уже построил по этому списку: средние и изменения
+    # считаются по массивам, без отдельного прохода по записям на каждую метрику
+    columns = service._get_columns(prices)
+    gold, silver = columns["gold"], columns["silver"]
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка при тестировании: {e}", exc_info=True)
-        test_results["failed"] += 1
-        print(f"\n❌ Критическая ошибка: {e}")
+    # Средние цены
+    print(f"\nСредняя цена золота: {fmean(gold):.2f} руб/г")
+    print(f"Средняя цена серебра: {fmean(silver):.2f} руб/г")
 
-    finally:
-        # Закрываем сессию
-        await service.close()
-        print("\n✅ Сессия закрыта")
+    # Изменение за период (записи идут от новых к старым)
+    if len(prices) > 1:
+        gold_change = (gold[0] / gold[-1] - 1) * 100
+        silver_change = (silver[0] / silver[-1] - 1) * 100
 
-    return test_results
+        print(f"\nИзменение за период:")
+        print(f"  Золото: {gold_change:+.2f}%")
+        print(f"  Серебро: {silver_change:+.2f}%")
 
 
-async def run_performance_test():
+async def run_performance_test(metal_service):
     """Тест производительности"""
     print("\n" + "=" * 70)
     print("ТЕСТ ПРОИЗВОДИТЕЛЬНОСТИ")
     print("=" * 70)
 
-    from src.services.cbr_metals_service import MetalService
     import time
 
-    service = MetalService()
+    service = metal_service
 
-    try:
-        # Тест скорости получения данных
-        start_time = time.time()
-        prices = await service.get_latest_prices()
-        load_time = time.time() - start_time
-
-        print(f"Время загрузки данных: {load_time:.2f} сек")
-        print(f"Количество записей: {len(prices) if prices else 0}")
-
-        # Тест скорости работы с кэшем
-        start_time = time.time()
-        cached_prices = await service.get_latest_prices()
-        cache_time = time.time() - start_time
-
-        print(f"Время получения из кэша: {cache_time:.2f} сек")
-
-        # Ускорение за счет кэша
-        if load_time > 0 and cache_time > 0:
-            speedup = load_time / cache_time
-            print(f"Ускорение за счет кэша: {speedup:.1f}x")
-
-        # Тест получения отдельных цен
-        print("\nТест получения отдельных цен:")
-        for metal in ["gold", "silver", "platinum", "palladium"]:
-            start_time = time.time()
-            price = await service.get_latest_metal_price(metal)
-            elapsed = time.time() - start_time
-            print(f"  {metal.capitalize()}: {elapsed:.3f} сек")
+    # Тест скорости получения данных
+    start_time = time.perf_counter()
+    prices = await service.get_latest_prices()
+    load_time = time.perf_counter() - start_time
 
-    finally:
-        await service.close()
+    print(f"Время загрузки данных: {load_time:.2f} сек")
+    print(f"Количество записей: {len(prices) if prices else 0}")
+
+    # Тест скорости работы с кэшем
+    start_time = time.perf_counter()
+    cached_prices = await service.get_latest_prices()
+    cache_time = time.perf_counter() - start_time
+
+    print(f"Время получения из кэша: {cache_time:.2f} сек")
+    print(f"Доля попаданий в кэш: {service.cache_stats()['hit_rate']:.0%}")
 
+    # Ускорение за счет кэша (perf_counter монотонный, интервалы не отрицательные)
+    if cache_time > 0:
+        speedup = load_time / cache_time
+        print(f"Ускорение за счет кэша: {speedup:.1f}x")
 
-async def test_error_handling():
+    # Тест получения отдельных цен
+    print("\nТест получения отдельных цен:")
+    for metal in ["gold", "silver", "platinum", "palladium"]:
+        start_time = time.perf_counter()
+        price = await service.get_latest_metal_price(metal)
+        elapsed = time.perf_counter() - start_time
+        print(f"  {metal.capitalize()}: {elapsed:.3f} сек")
+
+
+async def test_error_handling(metal_service):
     """Тестирование обработки ошибок"""
-    print("\n" + "=" * 70)
-    print("ТЕСТИРОВАНИЕ ОБРАБОТКИ ОШИБОК")
-    print("=" * 70)
+    # Некорректный тип металла
+    assert await metal_service.get_latest_metal_price("invalid_metal") is None
+
+    # Дата раньше всех известных записей
+    assert await metal_service.get_metal_price_by_date(datetime(2000, 1, 1)) is None
+
+    # format_price с некорректным типом
+    prices = await metal_service.get_latest_prices()
+    with pytest.raises(ValueError):
+        prices[0].format_price("invalid")
+
+
+@pytest.mark.parametrize("metal_code, expected_name", [
+    ("gold", "Золото"),
+    ("silver", "Серебро"),
+    ("platinum", "Платина"),
+    ("palladium", "Палладий"),
+    ("GOLD", "Золото"),  # Регистр кода не важен
+    ("invalid", None),  # Несуществующий металл
+])
+async def test_get_metal_name(metal_service, metal_code, expected_name):
+    """Тестирование названий металлов"""
+    assert await metal_service.get_metal_name(metal_code) == expected_name
+
+
+async def test_latest_prices_from_fixture(metal_service, mock_cbr):
+    """Тестирование получения цен по заранее заданной таблице без сети"""
+    prices = await metal_service.get_latest_prices()
+    assert [p.gold for p in prices] == [12400.0, 12345.67]
+
+    latest_silver = await metal_service.get_latest_metal_price("silver")
+    assert latest_silver.silver == 151.0
+
+    history = await metal_service.get_price_history(days=100000)
+    assert history == prices
+
+    # Все вызовы обслужены одной загрузкой таблицы
+    assert len(mock_cbr) == 1
+
+
+@pytest.mark.parametrize("html_content, expected_gold", [
+    (_HTML_PRICES, [12400.0, 12345.67]),
+    (_HTML_PRICES_NESTED, [12400.0, 12345.67]),
+    ("<html><body><p>Нет таблицы</p></body></html>", []),
+    ("<table><tr><th>Дата</th></tr></table>", []),
+    ("", []),
+    ("some broken data", []),
+])
+def test_parse_metal_prices(html_content, expected_gold):
+    """Тестирование разбора HTML-таблицы ЦБ РФ"""
+    service = MetalService()
+    prices = service._parse_metal_prices(html_content)
+
+    # Записи отсортированы от новых к старым
+    assert [p.gold for p in prices] == expected_gold
+    assert [p.date for p in prices] == sorted((p.date for p in prices), reverse=True)
+    if prices:
+        assert prices[0].date == datetime(2026, 2, 3)
+        assert prices[1].palladium == 2345.67
+
 
-    from src.services.cbr_metals_service import MetalService
+def test_parse_cbr_date():
+    """Тестирование разбора дат ЦБ РФ"""
+    from src.services.cbr_metals_service import _parse_cbr_date
+
+    assert _parse_cbr_date("03.02.2026") == datetime(2026, 2, 3)
+
+    for bad_value in ("bad row", "2026-02-03", "31.02.2026"):
+        with pytest.raises(ValueError):
+            _parse_cbr_date(bad_value)
+
+
+async def test_price_history_cutoff():
+    """Тестирование выборки истории по столбцу дат"""
+    now = datetime.now()
+    prices = [
+        MetalPrice(date=now - timedelta(days=i), gold=100.0 + i, silver=1.0,
+                   platinum=2.0, palladium=3.0)
+        for i in range(10)
+    ]
 
     service = MetalService()
+    service.cache["latest"] = prices
 
-    try:
-        # Тест с некорректным типом металла
-        print("\n1. Тест некорректного типа металла:")
-        invalid_price = await service.get_latest_metal_price("invalid_metal")
-        if invalid_price is None:
-            print("✓ Обработка некорректного типа: корректно возвращает None")
-        else:
-            print("✗ Ожидался None для некорректного типа")
-
-        # Тест с некорректной датой
-        print("\n2. Тест очень старой даты:")
-        old_date = datetime(2000, 1, 1)
-        old_price = await service.get_metal_price_by_date(old_date)
-        if old_price is None:
-            print("✓ Обработка очень старой даты: корректно возвращает None")
-        else:
-            print("✓ Найдена цена для старой даты")
-
-        # Тест метода format_price с некорректным типом
-        print("\n3. Тест format_price с некорректным типом:")
-        if prices := await service.get_latest_prices():
-            try:
-                # Это должно вызвать исключение
-                invalid_format = prices[0].format_price("invalid")
-                print("✗ Ожидалось исключение для некорректного типа")
-            except ValueError as e:
-                print(f"✓ Исключение перехвачено: {e}")
+    history = await service.get_price_history(days=3)
+
+    assert [p.gold for p in history] == [100.0, 101.0, 102.0]
+    assert list(service._get_columns(prices)["gold"][:3]) == [100.0, 101.0, 102.0]
+    assert await service.get_price_history(days=30) == prices
 
+    change = await service.get_metal_price_change("gold", days=2)
+    assert change == pytest.approx((100.0 / 102.0 - 1) * 100)
+    assert await service.get_metal_price_change("gold", days=10) is None
+    assert await service.get_metal_price_change("copper") is None
+
+
+async def test_price_history_windows_share_one_fetch():
+    """Тестирование: окна истории разной длины нарезаются из одной загрузки"""
+    now = datetime.now()
+    prices = [
+        MetalPrice(date=now - timedelta(days=i), gold=100.0 + i, silver=1.0,
+                   platinum=2.0, palladium=3.0)
+        for i in range(40)
+    ]
+    calls = 0
+
+    async def fake_fetch():
+        nonlocal calls
+        calls += 1
+        return prices
+
+    service = MetalService()
+    service._fetch_metal_prices = fake_fetch
+
+    history_5, history_30 = await asyncio.gather(service.get_price_history(days=5),
+                                                 service.get_price_history(days=30))
+
+    assert len(history_5) == 5
+    assert len(history_30) == 30
+    assert history_30[:5] == history_5
+    assert calls == 1
+
+
+async def test_cache_stats():
+    """Тестирование счетчиков попаданий в кэш вместо замеров времени"""
+    latest = MetalPrice(date=datetime(2026, 2, 3), gold=12400.0, silver=151.0,
+                        platinum=3500.0, palladium=2400.0)
+
+    async def fake_fetch():
+        return [latest]
+
+    service = MetalService()
+    service._fetch_metal_prices = fake_fetch
+
+    await service.get_latest_prices()
+    assert service.cache_stats()["hit_rate"] == 0.0
+
+    for _ in range(4):
+        await service.get_latest_prices()
+
+    stats = service.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (4, 1)
+    assert stats["hit_rate"] == 0.8
+
+
+async def test_latest_metal_price_fast_path():
+    """Тестирование быстрого пути для последней цены"""
+    latest = MetalPrice(date=datetime(2026, 2, 3), gold=12400.0, silver=151.0,
+                        platinum=3500.0, palladium=2400.0)
+
+    service = MetalService()
+    service.cache[service._LATEST_PRICE_KEY] = latest
+
+    async def fail_fetch():
+        raise AssertionError("full price list should not be requested")
+
+    service.get_latest_prices = fail_fetch
+
+    assert await service.get_latest_metal_price("gold") is latest
+
+
+async def test_metal_prices_share_one_fetch():
+    """Тестирование: цены разных металлов берутся из одной загрузки таблицы"""
+    latest = MetalPrice(date=datetime(2026, 2, 3), gold=12400.0, silver=151.0,
+                        platinum=3500.0, palladium=2400.0)
+    calls = 0
+
+    async def fake_fetch():
+        nonlocal calls
+        calls += 1
+        return [latest]
+
+    service = MetalService()
+    service._fetch_metal_prices = fake_fetch
+
+    assert await service.get_gold_price() == 12400.0
+    assert await service.get_silver_price() == 151.0
+    assert await service.get_platinum_price() == 3500.0
+    assert calls == 1
+
+
+async def test_concurrent_requests_single_flight():
+    """Тестирование объединения одновременных запросов цен"""
+    latest = MetalPrice(date=datetime(2026, 2, 3), gold=12400.0, silver=151.0,
+                        platinum=3500.0, palladium=2400.0)
+    calls = 0
+
+    async def slow_fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return [latest]
+
+    service = MetalService()
+    service._fetch_metal_prices = slow_fetch
+
+    results = await asyncio.gather(service.get_gold_price(), service.get_silver_price(),
+                                   *(service.get_latest_prices() for _ in range(5)))
+
+    assert results[:2] == [12400.0, 151.0]
+    assert calls == 1
+    assert service._inflight == {}
+
+
+async def test_concurrent_requests_single_flight_error():
+    """Тестирование: ошибка загрузки доходит до всех объединенных запросов"""
+    calls = 0
+
+    async def failing_fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        raise RuntimeError("CBR down")
+
+    service = MetalService()
+    service._fetch_metal_prices = failing_fetch
+
+    results = await asyncio.gather(*(service.get_latest_prices() for _ in range(3)),
+                                   return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert calls == 1
+    assert service._inflight == {}
+
+
+async def test_injected_session():
+    """Тестирование работы с переданной сессией"""
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        service = MetalService(session=session)
+
+        assert await service._get_session() is session
+
+        # Сессией владеет вызывающий код
+        await service.close()
+        assert not session.closed
+
+
+async def main():
+    """Все проверки в одном event loop с общим сервисом и пулом соединений"""
+    from src.services._http import close_shared_session
+
+    service = MetalService()
+    try:
+        await print_live_summary(service)
+        await run_performance_test(service)
     finally:
         await service.close()
+        await close_shared_session()
 
 
 if __name__ == "__main__":
@@ -440,15 +523,7 @@ if __name__ == "__main__":
     print("=" * 70)
 
     try:
-        # Основные тесты
-        results = asyncio.run(test_all_methods())
-
-        # Тесты производительности (опционально)
-        if results.get('failed', 0) == 0:
-            asyncio.run(run_performance_test())
-
-        # Тесты обработки ошибок (опционально)
-        asyncio.run(test_error_handling())
+        asyncio.run(main())
 
     except KeyboardInterrupt:
         print("\n\nТестирование прервано пользователем")
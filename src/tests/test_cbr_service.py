@@ -7,67 +7,108 @@ import asyncio
 from datetime import datetime
 from unittest.mock import AsyncMock, patch, MagicMock
 import aiohttp
+import xml.etree.ElementTree as StdET
 
 # Абсолютный импорт
-from ..services.cbr_service import CBRService
+from ..services import cbr_service as cbr_module
+from ..services.cbr_service import CBRService, _cbr_date_param
+
+# Ответы ЦБ РФ для тестов разбора (строки создаются один раз при импорте модуля)
+_XML_DAILY = """
+<ValCurs Date="03.02.2026" name="Foreign Currency Market">
+    <Valute ID="R01235">
+        <CharCode>USD</CharCode>
+        <Nominal>1</Nominal>
+        <Value>91,2345</Value>
+    </Valute>
+    <Valute ID="R01239">
+        <CharCode>EUR</CharCode>
+        <Nominal>1</Nominal>
+        <Value>99,8765</Value>
+    </Valute>
+    <Valute ID="R01375">
+        <CharCode>CNY</CharCode>
+        <Nominal>10</Nominal>
+        <Value>127,5432</Value>
+    </Valute>
+</ValCurs>
+""".strip()
+
+_XML_DAILY_USD = """
+<ValCurs Date="03.02.2026" name="Foreign Currency Market">
+    <Valute ID="R01235">
+        <CharCode>USD</CharCode>
+        <Nominal>1</Nominal>
+        <Value>91,2345</Value>
+    </Valute>
+</ValCurs>
+""".strip()
+
+_XML_EMPTY = '<ValCurs Date="03.02.2026"></ValCurs>'
+
+_XML_DYNAMIC = """
+<ValCurs ID="R01235" DateRange1="01.02.2026" DateRange2="03.02.2026" name="Foreign Currency Market">
+    <Record Date="01.02.2026" Id="R01235">
+        <Nominal>1</Nominal>
+        <Value>90,1234</Value>
+    </Record>
+    <Record Date="02.02.2026" Id="R01235">
+        <Nominal>1</Nominal>
+        <Value>91,2345</Value>
+    </Record>
+</ValCurs>
+""".strip()
+
+_XML_DYNAMIC_EMPTY = """
+<ValCurs ID="R01235" DateRange1="01.02.2026" DateRange2="03.02.2026" name="Foreign Currency Market">
+</ValCurs>
+""".strip()
+
+
+@pytest.fixture(params=["lxml", "etree"])
+def parser_backend(request, monkeypatch):
+    """Прогоняет тест разбора на обоих парсерах: lxml (основной) и xml.etree (запасной)"""
+    if request.param == "lxml":
+        lxml_etree = pytest.importorskip("lxml.etree")
+        monkeypatch.setattr(cbr_module, "ET", lxml_etree)
+        monkeypatch.setattr(cbr_module, "_LXML", True)
+    else:
+        monkeypatch.setattr(cbr_module, "ET", StdET)
+        monkeypatch.setattr(cbr_module, "_LXML", False)
+    return request.param
 
 
 class TestCBRService:
     """Тесты для сервиса ЦБ РФ"""
 
     @pytest.fixture
-    def cbr_service(self):
-        """Создает экземпляр сервиса для тестов"""
-        service = CBRService()
-        yield service
-        # Очистка после теста
-        if service.session and not service.session.closed:
-            asyncio.run(service.close())
+    def cbr_service(self, shared_cbr_service):
+        """Общий экземпляр сервиса с очищенным кэшем (изоляция тестов)"""
+        shared_cbr_service.clear_cache()
+        return shared_cbr_service
 
     def test_initialization(self, cbr_service):
         """Тест инициализации сервиса"""
         assert cbr_service is not None
-        assert hasattr(cbr_service, 'CBR_API_URL')
+        assert {'CBR_API_URL', 'CURRENCY_CODES'} <= set(dir(cbr_service))
         assert cbr_service.CBR_API_URL == "https://www.cbr.ru/scripts/XML_daily.asp"
         assert 'usd' in cbr_service.CURRENCY_CODES
         assert cbr_service.CURRENCY_CODES['usd'] == 'R01235'
 
-    def test_parse_daily_rates(self, cbr_service):
+    def test_parse_daily_rates(self, cbr_service, parser_backend):
         """Тест парсинга XML данных"""
-        xml_data = '''
-            <ValCurs Date="03.02.2026" name="Foreign Currency Market">
-                <Valute ID="R01235">
-                    <CharCode>USD</CharCode>
-                    <Nominal>1</Nominal>
-                    <Value>91,2345</Value>
-                </Valute>
-                <Valute ID="R01239">
-                    <CharCode>EUR</CharCode>
-                    <Nominal>1</Nominal>
-                    <Value>99,8765</Value>
-                </Valute>
-                <Valute ID="R01375">
-                    <CharCode>CNY</CharCode>
-                    <Nominal>10</Nominal>
-                    <Value>127,5432</Value>
-                </Valute>
-            </ValCurs>
-        '''
-
-        rates = cbr_service._parse_daily_rates(xml_data)
+        rates = cbr_service._parse_daily_rates(_XML_DAILY)
 
         assert 'usd' in rates
         assert 'eur' in rates
         assert 'cny' in rates
-        assert rates['usd'] == 91.2345
-        assert rates['eur'] == 99.8765
-        assert rates['cny'] == 12.75432  # 127.5432 / 10
+        assert rates['usd'] == pytest.approx(91.2345)
+        assert rates['eur'] == pytest.approx(99.8765)
+        assert rates['cny'] == pytest.approx(12.75432)  # 127.5432 / 10
 
     def test_parse_daily_rates_empty_xml(self, cbr_service):
         """Тест парсинга пустого XML"""
-        xml_data = '<ValCurs Date="03.02.2026"></ValCurs>'
-
-        rates = cbr_service._parse_daily_rates(xml_data)
+        rates = cbr_service._parse_daily_rates(_XML_EMPTY)
 
         assert isinstance(rates, dict)
         assert len(rates) == 0
@@ -81,33 +122,15 @@ class TestCBRService:
         assert isinstance(rates, dict)
         assert len(rates) == 0
 
-    def test_parse_dynamic_rate(self, cbr_service):
+    def test_parse_dynamic_rate(self, cbr_service, parser_backend):
         """Тест парсинга динамики курса"""
-        xml_data = '''
-            <ValCurs ID="R01235" DateRange1="01.02.2026" DateRange2="03.02.2026" name="Foreign Currency Market">
-                <Record Date="01.02.2026" Id="R01235">
-                    <Nominal>1</Nominal>
-                    <Value>90,1234</Value>
-                </Record>
-                <Record Date="02.02.2026" Id="R01235">
-                    <Nominal>1</Nominal>
-                    <Value>91,2345</Value>
-                </Record>
-            </ValCurs>
-        '''
-
-        rate = cbr_service._parse_dynamic_rate(xml_data, 'usd')
+        rate = cbr_service._parse_dynamic_rate(_XML_DYNAMIC, 'usd')
 
-        assert rate == 91.2345  # Последняя запись
+        assert rate == pytest.approx(91.2345)  # Последняя запись
 
     def test_parse_dynamic_rate_empty(self, cbr_service):
         """Тест парсинга пустой динамики"""
-        xml_data = '''
-            <ValCurs ID="R01235" DateRange1="01.02.2026" DateRange2="03.02.2026" name="Foreign Currency Market">
-            </ValCurs>
-        '''
-
-        rate = cbr_service._parse_dynamic_rate(xml_data, 'usd')
+        rate = cbr_service._parse_dynamic_rate(_XML_DYNAMIC_EMPTY, 'usd')
 
         assert rate is None
 
@@ -122,20 +145,98 @@ class TestCBRService:
         assert 'eur' in currencies
         assert 'cny' in currencies
 
+    def test_parse_daily_rate_for(self, cbr_service, parser_backend):
+        """Тест разбора одной валюты из XML с ежедневными курсами"""
+        xml_data = '''
+            <ValCurs Date="03.02.2026" name="Foreign Currency Market">
+                <Valute ID="R01235">
+                    <CharCode>USD</CharCode>
+                    <Nominal>1</Nominal>
+                    <Value>91,2345</Value>
+                </Valute>
+                <Valute ID="R01820">
+                    <CharCode>JPY</CharCode>
+                    <Nominal>100</Nominal>
+                    <Value>58,1200</Value>
+                </Valute>
+            </ValCurs>
+        '''
+
+        assert cbr_service._parse_daily_rate_for(xml_data, 'usd') == pytest.approx(91.2345)
+        assert cbr_service._parse_daily_rate_for(xml_data, 'jpy') == pytest.approx(0.5812)
+        assert cbr_service._parse_daily_rate_for(xml_data, 'eur') is None
+
+    def test_parse_daily_rates_ignores_entities(self, cbr_service):
+        """Тест: сущности из DTD не разворачиваются при разборе"""
+        xml_data = '''<?xml version="1.0"?>
+            <!DOCTYPE ValCurs [<!ENTITY code "USD">]>
+            <ValCurs Date="03.02.2026" name="Foreign Currency Market">
+                <Valute ID="R99999">
+                    <CharCode>&code;</CharCode>
+                    <Nominal>1</Nominal>
+                    <Value>99,5000</Value>
+                </Valute>
+            </ValCurs>
+        '''
+
+        rates = cbr_service._parse_daily_rates(xml_data)
+
+        assert 'usd' not in rates
+
+    def test_cbr_date_param(self):
+        """Тест форматирования даты для запросов к ЦБ РФ"""
+        assert _cbr_date_param(datetime(2025, 12, 31, 15, 30)) == '31/12/2025'
+        assert _cbr_date_param(datetime(2025, 12, 31).date()) == '31/12/2025'
+
     def test_clear_cache(self, cbr_service):
         """Тест очистки кэша"""
         # Добавляем тестовые данные в кэш
         cbr_service.cache['test_key'] = {'rate': 100.0}
-        cbr_service.cache_time['test_key'] = datetime.now()
 
         assert len(cbr_service.cache) == 1
-        assert len(cbr_service.cache_time) == 1
 
         # Очищаем кэш
         cbr_service.clear_cache()
 
         assert len(cbr_service.cache) == 0
-        assert len(cbr_service.cache_time) == 0
+
+    @pytest.mark.asyncio
+    async def test_cache_stats(self):
+        """Тест счетчиков попаданий в кэш курсов"""
+        service = CBRService()
+        service._fetch_currency_rate = AsyncMock(return_value=100.0)
+        service.cache['usd_today'] = 90.0
+
+        for _ in range(4):
+            assert await service.get_currency_rate('usd') == 90.0
+        assert await service.get_currency_rate('eur') == 100.0
+
+        stats = service.cache_stats()
+        assert (stats["hits"], stats["misses"]) == (4, 1)
+        assert stats["hit_rate"] == 0.8
+
+    def test_cache_evicts_least_recently_used(self, cbr_service):
+        """Тест вытеснения давно использованных записей при переполнении"""
+        cbr_service.cache.maxsize = 2
+        cbr_service.cache['usd_today'] = 90.0
+        cbr_service.cache['eur_today'] = 100.0
+
+        # Обращение к usd делает его последним использованным
+        assert cbr_service.cache.get('usd_today') == 90.0
+        cbr_service.cache['cny_today'] = 12.0
+
+        assert len(cbr_service.cache) == 2
+        assert 'usd_today' in cbr_service.cache
+        assert 'eur_today' not in cbr_service.cache
+
+    def test_cache_expires_old_entries(self, cbr_service):
+        """Тест устаревания записей по дедлайну"""
+        cbr_service.cache['usd_today'] = 90.0
+        value, deadline = cbr_service.cache._data['usd_today']
+        cbr_service.cache._data['usd_today'] = (value, deadline - cbr_service.cache_ttl - 1)
+
+        assert cbr_service.cache.get('usd_today') is None
+        assert len(cbr_service.cache) == 0
 
     @pytest.mark.asyncio
     async def test_close_session(self, cbr_service):
@@ -150,6 +251,22 @@ class TestCBRService:
         mock_session.close.assert_called_once()
         assert cbr_service.session is None
 
+    @pytest.mark.asyncio
+    async def test_injected_session(self):
+        """Тест работы с переданной сессией (один пул соединений на несколько сервисов)"""
+        from ..services.cbr_metals_service import MetalService
+
+        async with aiohttp.ClientSession() as session:
+            service = CBRService(session=session)
+            metal_service = MetalService(session=session)
+
+            assert await service._get_session() is session
+            assert await metal_service._get_session() is session
+
+            # Сессией владеет вызывающий код
+            await service.close()
+            assert not session.closed
+
     @pytest.mark.asyncio
     @patch('aiohttp.ClientSession.get')
     async def test_get_usd_rub_rate_success(self, mock_get):
@@ -157,15 +274,9 @@ class TestCBRService:
         # Создаем мок ответа
         mock_response = AsyncMock()
         mock_response.status = 200
-        mock_response.text.return_value = '''
-            <ValCurs Date="03.02.2026" name="Foreign Currency Market">
-                <Valute ID="R01235">
-                    <CharCode>USD</CharCode>
-                    <Nominal>1</Nominal>
-                    <Value>91,2345</Value>
-                </Valute>
-            </ValCurs>
-        '''
+        mock_response.text.return_value = _XML_DAILY_USD
+
+        mock_response.headers = {}
 
         # Настраиваем мок
         mock_get.return_value.__aenter__.return_value = mock_response
@@ -178,7 +289,7 @@ class TestCBRService:
             rate = await service.get_usd_rub_rate()
 
             # Проверяем результат
-            assert rate == 91.2345
+            assert rate == pytest.approx(91.2345)
             mock_get.assert_called_once()
 
             # Проверяем, что был вызван правильный URL
@@ -188,6 +299,28 @@ class TestCBRService:
             # Закрываем сессию
             await service.close()
 
+    @pytest.mark.asyncio
+    @patch('aiohttp.ClientSession.get')
+    async def test_daily_rates_not_modified(self, mock_get):
+        """Тест условного запроса: при 304 используется сохраненный XML"""
+        mock_response = AsyncMock()
+        mock_response.status = 304
+        mock_get.return_value.__aenter__.return_value = mock_response
+
+        service = CBRService()
+        service._daily_validators = ('"abc"', 'Tue, 03 Feb 2026 10:00:00 GMT', _XML_DAILY_USD)
+
+        try:
+            rates = await service.get_daily_rates()
+
+            assert rates == {'usd': 91.2345}
+            headers = mock_get.call_args.kwargs['headers']
+            assert headers['If-None-Match'] == '"abc"'
+            assert headers['If-Modified-Since'] == 'Tue, 03 Feb 2026 10:00:00 GMT'
+            mock_response.text.assert_not_called()
+        finally:
+            await service.close()
+
     @pytest.mark.asyncio
     async def test_convert_currency_same(self, cbr_service):
         """Тест конвертации в ту же валюту"""
@@ -196,60 +329,82 @@ class TestCBRService:
         assert result == 100.0
 
     @pytest.mark.asyncio
-    async def test_convert_currency_different(self):
+    async def test_convert_currency_different(self, monkeypatch):
         """Тест конвертации между разными валютами"""
-        # Создаем сервис
         service = CBRService()
+        calls = []
 
-        # Создаем моки для get_currency_rate
-        mock_get_rate = AsyncMock()
+        async def fake_rate(currency, date=None):
+            calls.append(currency)
+            return {'usd': 90.0, 'eur': 100.0}.get(currency.lower())
 
-        # Настраиваем возвращаемые значения
-        mock_get_rate.side_effect = lambda currency, date=None: {
-            'usd': 90.0,
-            'eur': 100.0
-        }.get(currency.lower())
+        monkeypatch.setattr(service, "get_currency_rate", fake_rate)
 
-        # Заменяем метод в сервисе
-        service.get_currency_rate = mock_get_rate
+        # Конвертируем 100 USD в EUR
+        result = await service.convert_currency(100, 'usd', 'eur')
 
-        try:
-            # Конвертируем 100 USD в EUR
-            result = await service.convert_currency(100, 'usd', 'eur')
-
-            # Проверяем: 100 USD * (90 RUB/USD / 100 RUB/EUR) = 90 EUR
-            assert result == 90.0
-            assert mock_get_rate.call_count == 2
-        finally:
-            await service.close()
+        # Проверяем: 100 USD * (90 RUB/USD / 100 RUB/EUR) = 90 EUR
+        assert result == 90.0
+        assert len(calls) == 2
 
     @pytest.mark.asyncio
-    async def test_convert_currency_with_none_rate(self):
+    async def test_convert_currency_with_none_rate(self, monkeypatch):
         """Тест конвертации когда один из курсов None"""
-        # Создаем сервис
         service = CBRService()
+        calls = []
 
-        # Создаем моки для get_currency_rate
-        mock_get_rate = AsyncMock()
+        async def fake_rate(currency, date=None):
+            calls.append(currency)
+            return {'usd': 90.0, 'eur': None}.get(currency.lower())  # Курс EUR не найден
 
-        # Настраиваем возвращаемые значения (один курс None)
-        mock_get_rate.side_effect = lambda currency, date=None: {
-            'usd': 90.0,
-            'eur': None  # Этот курс не будет найден
-        }.get(currency.lower())
+        monkeypatch.setattr(service, "get_currency_rate", fake_rate)
 
-        # Заменяем метод в сервисе
-        service.get_currency_rate = mock_get_rate
+        # Конвертируем 100 USD в EUR
+        result = await service.convert_currency(100, 'usd', 'eur')
 
-        try:
-            # Конвертируем 100 USD в EUR
-            result = await service.convert_currency(100, 'usd', 'eur')
+        # Должно вернуться None, так как один из курсов None
+        assert result is None
+        assert len(calls) == 2
 
-            # Должно вернуться None, так как один из курсов None
-            assert result is None
-            assert mock_get_rate.call_count == 2
-        finally:
-            await service.close()
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_single_flight(self):
+        """Тест объединения одновременных запросов одного курса"""
+        service = CBRService()
+
+        async def slow_fetch(currency_code, date, cache_key):
+            await asyncio.sleep(0.01)
+            return 90.0
+
+        mock_fetch = AsyncMock(side_effect=slow_fetch)
+        service._fetch_currency_rate = mock_fetch
+
+        results = await asyncio.gather(*(service.get_currency_rate('usd') for _ in range(5)))
+
+        assert results == [90.0] * 5
+        assert mock_fetch.call_count == 1
+        assert service._inflight == {}
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_single_flight_error(self):
+        """Тест: ошибка первого запроса доходит до объединенных запросов"""
+        service = CBRService()
+
+        async def failing_fetch(currency_code, date, cache_key):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("CBR down")
+
+        mock_fetch = AsyncMock(side_effect=failing_fetch)
+        service._fetch_currency_rate = mock_fetch
+
+        # get_currency_rate перехватывает ошибку и возвращает None
+        with patch.object(cbr_module, 'logger') as mock_logger:
+            results = await asyncio.gather(*(service.get_currency_rate('usd') for _ in range(5)))
+
+        assert results == [None] * 5
+        assert mock_fetch.call_count == 1
+        # Ошибку видит каждый запрос, а не только первый
+        assert mock_logger.error.call_count == 5
+        assert service._inflight == {}
 
 
 # Простые интеграционные тесты (без моков)
@@ -273,17 +428,7 @@ class TestCBRServiceIntegration:
         """Тест парсинга XML структуры"""
         service = CBRService()
 
-        xml_data = '''
-            <ValCurs Date="03.02.2026" name="Foreign Currency Market">
-                <Valute ID="R01235">
-                    <CharCode>USD</CharCode>
-                    <Nominal>1</Nominal>
-                    <Value>91,2345</Value>
-                </Valute>
-            </ValCurs>
-        '''
-
-        rates = service._parse_daily_rates(xml_data)
+        rates = service._parse_daily_rates(_XML_DAILY_USD)
 
         assert 'usd' in rates
-        assert rates['usd'] == 91.2345
\ No newline at end of file
+        assert rates['usd'] == pytest.approx(91.2345)
\ No newline at end of file
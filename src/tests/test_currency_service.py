@@ -0,0 +1,128 @@
+# src/tests/test_currency_service.py
+"""
+Тесты для сервиса конвертации валют
+"""
+import pytest
+import asyncio
+
+# Абсолютный импорт
+from ..services import currency_service as currency_module
+from ..services.currency_service import CurrencyService
+
+
+class TestCurrencyService:
+    """Тесты для сервиса конвертации валют"""
+
+    @pytest.fixture
+    def currency_service(self):
+        """Создает сервис с заранее заданными курсами"""
+        service = CurrencyService(snapshot_file=None)
+        service.usd_rub_rate_cbr = 90.0
+        service.other_rates_cbr = {"eur": 100.0, "cny": 12.5}
+        return service
+
+    def test_convert_to_rub_sync(self, currency_service):
+        """Тест конвертации в рубли без учета регистра кода валюты"""
+        assert currency_service.convert_to_rub_sync(10, "RUB") == 10
+        assert currency_service.convert_to_rub_sync(10, "Usd") == 920.0
+        assert currency_service.convert_to_rub_sync(2, "EUR") == 200.0
+        assert currency_service.convert_to_rub_sync(2, "xyz") is None
+
+    def test_convert_to_usd_sync(self, currency_service):
+        """Тест конвертации в доллары по реальному курсу"""
+        assert currency_service.convert_to_usd_sync(5, "USD") == 5
+        assert currency_service.convert_to_usd_sync(92, "eur") == pytest.approx(100.0)
+        assert currency_service.get_currency_to_usd_rate_sync("CNY") == pytest.approx(12.5 / 92.0)
+        assert currency_service.get_currency_to_rub_rate_sync("rub") == 1.0
+        assert currency_service.convert_to_usd_sync(184, "RUB") == pytest.approx(2.0)
+        assert currency_service.convert_to_usd_sync(1, "xyz") is None
+
+    def test_real_rate_cache_follows_updates(self, currency_service):
+        """Тест пересчета реального курса при изменении курса ЦБ и надбавки"""
+        assert currency_service.get_real_usd_rub_rate_sync() == 92.0
+
+        currency_service.usd_rub_rate_cbr = 95.0
+        assert currency_service.get_real_usd_rub_rate_sync() == 97.0
+
+        currency_service.additional_rub = 3.0
+        assert currency_service.usd_additional_rub == 3.0
+        assert currency_service.get_real_usd_rub_rate_sync() == 98.0
+
+    def test_usd_to_rub_static(self, monkeypatch):
+        """Тест статической конвертации через глобальный экземпляр"""
+        service = currency_module.get_currency_service()
+        monkeypatch.setattr(service, "_real_rate_cache", 95.0)
+
+        assert CurrencyService.usd_to_rub_static(2) == 190.0
+        assert CurrencyService.usd_to_rub_static(0) == 0.0
+
+    def test_format_rub(self, currency_service):
+        """Тест форматирования рублевых сумм"""
+        assert currency_service.format_rub(1234567.8) == "1,234,568 ₽"
+        assert currency_service.format_rub(999.456) == "999.46 ₽"
+
+    def test_get_rate_info(self, currency_service):
+        """Тест формирования текста с курсами"""
+        info = currency_service.get_rate_info()
+
+        assert info == (
+            "💰 **Курсы валют:**\n"
+            "• USD/RUB (ЦБ): 90.00 ₽\n"
+            "• USD/RUB (реальный): 92.00 ₽ (+2.0 ₽)\n"
+            "• EUR/RUB: 100.00 ₽\n"
+            "• CNY/RUB: 12.50 ₽\n"
+        )
+
+    @pytest.mark.asyncio
+    async def test_update_rates_from_cbr_concurrent(self, monkeypatch, tmp_path):
+        """Тест параллельной загрузки курсов из ЦБ"""
+        rates = {"usd": 90.0, "eur": 100.0, "cny": 12.5, "kzt": 0.2, "uah": None}
+        active = 0
+        max_active = 0
+
+        async def fake_get_currency_rate(currency, date=None):
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return rates[currency]
+
+        async def fake_get_usd_rub_rate():
+            return await fake_get_currency_rate("usd")
+
+        monkeypatch.setattr(currency_module.cbr_service, "get_currency_rate", fake_get_currency_rate)
+        monkeypatch.setattr(currency_module.cbr_service, "get_usd_rub_rate", fake_get_usd_rub_rate)
+
+        service = CurrencyService(snapshot_file=tmp_path / "rates.json")
+        await service.update_rates_from_cbr()
+
+        assert max_active == 5
+        assert service.usd_rub_rate_cbr == 90.0
+        assert service.other_rates_cbr == {"eur": 100.0, "cny": 12.5, "kzt": 0.2}
+        assert service.last_update is not None
+
+    @pytest.mark.asyncio
+    async def test_initialize_from_snapshot(self, monkeypatch, tmp_path):
+        """Тест запуска по свежему снимку курсов без запроса к ЦБ"""
+        snapshot_file = tmp_path / "rates.json"
+        first = CurrencyService(snapshot_file=snapshot_file)
+        first.usd_rub_rate_cbr = 90.0
+        first.other_rates_cbr = {"eur": 100.0}
+        first._save_snapshot()
+
+        async def fail_update():
+            raise AssertionError("ЦБ не должен запрашиваться")
+
+        service = CurrencyService(snapshot_file=snapshot_file)
+        monkeypatch.setattr(service, "update_rates_from_cbr", fail_update)
+        await service.initialize()
+
+        assert service.get_real_usd_rub_rate_sync() == 92.0
+        assert service.other_rates_cbr == {"eur": 100.0}
+        assert service.last_update is not None
+
+        # Устаревший снимок не используется
+        stale = CurrencyService(snapshot_file=snapshot_file)
+        stale.update_interval = 0
+        assert stale._load_snapshot() is False
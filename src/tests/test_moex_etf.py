@@ -2,13 +2,29 @@
 import pytest
 import asyncio
 from unittest.mock import AsyncMock, Mock, patch
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from time import monotonic
 import aiohttp
+import orjson
 
-from src.assets.moex_etf import MoexETFAsset
+from src.assets.moex_etf import MoexETFAsset, _moex_cache_lifetime, _moex_trading_session_id
 from src.config.assets import AssetConfig, AssetType
 
 
+MSK = timezone(timedelta(hours=3))
+
+
+def frozen_datetime(moment: datetime):
+    """Подменяет datetime в модуле moex_etf: now() возвращает заданный момент"""
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return moment
+
+    return patch('src.assets.moex_etf.datetime', FrozenDatetime)
+
+
 @pytest.fixture
 def fxgd_config():
     """Конфигурация для FXGD ETF"""
@@ -51,18 +67,23 @@ def mock_response():
 
 
 @pytest.mark.asyncio
-async def test_get_session_creates_new_session(moex_etf):
-    """Тест создания новой сессии"""
-    # Убедимся, что сессии нет
-    assert moex_etf.session is None
+async def test_get_session_uses_shared_pool(fxgd_config):
+    """Тест: все экземпляры используют общий пул соединений"""
+    from src.services._http import close_shared_session
 
-    # Создаем сессию
-    session = await moex_etf._get_session()
+    first = MoexETFAsset(fxgd_config)
+    second = MoexETFAsset(fxgd_config)
+
+    try:
+        session = await first._get_session()
 
-    # Проверяем, что сессия создана
-    assert session is not None
-    assert isinstance(session, aiohttp.ClientSession)
-    assert moex_etf.session == session
+        assert isinstance(session, aiohttp.ClientSession)
+        assert session._read_bufsize == 2 ** 18
+        assert await second._get_session() is session
+        # Собственная сессия не создается
+        assert first.session is None
+    finally:
+        await close_shared_session()
 
 
 @pytest.mark.asyncio
@@ -78,20 +99,17 @@ async def test_get_session_reuses_existing(moex_etf, mock_session):
 
 
 @pytest.mark.asyncio
-async def test_get_session_recreates_closed(moex_etf, mock_session):
-    """Тест пересоздания закрытой сессии"""
+async def test_get_session_closed_falls_back_to_shared(moex_etf, mock_session):
+    """Тест: вместо закрытой собственной сессии используется общий пул"""
     mock_session.closed = True
     moex_etf.session = mock_session
 
-    # Патчим ClientSession, чтобы он вернул новый мок
-    with patch('src.assets.moex_etf.aiohttp.ClientSession') as mock_client_session:
-        mock_new_session = AsyncMock()
-        mock_client_session.return_value = mock_new_session
-
+    shared_session = AsyncMock()
+    with patch('src.assets.moex_etf.get_shared_session', AsyncMock(return_value=shared_session)) as mock_shared:
         session = await moex_etf._get_session()
 
-        assert session == mock_new_session
-        mock_client_session.assert_called_once()
+        assert session == shared_session
+        mock_shared.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -99,16 +117,14 @@ async def test_get_price_moex_iss_success(moex_etf, mock_session, mock_response)
     """Тест успешного получения цены через MOEX ISS API"""
     # Мокаем ответ от MOEX для первого endpoint
     mock_data_first = [
-        {},  # metadata
+        {"charsetinfo": {"name": "utf-8"}},
         {
-            "securities": {
-                "columns": ["SECID", "LAST", "LASTTOPREVPRICE"],
-                "data": [["FXGD", 3500.50, 2.5]]
-            }
+            "securities": [{"SECID": "FXGD", "PREVPRICE": 3415.00}],
+            "marketdata": [{"SECID": "FXGD", "LAST": 3500.50}]
         }
     ]
 
-    mock_response.json = AsyncMock(return_value=mock_data_first)
+    mock_response.read = AsyncMock(return_value=orjson.dumps(mock_data_first))
     mock_session.get.return_value.__aenter__.return_value = mock_response
 
     # Патчим _get_session
@@ -116,61 +132,115 @@ async def test_get_price_moex_iss_success(moex_etf, mock_session, mock_response)
         price = await moex_etf._get_price_moex_iss()
 
         assert price == 3500.50
+        params = mock_session.get.call_args.kwargs["params"]
+        assert params["iss.json"] == "extended"
+        assert params["iss.only"] == "securities,marketdata"
 
 
 @pytest.mark.asyncio
 async def test_get_price_moex_iss_fallback_to_prevprice(moex_etf, mock_session, mock_response):
     """Тест получения цены через PREVPRICE, когда LAST нет"""
-    # Первый endpoint возвращает None для LAST
-    mock_data_first = [
-        {},
+    # LAST и PREVPRICE приходят в одном ответе
+    mock_data = [
+        {"charsetinfo": {"name": "utf-8"}},
         {
-            "securities": {
-                "columns": ["SECID", "LAST", "LASTTOPREVPRICE"],
-                "data": [["FXGD", None, None]]
-            }
+            "securities": [{"SECID": "FXGD", "PREVPRICE": 3490.00}],
+            "marketdata": [{"SECID": "FXGD", "LAST": None}]
         }
     ]
 
-    # Второй endpoint возвращает PREVPRICE
-    mock_data_second = [
-        {},
+    mock_response.read = AsyncMock(return_value=orjson.dumps(mock_data))
+    mock_session.get.return_value.__aenter__.return_value = mock_response
+
+    with patch.object(moex_etf, '_get_session', return_value=mock_session):
+        price = await moex_etf._get_price_moex_iss()
+
+        assert price == 3490.00
+        # Проверяем что был один запрос
+        assert mock_session.get.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_get_price_moex_iss_large_response(moex_etf, mock_session, mock_response):
+    """Тест разбора ответа MOEX ISS больше 200 КБ"""
+    mock_data = [
+        {"charsetinfo": {"name": "utf-8"}},
         {
-            "securities": {
-                "columns": ["PREVPRICE"],
-                "data": [[3490.00]]
-            }
+            "securities": [{"SECID": "FXGD", "PREVPRICE": 3415.00, "SECNAME": "x" * 200_000}],
+            "marketdata": [{"SECID": "FXGD", "LAST": 3500.50}]
         }
     ]
 
-    # Настраиваем mock чтобы первый вызов вернул первый ответ, второй - второй
-    mock_response.json = AsyncMock(side_effect=[mock_data_first, mock_data_second])
+    mock_response.read = AsyncMock(return_value=orjson.dumps(mock_data))
     mock_session.get.return_value.__aenter__.return_value = mock_response
 
     with patch.object(moex_etf, '_get_session', return_value=mock_session):
-        price = await moex_etf._get_price_moex_iss()
+        assert await moex_etf._get_price_moex_iss() == 3500.50
 
-        assert price == 3490.00
-        # Проверяем что было 2 вызова
-        assert mock_session.get.call_count == 2
+
+@pytest.mark.asyncio
+async def test_get_price_moex_iss_lowercase_source_id(fxgd_config, mock_session, mock_response):
+    """Тест: source_id в нижнем регистре (по умолчанию - символ) совпадает с SECID биржи"""
+    from dataclasses import replace
+
+    tmos = MoexETFAsset(replace(fxgd_config, symbol="tmos", source_id="tmos"))
+    mock_data = [
+        {"charsetinfo": {"name": "utf-8"}},
+        {
+            "securities": [{"SECID": "TMOS", "PREVPRICE": 7.0}],
+            "marketdata": [{"SECID": "TMOS", "LAST": 7.1}]
+        }
+    ]
+
+    mock_response.read = AsyncMock(return_value=orjson.dumps(mock_data))
+    mock_session.get.return_value.__aenter__.return_value = mock_response
+
+    with patch.object(tmos, '_get_session', return_value=mock_session):
+        assert await tmos._get_price_moex_iss() == 7.1
+        assert mock_session.get.call_args.args[0].endswith("/TMOS.json")
+
+        assert await MoexETFAsset.prefetch_all([tmos]) == {"tmos": 7.1}
 
 
 @pytest.mark.asyncio
-async def test_get_price_moex_iss_no_data(moex_etf, mock_session):
-    """Тест, когда оба endpoint возвращают пустые данные"""
+async def test_get_price_moex_iss_304_not_modified(moex_etf, mock_session, mock_response):
+    """Тест условного запроса: при 304 цена берется из прошлого ответа без разбора"""
+    mock_data = [
+        {"charsetinfo": {"name": "utf-8"}},
+        {
+            "securities": [{"SECID": "FXGD", "PREVPRICE": 3415.00}],
+            "marketdata": [{"SECID": "FXGD", "LAST": 3500.50}]
+        }
+    ]
+    last_modified = "Sat, 07 Feb 2026 10:00:00 GMT"
+
+    mock_response.read = AsyncMock(return_value=orjson.dumps(mock_data))
+    mock_response.headers = {"ETag": '"v1"', "Last-Modified": last_modified}
+    mock_session.get.return_value.__aenter__.return_value = mock_response
+
     with patch.object(moex_etf, '_get_session', return_value=mock_session):
-        # Мокаем ответы без данных
-        mock_response1 = AsyncMock(spec=aiohttp.ClientResponse)
-        mock_response1.status = 200
-        mock_response1.json = AsyncMock(return_value=[{}, {"securities": {"data": []}}])
+        assert await moex_etf._get_price_moex_iss() == 3500.50
+        assert mock_session.get.call_args.kwargs["headers"] is None
+
+        not_modified = AsyncMock(spec=aiohttp.ClientResponse)
+        not_modified.status = 304
+        mock_session.get.return_value.__aenter__.return_value = not_modified
+
+        assert await moex_etf._get_price_moex_iss() == 3500.50
+        assert mock_session.get.call_args.kwargs["headers"] == {
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": last_modified
+        }
+        not_modified.read.assert_not_called()
 
-        mock_response2 = AsyncMock(spec=aiohttp.ClientResponse)
-        mock_response2.status = 200
-        mock_response2.json = AsyncMock(return_value=[{}, {"securities": {"data": []}}])
 
-        # Настраиваем последовательные вызовы
-        mock_session.get.return_value.__aenter__.side_effect = [mock_response1, mock_response2]
+@pytest.mark.asyncio
+async def test_get_price_moex_iss_no_data(moex_etf, mock_session, mock_response):
+    """Тест, когда endpoint возвращает пустые данные"""
+    mock_response.read = AsyncMock(return_value=orjson.dumps([{}, {"securities": [], "marketdata": []}]))
+    mock_session.get.return_value.__aenter__.return_value = mock_response
 
+    with patch.object(moex_etf, '_get_session', return_value=mock_session):
         price = await moex_etf._get_price_moex_iss()
 
         assert price is None
@@ -202,7 +272,7 @@ async def test_get_price_with_cache(moex_etf):
 
     # Помещаем в кэш
     moex_etf._cache["fxgd"] = cached_price
-    moex_etf._cache_time["fxgd"] = datetime.now()
+    moex_etf._cache_deadline["fxgd"] = monotonic() + 60
 
     # Получаем цену
     price = await moex_etf.get_price()
@@ -213,28 +283,120 @@ async def test_get_price_with_cache(moex_etf):
 
 @pytest.mark.asyncio
 async def test_get_price_with_expired_cache(moex_etf):
-    """Тест, когда кэш устарел"""
+    """Тест, когда кэш устарел во время торгов"""
     from src.assets.base import AssetPrice
 
+    # Среда, 14:00 по Москве - идут торги
+    now = datetime(2026, 2, 4, 14, 0, tzinfo=MSK)
+
     # Создаем устаревший кэш
     old_price = AssetPrice(
         symbol="fxgd",
         price=3400.00,
         source="moex",
-        timestamp=datetime.now() - timedelta(minutes=2)
+        timestamp=now - timedelta(minutes=2)
     )
 
     moex_etf._cache["fxgd"] = old_price
-    moex_etf._cache_time["fxgd"] = datetime.now() - timedelta(minutes=2)
+    moex_etf._cache_deadline["fxgd"] = monotonic() - 1
 
     # Мокаем получение новой цены
-    with patch.object(moex_etf, '_get_price_moex_iss', return_value=3500.50):
+    with frozen_datetime(now), patch.object(moex_etf, '_get_price_moex_iss', return_value=3500.50):
         price = await moex_etf.get_price()
 
         # Должна вернуться новая цена
         assert price.price == 3500.50
         assert price.symbol == "fxgd"
 
+        # Во время торгов новая цена кэшируется на минуту
+        assert moex_etf._cache_deadline["fxgd"] - monotonic() == pytest.approx(60, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_get_price_cache_lives_longer_when_market_closed(moex_etf):
+    """Тест: вне торгов цена кэшируется на час"""
+    # Воскресенье - торгов нет
+    now = datetime(2026, 2, 8, 14, 0, tzinfo=MSK)
+
+    with frozen_datetime(now), patch.object(moex_etf, '_get_price_moex_iss', return_value=3500.50) as mock_moex:
+        cached_price = await moex_etf.get_price()
+        assert await moex_etf.get_price() is cached_price
+        mock_moex.assert_called_once()
+
+    assert moex_etf._cache_deadline["fxgd"] - monotonic() == pytest.approx(3600, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_get_price_cache_expires_at_market_open(moex_etf):
+    """Тест: цена, полученная до открытия торгов, действительна только до открытия"""
+    now = datetime(2026, 2, 4, 9, 59, 30, tzinfo=MSK)
+
+    with frozen_datetime(now), patch.object(moex_etf, '_get_price_moex_iss', return_value=3500.50):
+        await moex_etf.get_price()
+
+    assert moex_etf._cache_deadline["fxgd"] - monotonic() == pytest.approx(30, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_get_price_single_flight(moex_etf):
+    """Тест объединения одновременных запросов цены в один запрос к бирже"""
+    async def slow_moex_iss():
+        await asyncio.sleep(0.01)
+        return 3500.50
+
+    with patch.object(moex_etf, '_get_price_moex_iss', side_effect=slow_moex_iss) as mock_moex:
+        prices = await asyncio.gather(*(moex_etf.get_price() for _ in range(10)))
+
+    assert mock_moex.call_count == 1
+    assert all(price is prices[0] for price in prices)
+    assert prices[0].price == 3500.50
+    assert moex_etf._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_get_price_single_flight_leader_cancelled(moex_etf):
+    """Тест: отмена первого запроса отменяет ожидающие, а не отдает им None"""
+    async def slow_moex_iss():
+        await asyncio.sleep(1)
+        return 3500.50
+
+    with patch.object(moex_etf, '_get_price_moex_iss', side_effect=slow_moex_iss):
+        leader = asyncio.create_task(moex_etf.get_price())
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(moex_etf.get_price()) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        results = await asyncio.gather(leader, *waiters, return_exceptions=True)
+
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert moex_etf._inflight == {}
+
+
+def test_moex_cache_lifetime():
+    """Тест срока жизни цены с учетом смены торговой сессии"""
+    # Среда: во время торгов - минута, но не дольше закрытия
+    assert _moex_cache_lifetime(datetime(2026, 2, 4, 14, 0, tzinfo=MSK)) == 60
+    assert _moex_cache_lifetime(datetime(2026, 2, 4, 18, 44, 45, tzinfo=MSK)) == 15
+    # До открытия и после закрытия - час, но не дольше открытия и полуночи
+    assert _moex_cache_lifetime(datetime(2026, 2, 4, 9, 0, tzinfo=MSK)) == 3600
+    assert _moex_cache_lifetime(datetime(2026, 2, 4, 9, 59, 30, tzinfo=MSK)) == 30
+    assert _moex_cache_lifetime(datetime(2026, 2, 4, 23, 40, tzinfo=MSK)) == 1200
+    # Выходной: открытия нет, ограничивает только полночь
+    assert _moex_cache_lifetime(datetime(2026, 2, 8, 14, 0, tzinfo=MSK)) == 3600
+    assert _moex_cache_lifetime(datetime(2026, 2, 7, 23, 50, tzinfo=MSK)) == 600
+
+
+def test_moex_trading_session_id():
+    """Тест определения торговой сессии MOEX"""
+    assert _moex_trading_session_id(datetime(2026, 2, 4, 14, 0, tzinfo=MSK)) == (datetime(2026, 2, 4).date(), True)
+    assert _moex_trading_session_id(datetime(2026, 2, 4, 9, 59, tzinfo=MSK))[1] is False
+    assert _moex_trading_session_id(datetime(2026, 2, 4, 18, 45, tzinfo=MSK))[1] is False
+    # Выходной день
+    assert _moex_trading_session_id(datetime(2026, 2, 7, 14, 0, tzinfo=MSK))[1] is False
+    # Время в другом поясе переводится в московское
+    assert _moex_trading_session_id(datetime(2026, 2, 4, 11, 0, tzinfo=timezone.utc))[1] is True
+
 
 @pytest.mark.asyncio
 async def test_get_price_success_flow(moex_etf):
@@ -250,7 +412,7 @@ async def test_get_price_success_flow(moex_etf):
 
         # Проверяем, что цена закэширована
         assert "fxgd" in moex_etf._cache
-        assert "fxgd" in moex_etf._cache_time
+        assert "fxgd" in moex_etf._cache_deadline
 
 
 @pytest.mark.asyncio
@@ -359,6 +521,7 @@ async def test_close_session(moex_etf, mock_session):
     await moex_etf.close()
 
     mock_session.close.assert_called_once()
+    assert moex_etf.session is None
 
 
 @pytest.mark.asyncio
@@ -464,7 +627,7 @@ async def test_integration_flow(moex_etf):
 
                 # Очищаем кэш
                 moex_etf._cache.clear()
-                moex_etf._cache_time.clear()
+                moex_etf._cache_deadline.clear()
 
                 # Тест 2: MOEX неуспешен, Investing успешен
                 mock_moex.return_value = None
@@ -475,7 +638,7 @@ async def test_integration_flow(moex_etf):
 
                 # Очищаем кэш
                 moex_etf._cache.clear()
-                moex_etf._cache_time.clear()
+                moex_etf._cache_deadline.clear()
 
                 # Тест 3: Все неуспешно, используем fallback
                 mock_moex.return_value = None
@@ -485,6 +648,70 @@ async def test_integration_flow(moex_etf):
                 assert price3.price == 35.0
 
 
+@pytest.mark.asyncio
+async def test_prefetch_all_single_request(fxgd_config, mock_session, mock_response):
+    """Тест загрузки цен нескольких ETF одним запросом"""
+    from dataclasses import replace
+
+    fxgd = MoexETFAsset(fxgd_config)
+    tbrd = MoexETFAsset(replace(fxgd_config, symbol="tbrd", name="Тинькофф Облигации", source_id="TBRD"))
+
+    mock_response.read = AsyncMock(return_value=orjson.dumps([
+        {"charsetinfo": {"name": "utf-8"}},
+        {
+            "securities": [
+                {"SECID": "FXGD", "PREVPRICE": 3490.00},
+                {"SECID": "TBRD", "PREVPRICE": 1520.00}
+            ],
+            "marketdata": [
+                {"SECID": "FXGD", "LAST": 3500.50},
+                {"SECID": "TBRD", "LAST": None}
+            ]
+        }
+    ]))
+    mock_session.get.return_value.__aenter__.return_value = mock_response
+
+    with patch.object(MoexETFAsset, '_get_session', AsyncMock(return_value=mock_session)):
+        prices = await MoexETFAsset.prefetch_all([fxgd, tbrd])
+
+        assert prices == {"fxgd": 3500.50, "tbrd": 1520.00}
+        assert mock_session.get.call_count == 1
+        assert mock_session.get.call_args.kwargs["params"]["securities"] == "FXGD,TBRD"
+
+        # Цены берутся из кэша, без запросов к бирже
+        with patch.object(MoexETFAsset, '_get_price_moex_iss') as mock_moex:
+            assert (await fxgd.get_price()).price == 3500.50
+            assert (await tbrd.get_price()).price == 1520.00
+            mock_moex.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_all_http_error(moex_etf, mock_session):
+    """Тест ошибки пакетного запроса: кэш не заполняется"""
+    mock_session.get.return_value.__aenter__.side_effect = aiohttp.ClientError("Connection error")
+
+    with patch.object(moex_etf, '_get_session', return_value=mock_session):
+        assert await MoexETFAsset.prefetch_all([moex_etf]) == {}
+        assert moex_etf._cache == {}
+
+    assert await MoexETFAsset.prefetch_all([]) == {}
+
+
+@pytest.mark.asyncio
+async def test_prefetch_all_unexpected_payload(moex_etf, mock_session, mock_response):
+    """Тест ответа в неожиданном формате: ошибка разбора не выходит наружу"""
+    # Компактный формат columns/data вместо запрошенного iss.json=extended
+    mock_response.read = AsyncMock(return_value=orjson.dumps([
+        {},
+        {"securities": {"columns": ["SECID", "PREVPRICE"], "data": [["FXGD", 3490.00]]}}
+    ]))
+    mock_session.get.return_value.__aenter__.return_value = mock_response
+
+    with patch.object(moex_etf, '_get_session', return_value=mock_session):
+        assert await MoexETFAsset.prefetch_all([moex_etf]) == {}
+        assert moex_etf._cache == {}
+
+
 def test_symbol_uppercase_conversion(moex_etf):
     """Тест преобразования символа в верхний регистр"""
     # Проверяем, что тикер преобразуется правильно
@@ -503,20 +730,20 @@ async def test_get_price_moex_iss_different_data_structures(moex_etf, mock_sessi
         # Тест 1: data есть, но список пустой
         mock_response1 = AsyncMock(spec=aiohttp.ClientResponse)
         mock_response1.status = 200
-        mock_response1.json = AsyncMock(return_value=[
+        mock_response1.read = AsyncMock(return_value=orjson.dumps([
             {},
-            {"securities": {"columns": ["SECID", "LAST"], "data": []}}
-        ])
+            {"securities": [], "marketdata": []}
+        ]))
 
         # Тест 2: securities нет в ответе
         mock_response2 = AsyncMock(spec=aiohttp.ClientResponse)
         mock_response2.status = 200
-        mock_response2.json = AsyncMock(return_value=[{}, {"other": "data"}])
+        mock_response2.read = AsyncMock(return_value=orjson.dumps([{}, {"other": "data"}]))
 
         # Тест 3: неправильная структура ответа
         mock_response3 = AsyncMock(spec=aiohttp.ClientResponse)
         mock_response3.status = 200
-        mock_response3.json = AsyncMock(return_value=[{}])  # Только один элемент
+        mock_response3.read = AsyncMock(return_value=orjson.dumps([{}]))  # Только один элемент
 
         # Тест с первым случаем
         mock_session.get.return_value.__aenter__.return_value = mock_response1
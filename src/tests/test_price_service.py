@@ -0,0 +1,216 @@
+# src/tests/test_price_service.py
+"""
+Тесты для сервиса цен
+"""
+import pytest
+import asyncio
+import time
+from types import SimpleNamespace
+
+# Абсолютный импорт
+from ..assets.base import AssetPrice
+from ..services import price as price_module
+from ..services._cache import TTLCache
+from ..services.price import PriceService, TokenBucket
+from ..config.settings import PriceSources
+
+
+class FakeAsset:
+    """Актив с задержкой ответа вместо сетевого запроса"""
+
+    def __init__(self, symbol: str, price_source: str = "coingecko", delay: float = 0.05):
+        self.symbol = symbol
+        self.config = SimpleNamespace(price_source=price_source)
+        self.delay = delay
+        self.calls = 0
+
+    async def get_price(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return AssetPrice(symbol=self.symbol, price=100.0, source=self.config.price_source)
+
+
+class TestPriceService:
+    """Тесты для сервиса цен"""
+
+    @pytest.fixture
+    def assets(self, monkeypatch):
+        """Подменяет реестр активов тестовыми активами"""
+        assets = {symbol: FakeAsset(symbol) for symbol in ("btc", "eth", "ton", "sol")}
+        monkeypatch.setattr(price_module.asset_registry, "get_asset", assets.get)
+        monkeypatch.setattr(price_module.asset_registry, "get_assets",
+                            lambda symbols: {symbol: assets.get(symbol) for symbol in symbols})
+        return assets
+
+    @pytest.mark.asyncio
+    async def test_get_prices_concurrent(self, assets):
+        """Тест параллельного получения цен без последовательных задержек"""
+        service = PriceService()
+
+        start = time.monotonic()
+        prices = await service.get_prices(list(assets))
+        elapsed = time.monotonic() - start
+
+        assert set(prices) == set(assets)
+        assert all(price.price == 100.0 for price in prices.values())
+        # Последовательно с задержкой 1 сек это заняло бы больше 3 секунд
+        assert elapsed < 1.0
+        assert service.get_price_sources_stats() == {"coingecko": 4}
+
+    @pytest.mark.asyncio
+    async def test_get_prices_unknown_symbol(self, assets):
+        """Тест: неизвестный символ возвращает None"""
+        service = PriceService()
+
+        prices = await service.get_prices(["btc", "unknown"])
+
+        assert prices["btc"].price == 100.0
+        assert prices["unknown"] is None
+
+    @pytest.mark.asyncio
+    async def test_get_price_uses_cache(self, assets):
+        """Тест повторного запроса цены из кэша"""
+        service = PriceService()
+
+        first = await service.get_price("btc")
+        second = await service.get_price("btc")
+
+        assert second is first
+        assert assets["btc"].calls == 1
+        assert "btc" in service.cache
+
+        service.clear_cache()
+        assert len(service.cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_get_price_single_flight(self, assets):
+        """Тест объединения одновременных запросов одной цены"""
+        service = PriceService()
+
+        results = await asyncio.gather(*(service.get_price("btc") for _ in range(10)))
+
+        assert all(price is results[0] for price in results)
+        assert assets["btc"].calls == 1
+        assert service._inflight == {}
+
+    @pytest.mark.asyncio
+    async def test_get_price_single_flight_error(self, assets, monkeypatch):
+        """Тест: ошибка загрузки доходит до всех объединенных запросов"""
+        service = PriceService()
+
+        async def failing_get_price():
+            assets["btc"].calls += 1
+            await asyncio.sleep(0.05)
+            raise RuntimeError("source down")
+
+        monkeypatch.setattr(assets["btc"], "get_price", failing_get_price)
+
+        results = await asyncio.gather(*(service.get_price("btc") for _ in range(3)),
+                                        return_exceptions=True)
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert assets["btc"].calls == 1
+        assert service._inflight == {}
+
+    @pytest.mark.asyncio
+    async def test_get_price_stale_while_revalidate(self, assets):
+        """Тест: устаревшая цена отдается сразу и обновляется в фоне"""
+        service = PriceService()
+        stale = AssetPrice(symbol="btc", price=50.0, source="coingecko")
+        service.cache["btc"] = stale
+
+        # Сдвигаем дедлайн в прошлое, но в пределах окна устаревания
+        value, _ = service.cache._data["btc"]
+        service.cache._data["btc"] = (value, time.monotonic() - 1)
+
+        result = await service.get_price("btc")
+        assert result is stale
+        assert "btc" in service._refreshing
+
+        # Повторный запрос не запускает второе обновление
+        await service.get_price("btc")
+        await asyncio.gather(*service._background_tasks)
+
+        assert assets["btc"].calls == 1
+        assert not service._refreshing
+        assert (await service.get_price("btc")).price == 100.0
+
+    @pytest.mark.asyncio
+    async def test_convert_currency_usd_shortcut(self, assets, monkeypatch):
+        """Тест конвертации с USD без запроса цены USD"""
+        service = PriceService()
+        requested = []
+        original_get_price = service.get_price
+
+        async def tracking_get_price(symbol):
+            requested.append(symbol)
+            return await original_get_price(symbol)
+
+        monkeypatch.setattr(service, "get_price", tracking_get_price)
+
+        assert await service.convert_currency(2, "btc", "USD") == 200.0
+        assert await service.convert_currency(50, "usd", "btc") == 0.5
+        assert requested == ["btc", "btc"]
+
+    @pytest.mark.asyncio
+    async def test_source_stats_merge_enum_and_string(self, assets):
+        """Тест: источник-enum и источник-строка учитываются под одним ключом"""
+        service = PriceService()
+
+        async def enum_source_price():
+            return AssetPrice(symbol="eth", price=10.0, source=PriceSources.BINANCE)
+
+        assets["btc"].config.price_source = "binance"
+        assets["eth"].get_price = enum_source_price
+
+        await service.get_prices(["btc", "eth"])
+
+        assert service.get_price_sources_stats() == {"binance": 2}
+
+    def test_active_price_source_tracks_top(self):
+        """Тест отслеживания самого частого источника"""
+        service = PriceService()
+
+        service._count_sources(["coingecko", "binance", "binance"])
+        assert service.get_active_price_source() == "Binance API (2 запросов)"
+
+        service._count_sources(["coingecko", "coingecko"])
+        assert service.get_active_price_source() == "CoinGecko API (3 запросов)"
+        assert service._top_source == service.request_counter.most_common(1)[0]
+
+    @pytest.mark.asyncio
+    async def test_token_bucket_limits_rate(self):
+        """Тест ограничения частоты после исчерпания запаса токенов"""
+        bucket = TokenBucket(rate=20.0, capacity=2)
+
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        elapsed = time.monotonic() - start
+
+        # Два токена из запаса сразу, еще два - по 1/20 сек каждый
+        assert elapsed >= 0.09
+
+    def test_cache_ttl_jitter(self):
+        """Тест разброса сроков жизни записей кэша"""
+        cache = TTLCache(maxsize=100, ttl=100, jitter=0.2)
+
+        start = time.monotonic()
+        for i in range(20):
+            cache[f"sym{i}"] = i
+
+        deadlines = [deadline - start for _, deadline in cache._data.values()]
+        assert all(80 <= d <= 121 for d in deadlines)
+        assert len(set(deadlines)) > 1
+
+    def test_cache_stats(self):
+        """Тест счетчиков попаданий, промахов и вытеснений кэша"""
+        cache = TTLCache(maxsize=2, ttl=100)
+        cache["btc"] = 1
+        cache["eth"] = 2
+        cache["ton"] = 3  # Вытесняет btc
+
+        assert cache.get("eth") == 2
+        assert cache.get("btc") is None
+
+        assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 1, "hit_rate": 0.5}
@@ -5,8 +5,10 @@
 import pytest
 import tempfile
 import os
+import sqlite3
 
 # Абсолютный импорт
+from ..database import simple_repo
 from ..database.simple_repo import SimplePortfolioRepository
 
 
@@ -17,8 +19,7 @@ class TestPortfolioRepository:
     def repo(self):
         """Создает временный репозиторий для тестов"""
         # Создаем временный файл БД
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            f.write('{}')
+        with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as f:
             db_file = f.name
 
         # Создаем репозиторий с временным файлом
@@ -26,14 +27,13 @@ class TestPortfolioRepository:
         yield repo
 
         # Очистка после теста
-        repo._save_data()
+        repo.close()
         os.unlink(db_file)
 
     def test_initialization(self, repo):
         """Тест инициализации репозитория"""
         assert repo is not None
-        assert hasattr(repo, 'data_file')
-        assert hasattr(repo, 'data')
+        assert {'data_file', 'data'} <= set(dir(repo))
         assert isinstance(repo.data, dict)
 
     def test_get_or_create_user_new(self, repo):
@@ -319,6 +319,23 @@ class TestPortfolioRepository:
         assert health['status'] == 'healthy'
         assert health['initialized'] is True
 
+    def test_health_check_asset_counter(self, repo):
+        """Тест счетчика активов при добавлении, удалении и очистке"""
+        repo.get_or_create_user(12345, "user1")
+        repo.get_or_create_user(67890, "user2")
+        repo.add_asset(12345, 'btc', 0.5)
+        repo.add_asset(12345, 'btc', 0.5)
+        repo.add_asset(12345, 'eth', 2.0)
+        repo.add_asset(67890, 'ton', 10.0)
+        assert repo.health_check()['total_assets'] == 3
+
+        repo.remove_asset(12345, 'btc', 0.4)
+        repo.remove_asset(12345, 'eth', None)
+        assert repo.health_check()['total_assets'] == 2
+
+        repo.clear_portfolio(12345)
+        assert repo.health_check()['total_assets'] == repo._count_assets() == 1
+
     def test_save_method(self, repo):
         """Тест публичного метода сохранения"""
         user_id = 12345
@@ -332,6 +349,143 @@ class TestPortfolioRepository:
         success = repo.save()
 
         assert success is True
+        row = repo._conn.execute(
+            "SELECT amount FROM assets WHERE user_id = ? AND symbol = ?", (user_id, 'btc')
+        ).fetchone()
+        assert row == (0.5,)
+
+    def test_transaction_defers_commit(self, repo):
+        """Тест одной фиксации изменений внутри транзакции"""
+        repo.get_or_create_user(12345, "test_user")
+
+        with repo.transaction():
+            repo.add_asset(12345, 'btc', 0.5)
+            repo.add_asset(12345, 'eth', 2.0)
+            assert repo._conn.in_transaction
+
+        assert not repo._conn.in_transaction
+
+        reopened = SimplePortfolioRepository(str(repo.data_file))
+        try:
+            assert set(reopened.get_user_assets(12345)) == {'btc', 'eth'}
+        finally:
+            reopened.close()
+
+    def test_transaction_failed_write_rolls_back(self, repo, monkeypatch):
+        """Тест: неудачная запись внутри транзакции откатывается целиком"""
+        repo.get_or_create_user(12345, "test_user")
+
+        with repo.transaction():
+            assert repo.add_asset(12345, 'btc', 0.5)[0] is True
+
+            # Второй запрос группы падает после успешной записи актива
+            monkeypatch.setattr(simple_repo, "_TOUCH_USER", "UPDATE missing_table SET x = ?")
+            success, _ = repo.add_asset(12345, 'eth', 2.0)
+            monkeypatch.undo()
+
+            assert success is False
+            assert set(repo.get_user_assets(12345)) == {'btc'}
+
+        reopened = SimplePortfolioRepository(str(repo.data_file))
+        try:
+            assert set(reopened.get_user_assets(12345)) == {'btc'}
+        finally:
+            reopened.close()
+
+    def test_transaction_exception_rolls_back(self, repo):
+        """Тест: исключение в блоке транзакции отменяет все ее изменения"""
+        repo.get_or_create_user(12345, "test_user")
+        repo.add_asset(12345, 'btc', 0.5)
+
+        with pytest.raises(RuntimeError):
+            with repo.transaction():
+                repo.add_asset(12345, 'btc', 1.0)
+                repo.add_asset(12345, 'eth', 2.0)
+                raise RuntimeError("handler failed")
+
+        assert set(repo.get_user_assets(12345)) == {'btc'}
+        assert repo.get_user_assets(12345)['btc']['amount'] == 0.5
+        assert repo.health_check()['total_assets'] == 1
+
+        reopened = SimplePortfolioRepository(str(repo.data_file))
+        try:
+            assert reopened.data == repo.data
+        finally:
+            reopened.close()
+
+    def test_transaction_failed_commit_raises(self, repo):
+        """Тест: ошибка фиксации откатывает изменения и пробрасывается"""
+        repo.get_or_create_user(12345, "test_user")
+        conn = repo._conn
+
+        class FailingCommit:
+            """Соединение, у которого фиксация завершается ошибкой"""
+
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+            def commit(self):
+                raise sqlite3.OperationalError("disk I/O error")
+
+        repo._conn = FailingCommit()
+        try:
+            with pytest.raises(sqlite3.OperationalError):
+                with repo.transaction():
+                    repo.add_asset(12345, 'btc', 0.5)
+        finally:
+            repo._conn = conn
+
+        assert repo.get_user_assets(12345) == {}
+        assert repo.health_check()['total_assets'] == 0
+
+    def test_persistence_after_reopen(self, repo):
+        """Тест: изменения записываются в базу сразу, без полного сохранения"""
+        repo.get_or_create_user(12345, "test_user")
+        repo.add_asset(12345, 'btc', 0.5)
+        repo.add_asset(12345, 'eth', 2.0)
+        repo.remove_asset(12345, 'eth', 0.5)
+
+        reopened = SimplePortfolioRepository(str(repo.data_file))
+        try:
+            assert reopened.data == repo.data
+            assert reopened.health_check()['journal_mode'] == 'wal'
+        finally:
+            reopened.close()
+
+    def test_import_legacy_json(self, tmp_path):
+        """Тест переноса данных из прежнего JSON файла"""
+        (tmp_path / "user_data.json").write_text(
+            '{"12345": {"user_id": 12345, "username": "test_user", '
+            '"assets": {"btc": {"symbol": "btc", "amount": 0.5}}}}',
+            encoding='utf-8'
+        )
+
+        repo = SimplePortfolioRepository(str(tmp_path / "user_data.db"))
+        try:
+            assert repo.get_user_assets(12345)['btc']['amount'] == 0.5
+            assert repo._conn.execute("SELECT COUNT(*) FROM assets").fetchone() == (1,)
+        finally:
+            repo.close()
+
+    def test_import_legacy_json_path(self, tmp_path):
+        """Тест: путь к прежнему JSON файлу открывает базу рядом и переносит данные"""
+        json_file = tmp_path / "port.json"
+        json_file.write_text(
+            '{"12345": {"user_id": 12345, "username": "test_user", '
+            '"assets": {"btc": {"symbol": "btc", "amount": 0.5}}}}',
+            encoding='utf-8'
+        )
+
+        repo = SimplePortfolioRepository(str(json_file))
+        try:
+            assert repo.data_file == tmp_path / "port.db"
+            assert repo.get_user_assets(12345)['btc']['amount'] == 0.5
+        finally:
+            repo.close()
+
+        # JSON файл не перемещается и не изменяется
+        assert json_file.exists()
+        assert not list(tmp_path.glob("*.backup.*"))
 
     def test_update_username(self, repo):
         """Тест обновления имени пользователя"""
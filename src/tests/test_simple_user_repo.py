@@ -0,0 +1,139 @@
+# src/tests/test_simple_user_repo.py
+"""
+Тесты для simple_user_repo
+"""
+import pytest
+import tempfile
+import json
+import os
+from datetime import datetime, timedelta
+
+# Абсолютный импорт
+from ..database.simple_user_repo import SimpleUserRepository
+
+
+class TestUserRepository:
+    """Тесты для репозитория пользователей"""
+
+    @pytest.fixture
+    def repo(self):
+        """Создает временный репозиторий для тестов"""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
+            f.write('{}')
+            db_file = f.name
+
+        repo = SimpleUserRepository(db_file)
+        yield repo
+
+        # Очистка после теста
+        os.unlink(db_file)
+
+    def test_save_writes_file(self, repo):
+        """Тест быстрой записи без временного файла"""
+        repo.get_or_create_user(12345, "test_user")
+
+        with open(repo.data_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        assert data["12345"]["username"] == "test_user"
+        assert not repo.data_file.with_suffix('.tmp').exists()
+
+    def test_save_durable(self, repo):
+        """Тест надежной записи с fsync"""
+        repo.durable = True
+        repo.get_or_create_user(12345, "test_user")
+
+        reloaded = SimpleUserRepository(str(repo.data_file))
+
+        assert reloaded.get_user_settings(12345)["language"] == "ru"
+        assert not repo.data_file.with_suffix('.tmp').exists()
+
+    def test_int_keys_roundtrip(self, repo):
+        """Тест хранения int ключей в памяти и строковых в файле"""
+        repo.get_or_create_user(12345, "test_user")
+
+        reloaded = SimpleUserRepository(str(repo.data_file))
+
+        assert 12345 in reloaded.data
+        assert "12345" not in reloaded.data
+        assert reloaded.data[12345]["username"] == "test_user"
+
+    def test_transaction_defers_save(self, repo):
+        """Тест отложенного сохранения внутри транзакции"""
+        writes = []
+        original_write = repo._write_data
+
+        def counting_write():
+            writes.append(1)
+            return original_write()
+
+        repo._write_data = counting_write
+
+        with repo.transaction():
+            repo.get_or_create_user(12345, "test_user")
+            repo.record_user_activity(12345, "start")
+            repo.update_user_settings(12345, {"currency": "RUB"})
+            assert len(writes) == 0
+
+        assert len(writes) == 1
+
+        reloaded = SimpleUserRepository(str(repo.data_file))
+        assert reloaded.get_user_settings(12345)["currency"] == "RUB"
+
+    def test_transaction_rolls_back_on_error(self, repo):
+        """Тест: при исключении в транзакции ничего не записывается"""
+        repo.get_or_create_user(1, "existing")
+
+        writes = []
+        original_write = repo._write_data
+
+        def counting_write():
+            writes.append(1)
+            return original_write()
+
+        repo._write_data = counting_write
+
+        with pytest.raises(RuntimeError):
+            with repo.transaction():
+                repo.get_or_create_user(12345, "test_user")
+                repo.update_user_settings(1, {"currency": "RUB"})
+                raise RuntimeError("handler failed")
+
+        assert len(writes) == 0
+        assert not repo._dirty
+        # Данные в памяти откатываются к состоянию файла
+        assert 12345 not in repo.data
+        assert repo.get_user_settings(1)["currency"] == "USD"
+        assert repo.health_check()["active_users_7d"] == 1
+
+        reloaded = SimpleUserRepository(str(repo.data_file))
+        assert 12345 not in reloaded.data
+        assert reloaded.get_user_settings(1)["currency"] == "USD"
+
+    def test_active_users_index(self, repo):
+        """Тест подсчета активных пользователей по индексу"""
+        repo.get_or_create_user(1, "active")
+        repo.get_or_create_user(2, "inactive")
+        repo.data[2]["last_seen"] = "2000-01-01T00:00:00"
+        repo._rebuild_activity_index()
+
+        repo.record_user_activity(1, "start")
+
+        assert repo.health_check()["active_users_7d"] == 1
+        assert repo.get_user_statistics()["active_users"] == 1
+
+        repo.record_user_activity(2, "start")
+
+        assert repo.health_check()["active_users_7d"] == 2
+        assert sum(len(users) for users in repo._active_by_day.values()) == 2
+
+    def test_active_users_cutoff_time(self, repo):
+        """Тест: в день границы активность сравнивается с отсечкой по времени"""
+        now = datetime.now()
+        repo.get_or_create_user(1, "inside")
+        repo.get_or_create_user(2, "outside")
+        repo.data[1]["last_seen"] = (now - timedelta(days=7) + timedelta(minutes=1)).isoformat()
+        repo.data[2]["last_seen"] = (now - timedelta(days=7, minutes=1)).isoformat()
+        repo._rebuild_activity_index()
+
+        assert repo.health_check()["active_users_7d"] == 1